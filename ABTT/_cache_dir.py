@@ -0,0 +1,5 @@
+import os
+
+# root directory of the caches of ABTT, e.g. of parsed star files and orientation grids, can be overridden with the
+# ABTT_CACHE_DIR environment variable
+CACHE_DIR = os.environ.get('ABTT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ABTT'))
@@ -1,3 +1,5 @@
+from . import cache
+from . import convert
 from . import dynamo
 from . import mrc
 from . import pdb
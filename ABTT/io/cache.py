@@ -0,0 +1,191 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .._cache_dir import CACHE_DIR
+
+# maximum total size in bytes of the cache directory, least recently used entries are evicted beyond this
+CACHE_SIZE_LIMIT = 10 * 2 ** 30
+
+# number of bytes hashed at the start and at the end of a source file to detect changes in place
+_FINGERPRINT_BYTES = 2 ** 20
+
+_META_FILE = 'meta.json'
+
+
+def fingerprint(source_file):
+    """
+    fingerprints a file from its size, modification time and a hash of its first and last megabyte
+    hashing the whole file would cost as much as parsing it, sampling catches files rewritten in place
+    :param source_file: file
+    :return: dict {'size', 'mtime_ns', 'sha1'}
+    """
+    stat = os.stat(source_file)
+    sha1 = hashlib.sha1()
+    with open(source_file, 'rb') as file:
+        sha1.update(file.read(_FINGERPRINT_BYTES))
+        if stat.st_size > 2 * _FINGERPRINT_BYTES:
+            file.seek(-_FINGERPRINT_BYTES, os.SEEK_END)
+            sha1.update(file.read(_FINGERPRINT_BYTES))
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1.hexdigest()}
+
+
+def entry_directory(source_file, float_dtype=np.float64, cache_dir=None):
+    """
+    directory of the cache entry for a source file parsed with a given float dtype
+    :param source_file: file
+    :param float_dtype: dtype of non-integer numeric columns
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :return: path
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    key = f'{os.path.abspath(source_file)}:{np.dtype(float_dtype).str}'
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+def load_blocks(source_file, float_dtype=np.float64, columns=None, mmap=False, cache_dir=None):
+    """
+    loads the parsed blocks of a source file from its cache entry
+    :param source_file: file
+    :param float_dtype: dtype of non-integer numeric columns
+    :param columns: headings of the columns to load, None for all, other columns are returned as None
+    :param mmap: if True, columns are memory mapped read-only rather than read into memory
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :return: list of (block_name, headings, columns, header) as produced by star.scan_blocks or None if the entry
+             is missing or out of date
+    """
+    directory = entry_directory(source_file, float_dtype, cache_dir)
+    meta_file = os.path.join(directory, _META_FILE)
+    try:
+        with open(meta_file, 'r') as file:
+            meta = json.load(file)
+    except FileNotFoundError:
+        return None
+
+    if meta['fingerprint'] != fingerprint(source_file):
+        logging.info(f'cache entry for {source_file} is out of date')
+        shutil.rmtree(directory, ignore_errors=True)
+        return None
+
+    logging.info(f'loading {source_file} from cache: {directory}')
+    mmap_mode = 'r' if mmap else None
+    blocks = []
+    try:
+        for block in meta['blocks']:
+            block_columns = []
+            for heading, column_file in zip(block['headings'], block['files']):
+                if columns is None or heading in columns:
+                    column = np.load(os.path.join(directory, column_file), mmap_mode=mmap_mode)
+                    # key-value pairs are stored as 0-d arrays
+                    if column.ndim == 0:
+                        column = column[()]
+                    block_columns.append(column)
+                else:
+                    block_columns.append(None)
+            blocks.append((block['name'], block['headings'], block_columns, block['header']))
+
+        # touch the entry to mark it as recently used
+        os.utime(meta_file)
+    except FileNotFoundError:
+        # the entry was replaced or evicted by another process while it was read
+        logging.info(f'cache entry for {source_file} was removed while it was loaded')
+        return None
+
+    return blocks
+
+
+def store_blocks(source_file, blocks, float_dtype=np.float64, cache_dir=None, size_limit=None):
+    """
+    stores the parsed blocks of a source file as one .npy file per column, then evicts old entries
+    the entry is written into a temporary sibling directory and moved into place once complete, so that processes
+    caching the same file at once, e.g. the workers of star.read_many, never load or remove each other's partially
+    written entries
+    :param source_file: file
+    :param blocks: list of (block_name, headings, columns, header) as produced by star.scan_blocks
+    :param float_dtype: dtype of non-integer numeric columns
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :param size_limit: maximum size of the cache directory in bytes, defaults to CACHE_SIZE_LIMIT
+    :return: directory of the cache entry
+    """
+    directory = entry_directory(source_file, float_dtype, cache_dir)
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    logging.info(f'caching {source_file} in {directory}')
+
+    meta = {'source': os.path.abspath(source_file),
+            'fingerprint': fingerprint(source_file),
+            'blocks': []}
+
+    partial = tempfile.mkdtemp(prefix=f'.{os.path.basename(directory)}.', dir=os.path.dirname(directory))
+    try:
+        for block_idx, (block_name, headings, columns, header) in enumerate(blocks):
+            files = []
+            for column_idx, column in enumerate(columns):
+                column_file = f'{block_idx}_{column_idx}.npy'
+                np.save(os.path.join(partial, column_file), column, allow_pickle=False)
+                files.append(column_file)
+            meta['blocks'].append({'name': block_name, 'headings': headings, 'header': header, 'files': files})
+
+        with open(os.path.join(partial, _META_FILE), 'w') as file:
+            json.dump(meta, file)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        try:
+            os.replace(partial, directory)
+        except OSError:
+            # another process stored the same entry in the meantime, its entry is kept
+            logging.debug(f'cache entry {directory} was stored by another process')
+    finally:
+        shutil.rmtree(partial, ignore_errors=True)
+
+    evict(cache_dir, size_limit)
+    return directory
+
+
+def evict(cache_dir=None, size_limit=None):
+    """
+    removes least recently used entries from the cache directory until it is no larger than size_limit
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :param size_limit: maximum size of the cache directory in bytes, defaults to CACHE_SIZE_LIMIT
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if size_limit is None:
+        size_limit = CACHE_SIZE_LIMIT
+
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        # entries being written, see store_blocks
+        if name.startswith('.'):
+            continue
+        directory = os.path.join(cache_dir, name)
+        meta_file = os.path.join(directory, _META_FILE)
+        if not os.path.exists(meta_file):
+            continue
+        size = sum(entry.stat().st_size for entry in os.scandir(directory))
+        entries.append((os.stat(meta_file).st_mtime, size, directory))
+
+    total_size = sum(entry[1] for entry in entries)
+    for last_used, size, directory in sorted(entries):
+        if total_size <= size_limit:
+            break
+        logging.info(f'evicting cache entry {directory}')
+        shutil.rmtree(directory, ignore_errors=True)
+        total_size -= size
+
+
+def clear(cache_dir=None):
+    """
+    removes every entry from the cache directory
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    """
+    evict(cache_dir, size_limit=0)
@@ -0,0 +1,193 @@
+import logging
+import os
+
+import numpy as np
+
+from .dynamo import DynamoTable, TableWriter, format_table_map, iter_table_chunks, table_map_read, table_map_write
+from .star import StarDict, StarWriter, iter_chunks
+from ..math.euler_angles import dynamo2relion, relion2dynamo
+
+
+def dynamo_to_star(table, table_map):
+    """
+    converts a DynamoTable into a StarDict for particle extraction in Warp or subtomogram averaging in RELION
+    positions include the shifts in the table, tomograms are named by the basename of their path in the table map
+    :param table: DynamoTable
+    :param table_map: dict { tomo_idx : '/path/to/tomogram' } as read by table_map_read
+    :return: StarDict
+    """
+    logging.info(f'converting DynamoTable with {table.number_of_particles()} particles into a StarDict')
+    star = StarDict()
+
+    xyz = table['xyz']
+    star['rlnCoordinateX'] = xyz[:, 0]
+    star['rlnCoordinateY'] = xyz[:, 1]
+    star['rlnCoordinateZ'] = xyz[:, 2]
+
+    euler_angles_relion = dynamo2relion(table['eulers'])
+    star['rlnAngleRot'] = euler_angles_relion[:, 0]
+    star['rlnAngleTilt'] = euler_angles_relion[:, 1]
+    star['rlnAnglePsi'] = euler_angles_relion[:, 2]
+
+    star['rlnMicrographName'] = tomogram_names(table['tomo'], table_map)
+    return star
+
+
+def star_to_dynamo(star, table_map=None, first_tag=1):
+    """
+    converts a StarDict, e.g. from particle extraction in Warp, into a DynamoTable
+    particles are tagged in order from first_tag, tomograms are indexed from 1 in sorted order of rlnMicrographName
+    when converting chunks of one star file, passing the table map and next tag from the previous chunk keeps tags
+    and tomogram indices consistent across chunks
+    :param star: StarDict
+    :param table_map: dict { tomo_idx : tomogram } of tomograms already indexed, updated in place with new tomograms
+                      which are indexed after those already present. None for a new table map
+    :param first_tag: tag of the first particle
+    :return: table, table_map: DynamoTable and dict { tomo_idx : tomogram } to be written with table_map_write
+    """
+    n_rows = star.nrows()
+    logging.info(f'converting StarDict with {n_rows} particles into a DynamoTable')
+    if table_map is None:
+        table_map = {}
+    tomograms, inverse = np.unique(star['rlnMicrographName'], return_inverse=True)
+
+    # only unique tomograms are looked up in the table map
+    map_indices = {tomogram: idx for idx, tomogram in table_map.items()}
+    next_idx = max(table_map, default=0) + 1
+    for tomogram in tomograms:
+        if tomogram not in map_indices:
+            map_indices[tomogram] = next_idx
+            table_map[next_idx] = tomogram
+            next_idx += 1
+    tomogram_indices = np.array([map_indices[tomogram] for tomogram in tomograms], dtype=int)[inverse]
+    tags = np.arange(n_rows) + first_tag
+
+    table = DynamoTable()
+    table['tag'] = tags
+    table['aligned_value'] = np.ones_like(tags)
+    table['averaged_value'] = np.ones_like(tags)
+    table['x'] = star['rlnCoordinateX']
+    table['y'] = star['rlnCoordinateY']
+    table['z'] = star['rlnCoordinateZ']
+
+    euler_angles_dynamo = relion2dynamo(star.extract_eulers_relion())
+    table['tdrot'] = euler_angles_dynamo[:, 0]
+    table['tilt'] = euler_angles_dynamo[:, 1]
+    table['narot'] = euler_angles_dynamo[:, 2]
+
+    table['tomo'] = tomogram_indices
+    return table, table_map
+
+
+def stream_dynamo_to_star(table_file, table_map_file, star_file, chunksize=1000000):
+    """
+    converts a table file into a star file chunk by chunk, see dynamo_to_star, memory use is bounded by chunksize
+    :param table_file: dynamo table file
+    :param table_map_file: dynamo table map file
+    :param star_file: output star file
+    :param chunksize: maximum number of particles converted at once
+    :return: star_file
+    """
+    logging.info(f'converting {table_file} into {star_file} in chunks of {chunksize} particles')
+    table_map = table_map_read(table_map_file)
+    columns = ['tomo', 'x', 'y', 'z', 'dx', 'dy', 'dz', 'tdrot', 'tilt', 'narot']
+
+    with StarWriter(star_file) as writer:
+        for table in iter_table_chunks(table_file, chunksize, columns=columns):
+            writer.write(dynamo_to_star(table, table_map))
+
+    return star_file
+
+
+def stream_star_to_dynamo(star_file, table_file, chunksize=1000000, reextraction_box_size=None):
+    """
+    converts a star file into a table file chunk by chunk, see star_to_dynamo, memory use is bounded by chunksize
+    the table map is written next to the table file with the extension .doc
+    :param star_file: star file, e.g. from particle extraction in Warp. Particles are read from data_particles in
+                      RELION 3.1 star files, else from the first loop
+    :param table_file: output table file
+    :param chunksize: maximum number of particles converted at once
+    :param reextraction_box_size: if given, a table and table map for reextraction of a dynamo data folder from the
+                                  particles in rlnImageName are also written, see reextraction_table
+    :return: table_map: dict { tomo_idx : tomogram }
+    :raises ValueError: if no particles were converted
+    """
+    logging.info(f'converting {star_file} into {table_file} in chunks of {chunksize} particles')
+    columns = ['rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ', 'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi',
+               'rlnMicrographName']
+    if reextraction_box_size is not None:
+        columns.append('rlnImageName')
+
+    table_map = {}
+    next_tag = 1
+    with TableWriter(table_file) as writer:
+        if reextraction_box_size is not None:
+            reextraction_writer = TableWriter(table_file.replace('.tbl', '_reextract.tbl'))
+            reextraction_map_file = open(table_file.replace('.tbl', '_reextract.doc'), 'w')
+
+        try:
+            # names are read as strings in every chunk, a chunk of names such as '007' would otherwise be numeric
+            for star in iter_chunks(star_file, chunksize=chunksize, columns=columns,
+                                    dtypes={'rlnMicrographName': str, 'rlnImageName': str}):
+                table, table_map = star_to_dynamo(star, table_map, next_tag)
+                writer.write(table)
+                next_tag += star.nrows()
+
+                if reextraction_box_size is not None:
+                    reextraction_writer.write(reextraction_table(table, reextraction_box_size))
+                    reextraction_map_file.write(format_table_map(dict(zip(table['tag'], star['rlnImageName']))))
+        finally:
+            if reextraction_box_size is not None:
+                reextraction_writer.close()
+                reextraction_map_file.close()
+
+    if next_tag == 1:
+        raise ValueError(f'no particles converted from {star_file}, expected a loop with {columns}')
+    table_map_write(table_map, table_file.replace('.tbl', '.doc'))
+    return table_map
+
+
+def tomogram_names(tomo_indices, table_map, basename=True):
+    """
+    looks up the tomogram of each particle in a table map
+    :param tomo_indices: (N,) numpy array of tomogram indices
+    :param table_map: dict { tomo_idx : '/path/to/tomogram' }
+    :param basename: if True, only the basename of each path is returned
+    :return: (N,) numpy array of tomogram names
+    """
+    map_indices = np.array(sorted(table_map), dtype=float)
+    paths = [table_map[idx] for idx in sorted(table_map)]
+    if basename:
+        paths = [os.path.basename(path) for path in paths]
+    paths = np.array(paths, dtype=str)
+
+    # each unique tomogram index is looked up once
+    unique_indices, inverse = np.unique(tomo_indices, return_inverse=True)
+    positions = np.minimum(np.searchsorted(map_indices, unique_indices), len(map_indices) - 1)
+    missing = np.ones(len(unique_indices), dtype=bool)
+    if len(map_indices) > 0:
+        missing = map_indices[positions] != unique_indices
+    if np.any(missing):
+        raise KeyError(f'tomogram indices {unique_indices[missing].tolist()} are not in the table map')
+
+    return paths[positions][inverse]
+
+
+def reextraction_table(table, box_size):
+    """
+    modifies a table for reextraction of a dynamo data folder from already extracted particles
+    particles are centred in their box and the tomogram index of each particle is its tag
+    :param table: DynamoTable
+    :param box_size: box size of the extracted particles in pixels
+    :return: DynamoTable
+    """
+    reextraction = DynamoTable()
+    for key in table:
+        reextraction[key] = table[key]
+
+    reextract_centre = box_size / 2
+    for axis in ('x', 'y', 'z'):
+        reextraction[axis] = np.full(table.number_of_particles(), reextract_centre)
+
+    reextraction['tomo'] = table['tag']
+    return reextraction
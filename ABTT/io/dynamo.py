@@ -1,6 +1,29 @@
 import logging
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import shared_memory
 
 import numpy as np
+from scipy.spatial.distance import pdist, squareform
+
+from ..math import neighbours
+from ..math.orientations import Orientations
+
+# approximate number of bytes of text parsed at a time when reading a subset of the columns of a table
+_READ_CHUNK_SIZE = 2 ** 26
+
+# number of rows formatted at a time when writing a table
+_ROWS_PER_CHUNK = 65536
+
+# buffer size in bytes for writing table files
+_WRITE_BUFFER_SIZE = 2 ** 22
+
+# minimum number of columns in a written table, columns missing from a DynamoTable are written as zeros
+_TABLE_WIDTH = 41
+
+# np.loadtxt is implemented in C from numpy 1.23, earlier versions parse every line in python
+_LOADTXT_IN_C = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
 
 
 class TableConvention(dict):
@@ -69,73 +92,170 @@ class TableConvention(dict):
 class DynamoTable(dict):
     """
     A dictionary with some methods for reading and writing of dynamo table files
+    Tables read from a file, or packed with compact, are backed by one contiguous (N, ncols) array and their
+    columns are views into it. Subtables of slices of such tables are views too, see subtable.
+    'eulers' and 'xyz' are derived from the table when accessed, see get_eulers and get_xyz
     """
 
-    def __init__(self, table_file=None):
+    def __init__(self, table_file=None, float_dtype=np.float64, columns=None):
         self.convention = TableConvention()
+        # (N, ncols) array backing the table and { key : column index into data }
+        self.data = None
+        self.layout = {}
 
         if table_file is not None:
-            self.from_file(table_file)
-
-    def from_file(self, table_file):
+            self.from_file(table_file, float_dtype=float_dtype, columns=columns)
+
+    def __missing__(self, key):
+        if key == 'eulers':
+            return self.get_eulers()
+        elif key == 'xyz':
+            return self.get_xyz()
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        # derived keys are not stored in the table, dict.get would not see them
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def from_file(self, table_file, float_dtype=np.float64, columns=None):
+        """
+        reads a table file into one contiguous (N, ncols) array, see read_table_data, each column is a view into it
+        :param table_file: dynamo table file
+        :param float_dtype: dtype of the table, np.float32 halves its memory footprint
+        :param columns: keys of the columns to read, e.g. ['tag', 'x', 'y', 'z', 'tomo'], None for all
+        """
         logging.debug(f'reading table file: {table_file}')
-        # try:
-        data = np.loadtxt(table_file)
-        # except:
-        #     logging.debug(f'failed to read table, attempting to read as complex numbers...')
-        #     data_complex = np.genfromtxt(table_file, dtype=np.complex128)
-        #     data = data_complex.view(float)
-
-        for key, column_idx in self.convention.items():
-            try:
-                logging.debug(f'loaded data for {key} into DynamoTable')
-                zero_indexed_index = column_idx - 1
-                self[key] = data[:, zero_indexed_index]
-            except:
-                logging.debug(f'failed to access data for {key}')
-
-        self['eulers'] = self.get_eulers()
-        self['xyz'] = self.get_xyz()
+        column_indices, layout = self.file_layout(table_width(table_file), columns)
+        data = read_table_data(table_file, float_dtype, column_indices)
 
-    def write(self, file):
-        logging.info(f'writing table file from DynamoTable object: {file}')
-        # Check all dict items have same length, if so set empty array
-        if all([array.shape[0] for array in self.values()]):
-            array = self[list(self.keys())[0]]
-            data = np.zeros((array.shape[0], 41))
+        logging.debug(f'loaded data for {list(layout)} into DynamoTable')
+        self.set_data(data, layout)
 
-        else:
-            logging.warning('not all elements in dictionary have the same length')
+    def file_layout(self, n_columns, columns=None):
+        """
+        works out which columns of a table file to read and where they are stored
+        :param n_columns: number of columns in the table file
+        :param columns: keys of the columns to read, None for all
+        :return: column_indices, layout: zero based indices of the columns to read from the file (None for all) and
+                 dict { key : column index into the array read }
+        """
+        requested = list(self.convention.keys()) if columns is None else columns
+        keys = [key for key in requested if self.convention[key] <= n_columns]
+        for key in requested:
+            if key not in keys:
+                logging.debug(f'failed to access data for {key}, table only has {n_columns} columns')
 
-        for key, value in self.items():
-            column_idx_zero_index = self.convention[key] - 1
-            data[:, column_idx_zero_index] = value
+        if columns is None:
+            return None, {key: self.convention[key] - 1 for key in keys}
+        return [self.convention[key] - 1 for key in keys], {key: idx for idx, key in enumerate(keys)}
 
-        # Specify format
-        format = ['%.4f' for _ in range(41)]
-        for i in range(1):
-            format[i] = '%d'
+    def set_data(self, data, layout):
+        """
+        backs the table with an (N, ncols) array, each column in layout becomes a view into it
+        :param data: (N, ncols) numpy array
+        :param layout: dict { key : column index into data }
+        """
+        self.data = data
+        self.layout = dict(layout)
+        for key, column_idx in self.layout.items():
+            self[key] = self.data[:, column_idx]
 
-        # save file
-        np.savetxt(file, data, delimiter=' \t', fmt=format)
+    def compact(self, float_dtype=np.float64):
+        """
+        packs the columns of the table into one contiguous (N, ncols) array in table convention order, each column
+        is replaced by a view into it
+        :param float_dtype: dtype of the array
+        :return: self
+        """
+        keys = sorted([key for key in self if key in self.convention], key=self.convention.get)
+        nrows = len(self[keys[0]]) if keys else 0
+        logging.debug(f'packing {len(keys)} columns of DynamoTable into a ({nrows}, {len(keys)}) array')
+
+        self.data = np.empty((nrows, len(keys)), dtype=float_dtype)
+        self.layout = {}
+        for column_idx, key in enumerate(keys):
+            self.data[:, column_idx] = self[key]
+            self.layout[key] = column_idx
+            self[key] = self.data[:, column_idx]
+
+        return self
+
+    def backed_keys(self):
+        """
+        keys of the columns which are views of the array backing the table
+        columns which were replaced rather than modified in place no longer belong to it
+        :return: list of keys
+        """
+        if self.data is None:
+            return []
+
+        return [key for key, column_idx in self.layout.items()
+                if key in self and _same_view(self[key], self.data[:, column_idx])]
+
+    def write(self, file):
+        """
+        writes the table in chunks of rows, one format operation per row
+        columns which are not in the table are written as zeros without being allocated, keys outside of the table
+        convention such as 'eulers' and 'xyz' are not written
+        :param file: output table file
+        :return: file
+        """
+        logging.info(f'writing table file from DynamoTable object: {file}')
+        with TableWriter(file) as writer:
+            writer.write(self)
         return file
 
     def get_eulers(self):
         """
         extracts euler angles from table as (N,3) numpy array
-        :return: (N,3) numpy array of euler angles
+        :return: (N,3) numpy array of euler angles, a view of the table data if it was read from a file
         """
-        return np.vstack((self['tdrot'], self['tilt'], self['narot'])).transpose()
+        eulers = self.data_view(('tdrot', 'tilt', 'narot'))
+        if eulers is None:
+            eulers = np.column_stack((self['tdrot'], self['tilt'], self['narot']))
+        return eulers
+
+    def get_orientations(self, dtype=np.float64):
+        """
+        orientations of the particles in the table as unit quaternions, see ABTT.math.orientations
+        :param dtype: np.float32 or np.float64
+        :return: Orientations
+        """
+        return Orientations.from_euler_angles(self['eulers'], 'dynamo', dtype=dtype)
 
     def get_xyz(self):
         """
         extracts xyz coordinates from table as (N,3) numpy array
+        shifts which are not in the table are taken as zero, as they are written by write
         :return: (N,3) numpy array of xyz positions
         """
-        x = self['x'] + self['dx']
-        y = self['y'] + self['dy']
-        z = self['z'] + self['dz']
-        return np.vstack((x, y, z)).transpose()
+        xyz = self.data_view(('x', 'y', 'z'))
+        shifts = self.data_view(('dx', 'dy', 'dz'))
+        if xyz is None or shifts is None:
+            xyz = np.column_stack((self['x'], self['y'], self['z']))
+            if not any(key in self for key in ('dx', 'dy', 'dz')):
+                return xyz.astype(float)
+            shifts = np.column_stack([self[key] if key in self else np.zeros(len(xyz)) for key in ('dx', 'dy', 'dz')])
+        return xyz + shifts
+
+    def data_view(self, keys):
+        """
+        (N, len(keys)) view of adjacent columns of the array backing the table
+        :param keys: keys of columns which are adjacent and in order in the table file
+        :return: numpy array or None if the columns are not all adjacent views of the table data
+        """
+        backed_keys = self.backed_keys()
+        if any(key not in backed_keys for key in keys):
+            return None
+
+        start = self.layout[keys[0]]
+        if any(self.layout[key] != start + offset for offset, key in enumerate(keys)):
+            return None
+
+        return self.data[:, start:start + len(keys)]
 
     def averaged(self):
         """
@@ -146,18 +266,43 @@ class DynamoTable(dict):
         subtable = self.subtable(idx)
         return subtable
 
-    def subtable(self, selection_indices):
+    def subtable(self, selection_indices, view=False):
         """
         extracts selected indices into a subtable and returns that
-        :param selection_indices:
+        as for numpy arrays, slices give a subtable of views of this table and other selections give a copy, the
+        array backing the table is then copied once rather than column by column
+        :param selection_indices: slice, integer index, integer indices or boolean mask
+        :param view: if True, integer indices or boolean masks selecting a contiguous range of rows also give a
+                     subtable of views, without copying. Changes to the subtable then change this table
         :return: subtable
         """
+        if view:
+            selection_indices = _as_slice(selection_indices)
         subtable = DynamoTable()
+        backed_keys = self.backed_keys()
+        # a single row gives a subtable of scalars, as when selecting from each column
+        if len(backed_keys) > 0 and (isinstance(selection_indices, slice) or np.ndim(selection_indices) > 0):
+            subtable.data = self.data[selection_indices]
+            subtable.layout = {key: self.layout[key] for key in backed_keys}
+
         for key in self:
-            subtable[key] = self[key][selection_indices]
+            if key in subtable.layout:
+                subtable[key] = subtable.data[:, subtable.layout[key]]
+            else:
+                subtable[key] = self[key][selection_indices]
 
         return subtable
 
+    def sort(self, key='tomo'):
+        """
+        sorts the rows of the table by a column, keeping the original order of rows with equal values
+        groups of rows of the sorted table can then be extracted as views, see table_per_tomogram
+        :param key: key of the column to sort by
+        :return: sorted subtable
+        """
+        order = np.argsort(self[key], kind='stable')
+        return self.subtable(order)
+
     def number_of_particles(self):
         """
         calculates number of particles in table
@@ -173,11 +318,8 @@ class DynamoTable(dict):
         :type self: dynamo_table
         :return: class_particles: { class_index : n_particles }
         """
-        class_indices = np.unique(self['ref'])
-        class_particles = StarDict
-
-        for idx in class_indices:
-            class_particles[idx] = np.sum(self['ref'] == idx)
+        groups = self.groupby('ref')
+        class_particles = dict(zip(groups.keys, groups.count()))
 
         return class_particles
 
@@ -206,39 +348,76 @@ class DynamoTable(dict):
         :return: particles_per_class { class_idx : n_particles }, percentage_per_class { class_idx : n_particles }
         """
         total_particles = self.number_of_particles()
-        unique_classes = self.unique_classes()
-
-        particles_per_class = {}
-        percentage_per_class = {}
+        groups = self.groupby('ref')
+        counts = groups.count()
 
-        for class_idx in unique_classes:
-            particles_per_class[class_idx] = np.sum(self['ref'] == class_idx)
-            percentage_per_class[class_idx] = 100 * (particles_per_class[class_idx] / total_particles)
+        particles_per_class = dict(zip(groups.keys, counts))
+        percentage_per_class = dict(zip(groups.keys, 100 * (counts / total_particles)))
 
         return particles_per_class, percentage_per_class
 
     def table_per_tomogram(self):
         """
         separates a table into dictionary of tables, one per tomogram, accessed by the tomogram index from the original table
+        tables are views of one sorted copy of the table, see DynamoTableGroups.tables
         :param self: DynamoTable object
         :type self: DynamoTable
         :return: dict of DynamoTable objects { tomo_idx : DynamoTable }
         """
-        tomo_indices = np.unique(self['tomo'])
-        dict_of_dynamo_tables = {}
-
-        for tomo_idx in tomo_indices:
-            row_idx_for_current_tomogram = self['tomo'] == tomo_idx
-            table_for_current_tomogram = DynamoTable()
-            for key in self:
-                table_for_current_tomogram[key] = self[key][row_idx_for_current_tomogram]
-            dict_of_dynamo_tables[tomo_idx] = table_for_current_tomogram
+        dict_of_dynamo_tables = self.groupby('tomo').tables()
 
         return dict_of_dynamo_tables
 
+    def map_tomograms(self, func, workers=None, per_row=True):
+        """
+        applies a function to the table of each tomogram, in parallel processes
+        the table is copied once into shared memory, sorted by tomogram, and each process attaches to it and views
+        the rows of its tomogram rather than receiving a pickled copy. Results are collected in tomogram order so
+        that the output does not depend on the number of processes
+        :param func: function taking a DynamoTable, must be importable by the processes (defined at module level).
+                     Its table has every column of this table, which must all be numeric with one value per row
+        :param workers: number of processes, defaults to the number of cpus, 1 runs func in this process
+        :param per_row: if True, func returns an array with one element per row of its table and the results are
+                        reassembled into one array in the original row order of the table
+        :return: numpy array if per_row, else dict { tomo_idx : result }
+        """
+        # columns which cannot be shared are rejected whatever the number of workers, so that func sees the same
+        # columns in either case
+        _shared_keys(self)
+        groups = self.groupby('tomo')
+        logging.info(f'mapping {getattr(func, "__name__", func)} over {len(groups)} tomograms')
+
+        if len(groups) == 0:
+            return np.array([]) if per_row else {}
+
+        if workers == 1:
+            results = [func(table) for table in groups.tables().values()]
+        else:
+            results = _map_shared_groups(self, groups, func, workers)
+
+        if not per_row:
+            return dict(zip(groups.keys, results))
+
+        sorted_results = np.concatenate([np.asarray(result) for result in results])
+        if len(sorted_results) != self.number_of_particles():
+            raise ValueError(f'{getattr(func, "__name__", func)} did not return one result per row')
+
+        per_row_results = np.empty_like(sorted_results)
+        per_row_results[groups.order] = sorted_results
+        return per_row_results
+
+    def groupby(self, key):
+        """
+        groups the rows of the table by the values of a column, see DynamoTableGroups
+        :param key: key of the column to group by, e.g. 'tomo' or 'ref'
+        :return: DynamoTableGroups
+        """
+        return DynamoTableGroups(self, key)
+
     def pairwise_distances(self):
         """
         returns a squareform pairwise distance matrix for the xyz positions in a DynamoTable object
+        memory scales with the square of the number of particles, see neighbour_list for large tables
         :param self: DynamoTable object
         :type DynamoTable: DynamoTable
         :return: pairwise_distance_matrix
@@ -248,30 +427,68 @@ class DynamoTable(dict):
 
         return pairwise_distance_matrix
 
+    def tomogram_rows(self):
+        """
+        row indices of the particles in each tomogram, found with a single stable sort
+        :return: dict { tomo_idx : row indices }
+        """
+        return self.groupby('tomo').rows()
+
+    def neighbour_list(self, max_distance, min_distance=0, workers=1):
+        """
+        finds all pairs of particles in the same tomogram with min_distance <= distance < max_distance
+        pairs are found with a kd-tree per tomogram, memory scales with the number of pairs rather than the square of
+        the number of particles
+        :param max_distance: maximum distance below which particles are considered neighbours
+        :param min_distance: minimum distance above which particles are considered neighbours
+        :param workers: number of processes between which tomograms are shared, None for the number of cpus
+        :return: pairs, distances: (M, 2) numpy array of row indices i < j of neighbouring particles and (M,) numpy
+                 array of their distances
+        """
+        return neighbours.neighbour_pairs(self['xyz'], self['tomo'], max_distance, min_distance, workers=workers)
+
+    def remove_duplicates(self, min_distance, keep='cc'):
+        """
+        removes duplicate particles, particles closer than min_distance to another particle in the same tomogram
+        particles are kept from the best score down unless they are a duplicate of a particle already kept, see
+        neighbours.suppress_neighbours
+        :param min_distance: distance below which particles are considered duplicates
+        :param keep: key of the column whose highest values are kept first, None to keep particles in order
+        :return: subtable of the kept particles, in their original order
+        """
+        pairs, distances = self.neighbour_list(min_distance)
+        scores = None if keep is None else self[keep]
+        kept = neighbours.suppress_neighbours(pairs, self.number_of_particles(), scores)
+        logging.info(f'removing {np.sum(~kept)} duplicate particles closer than {min_distance} from DynamoTable')
+
+        return self.subtable(kept)
+
     def neighbours_in_range(self, min_distance, max_distance):
         """
         computes the number of neighbours within a minimum and maximum distance per particle for a DynamoTable object
+        only particles in the same tomogram are neighbours and a particle is not its own neighbour, see neighbour_list
         :param self: DynamoTable object
         :type self: DynamoTable
         :param min_distance: minimum distance above which particles are considered neighbours
         :param max_distance: maximum distance below which particles are considered neighbours
         :return: neighbours_in_range_per_particle : m-element numpy array if xyz in dynamo table is mx3
         """
-        pairwise_distance_matrix = self.pairwise_distances()
-        items_in_range = min_distance <= pairwise_distance_matrix < max_distance
-        neighbours_in_range_per_particle = np.sum(items_in_range, 0)
+        pairs, distances = self.neighbour_list(max_distance, min_distance)
+        neighbours_in_range_per_particle = np.bincount(pairs.ravel(), minlength=self.number_of_particles())
 
         return neighbours_in_range_per_particle
 
-    def neighbourhood_analysis(self, min_distance, max_distance, number_of_bins):
+    def neighbourhood_analysis(self, min_distance, max_distance, number_of_bins, workers=1):
         """
         computes a per-particle neighbourhood analysis for a DynamoTable object
         neighbourhood analysis will be performed in equally sized, non-overlapping bins between the minimum and maximum distance
+        pairs of neighbours are found once, see neighbour_list, then counted per particle and bin in a single pass
         :param self: DynamoTable object
         :type self: DynamoTable
         :param min_distance: minimum distance above which particles are considered neighbours
         :param max_distance: maximum distance below which particles are considered neighbours
         :param number_of_bins: number of equally spaced bins in which to measure number of neighbouring particles
+        :param workers: number of processes between which tomograms are shared, None for the number of cpus
         :return: neighbourhood_analysis_result, bin_centres, bin_minmax
         """
 
@@ -282,25 +499,418 @@ class DynamoTable(dict):
 
         bin_minmax = np.vstack((minimum_values, maximum_values)).transpose()
 
-        pairwise_distance_matrix = self.pairwise_distances()
-        n_rows = pairwise_distance_matrix.shape[0]
-        neighbourhood_analysis_result = np.zeros((n_rows, number_of_bins))
+        bin_edges = np.append(minimum_values, maximum_values[-1])
+        pairs, distances = self.neighbour_list(bin_edges[-1], bin_edges[0], workers=workers)
+        bin_indices = np.clip(np.searchsorted(bin_edges, distances, side='right') - 1, 0, number_of_bins - 1)
 
-        for idx, bin in enumerate(bin_minmax):
-            bin_minimum = bin[0]
-            bin_maximum = bin[1]
-            items_in_range = bin_minimum <= pairwise_distance_matrix < bin_maximum
-            neighbours_in_range_per_particle = np.sum(items_in_range, 0)
-            neighbourhood_analysis_result[:, idx] = neighbours_in_range_per_particle
+        # each pair is a neighbour of both of its particles
+        n_rows = self.number_of_particles()
+        flat_indices = pairs * number_of_bins + bin_indices[:, np.newaxis]
+        counts = np.bincount(flat_indices.ravel(), minlength=n_rows * number_of_bins)
+        neighbourhood_analysis_result = counts.reshape((n_rows, number_of_bins))
 
         return neighbourhood_analysis_result, bin_centres, bin_minmax
 
 
-def table_read(table_file):
-    dynamo_table = DynamoTable(table_file)
+class DynamoTableGroups:
+    """
+    Groups of the rows of a DynamoTable by the values of one column, found with a single stable sort
+    rows of a group are contiguous in the sorted table so groups are extracted as views and aggregations are
+    computed for every group at once
+    """
+
+    def __init__(self, table, key):
+        self.table = table
+        self.key = key
+
+        values = np.asarray(table[key])
+        nrows = len(values)
+        self.sorted = bool(np.all(values[1:] >= values[:-1]))
+        self.order = np.arange(nrows) if self.sorted else np.argsort(values, kind='stable')
+        sorted_values = values[self.order]
+
+        # first row of each group in the sorted table
+        self.starts = np.flatnonzero(np.concatenate(([nrows > 0], sorted_values[1:] != sorted_values[:-1])))
+        self.keys = sorted_values[self.starts]
+        self.counts = np.diff(np.append(self.starts, nrows))
+
+        # group index of each row of the table
+        self.inverse = np.empty(nrows, dtype=np.int64)
+        self.inverse[self.order] = np.repeat(np.arange(len(self.keys)), self.counts)
+
+        self._sorted_table = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def sorted_table(self):
+        """
+        the table sorted by the grouping column, the table itself if it is already sorted
+        :return: DynamoTable
+        """
+        if self._sorted_table is None:
+            self._sorted_table = self.table if self.sorted else self.table.subtable(self.order)
+        return self._sorted_table
+
+    def rows(self):
+        """
+        row indices of each group in the original table
+        :return: dict { value : row indices }
+        """
+        return dict(zip(self.keys, np.split(self.order, self.starts[1:])))
+
+    def tables(self, view=False):
+        """
+        subtables of each group, views of the sorted table
+        :param view: if True and the table is already sorted, subtables are views of the table itself and changes to
+                     them change the table. Otherwise they are views of a sorted copy
+        :return: dict { value : DynamoTable }
+        """
+        table = self.sorted_table()
+        if table is self.table and not view:
+            table = table.subtable(self.order)
+        stops = self.starts + self.counts
+        return {value: table.subtable(slice(start, stop)) for value, start, stop in zip(self.keys, self.starts, stops)}
+
+    def count(self):
+        """
+        :return: number of rows in each group
+        """
+        return self.counts
+
+    def sum(self, key):
+        """
+        :param key: key of a column
+        :return: sum of the column over each group
+        """
+        return np.bincount(self.inverse, weights=self.table[key], minlength=len(self))
+
+    def mean(self, key):
+        """
+        :param key: key of a column
+        :return: mean of the column over each group
+        """
+        return self.sum(key) / self.counts
+
+    def min(self, key):
+        """
+        :param key: key of a column
+        :return: minimum of the column over each group
+        """
+        return self._reduce(np.minimum, key)
+
+    def max(self, key):
+        """
+        :param key: key of a column
+        :return: maximum of the column over each group
+        """
+        return self._reduce(np.maximum, key)
+
+    def _reduce(self, ufunc, key):
+        column = np.asarray(self.table[key])
+        if len(self) == 0:
+            return column[:0]
+        return ufunc.reduceat(column[self.order], self.starts)
+
+
+def _map_shared_groups(table, groups, func, workers=None):
+    """
+    copies the columns of a table into shared memory in group order and applies func to each group in a process pool
+    columns are copied into one block of shared memory per dtype so that func sees the dtypes of the table
+    """
+    keys = _shared_keys(table)
+    dtype_keys = {}
+    for key in keys:
+        dtype_keys.setdefault(np.asarray(table[key]).dtype.str, []).append(key)
+    nrows = table.number_of_particles()
+
+    # (name, shape, dtype, layout) of each block of shared memory
+    blocks = []
+    memories = []
+    try:
+        for dtype, block_keys in dtype_keys.items():
+            shape = (nrows, len(block_keys))
+            size = max(nrows * len(block_keys) * np.dtype(dtype).itemsize, 1)
+            memory = shared_memory.SharedMemory(create=True, size=size)
+            memories.append(memory)
+            layout = {key: column_idx for column_idx, key in enumerate(block_keys)}
+
+            data = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+            for key, column_idx in layout.items():
+                data[:, column_idx] = np.asarray(table[key])[groups.order]
+            del data
+            blocks.append((memory.name, shape, dtype, layout))
+
+        stops = groups.starts + groups.counts
+        n_groups = len(groups)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(map(pickle.loads, executor.map(_map_shared_rows,
+                                                          [func] * n_groups,
+                                                          [blocks] * n_groups,
+                                                          [list(table)] * n_groups,
+                                                          groups.starts,
+                                                          stops)))
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+
+    return results
+
+
+def _shared_keys(table):
+    """
+    keys of the columns of a table which are copied into shared memory, table convention columns in convention order
+    followed by any other columns
+    :raises ValueError: for columns which are not numeric with one value per row
+    """
+    nrows = table.number_of_particles()
+    for key in table:
+        column = np.asarray(table[key])
+        if column.dtype.kind not in 'biuf' or column.shape != (nrows,):
+            raise ValueError(f'column {key} cannot be shared between processes, columns must be numeric with one '
+                             f'value per row')
+
+    convention_keys = sorted([key for key in table if key in table.convention], key=table.convention.get)
+    return convention_keys + [key for key in table if key not in table.convention]
+
+
+def _map_shared_rows(func, blocks, keys, start, stop):
+    """
+    applies func to a table viewing rows start:stop of the blocks of a table in shared memory, see _map_shared_groups
+    the table is backed by the first block, columns of other blocks are views of their own block
+    :return: the result of func, pickled
+    """
+    memories = [shared_memory.SharedMemory(name=name) for name, shape, dtype, layout in blocks]
+    try:
+        table = DynamoTable()
+        columns = {}
+        for memory, (name, shape, dtype, layout) in zip(memories, blocks):
+            data = np.ndarray(shape, dtype=dtype, buffer=memory.buf)[start:stop]
+            if table.data is None:
+                table.data = data
+                table.layout = dict(layout)
+            columns.update({key: data[:, column_idx] for key, column_idx in layout.items()})
+        # columns are added in the order of the original table
+        for key in keys:
+            table[key] = columns[key]
+        del data, columns
+
+        # results are pickled before the shared memory is closed, so that none of them, e.g. a subtable or a tuple
+        # of columns, still refers to it. The bytes are returned to be unpickled once in the calling process
+        result = pickle.dumps(func(table), protocol=pickle.HIGHEST_PROTOCOL)
+        del table
+    finally:
+        for memory in memories:
+            memory.close()
+
+    return result
+
+
+def table_read(table_file, float_dtype=np.float64, columns=None):
+    dynamo_table = DynamoTable(table_file, float_dtype=float_dtype, columns=columns)
     return dynamo_table
 
 
+class TableWriter:
+    """
+    Writes dynamo tables to a table file one after the other, e.g. chunk by chunk for tables which do not fit in memory
+
+    with TableWriter('particles.tbl') as writer:
+        for table in iter_table_chunks('large.tbl'):
+            writer.write(table.subtable(table['cc'] > 0.2))
+    """
+
+    def __init__(self, file):
+        self.file = open(file, 'w', buffering=_WRITE_BUFFER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, table):
+        """
+        appends the rows of a table in chunks of rows, one format operation per row
+        columns which are not in the table are written as zeros without being allocated, keys outside of the table
+        convention such as 'eulers' and 'xyz' are not written
+        :param table: DynamoTable
+        """
+        keys = [key for key in table if key in table.convention]
+        if len(set(len(table[key]) for key in keys)) > 1:
+            raise ValueError('not all columns of the table have the same length')
+
+        n_columns = max([_TABLE_WIDTH] + [table.convention[key] for key in keys])
+        columns = [None for _ in range(n_columns)]
+        for key in keys:
+            columns[table.convention[key] - 1] = table[key]
+        formats = ['%d'] + ['%.4f' for _ in range(n_columns - 1)]
+
+        present = [column for column in columns if column is not None]
+        nrows = len(present[0]) if present else 0
+        for start in range(0, nrows, _ROWS_PER_CHUNK):
+            stop = start + _ROWS_PER_CHUNK
+            self.file.write(format_table_rows(formats, [column if column is None else column[start:stop]
+                                                        for column in columns]))
+
+    def close(self):
+        self.file.close()
+
+
+def format_table_rows(formats, columns):
+    """
+    formats columns into the lines of a table file, one format operation per row rather than per element
+    constant columns, which are common in dynamo tables, are formatted once and written as part of the row format
+    :param formats: list of format strings, one for each column
+    :param columns: list of columns of equal length, None for columns of zeros
+    :return: str
+    """
+    row_formats = []
+    values = []
+    for format, column in zip(formats, columns):
+        if column is None:
+            row_formats.append(format % 0)
+            continue
+
+        column = np.asarray(column)
+        if len(column) > 0 and np.all(column == column[0]):
+            row_formats.append(format % column[0])
+        else:
+            row_formats.append(format)
+            values.append(column.tolist())
+
+    row_format = ' \t'.join(row_formats) + '\n'
+    if len(values) == 0:
+        nrows = max([len(column) for column in columns if column is not None], default=0)
+        return row_format * nrows
+    return ''.join([row_format % row for row in zip(*values)])
+
+
+def table_width(table_file):
+    """
+    number of columns in a table file, taken from its first line
+    :param table_file: dynamo table file
+    :return: n_columns
+    """
+    with open(table_file, 'r') as file:
+        first_line = file.readline()
+    return len(first_line.split())
+
+
+def iter_table_chunks(table_file, chunksize=1000000, float_dtype=np.float64, columns=None):
+    """
+    iterates over the rows of a table file in chunks, so that tables of any size can be processed in bounded memory.
+    Use with TableWriter to write results back out chunk by chunk
+    :param table_file: dynamo table file
+    :param chunksize: maximum number of rows per chunk
+    :param float_dtype: dtype of the table
+    :param columns: keys of the columns to read, None for all
+    :return: generator of DynamoTable, each backed by its own array
+    """
+    n_columns = table_width(table_file)
+    if n_columns == 0:
+        return
+
+    column_indices, layout = DynamoTable().file_layout(n_columns, columns)
+    with open(table_file, 'r') as file:
+        while True:
+            lines = list(islice(file, chunksize))
+            if len(lines) == 0:
+                break
+
+            table = DynamoTable()
+            table.set_data(_parse_table_lines(lines, n_columns, float_dtype, column_indices, table_file), layout)
+            yield table
+
+
+def read_table_data(table_file, float_dtype=np.float64, column_indices=None):
+    """
+    parses a whitespace delimited numeric table into one contiguous (N, ncols) array
+    from numpy 1.23 this is np.loadtxt, whose C parser is as fast as any numpy or pandas reader of text tables, so
+    full reads take as long as np.loadtxt. The gains are in memory, a float32 array and only the requested columns
+    are stored. Earlier numpy versions parse lines in python in np.loadtxt, np.fromfile is used there instead and
+    with a subset of columns the file is parsed in chunks
+    :param table_file: table file, every row must have the same number of columns
+    :param float_dtype: dtype of the array
+    :param column_indices: zero based indices of the columns to keep, None for all
+    :return: (N, ncols) numpy array
+    """
+    n_columns = table_width(table_file)
+    if n_columns == 0:
+        return np.zeros((0, 0 if column_indices is None else len(column_indices)), dtype=float_dtype)
+
+    if _LOADTXT_IN_C:
+        return np.loadtxt(table_file, dtype=float_dtype, usecols=column_indices, ndmin=2)
+
+    if column_indices is None:
+        values = np.fromfile(table_file, dtype=float_dtype, sep=' ')
+        return _table_rows(values, n_columns, table_file)
+
+    chunks = []
+    with open(table_file, 'r') as file:
+        while True:
+            lines = file.readlines(_READ_CHUNK_SIZE)
+            if len(lines) == 0:
+                break
+            chunks.append(_parse_table_lines(lines, n_columns, float_dtype, column_indices, table_file))
+
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
+
+
+def _parse_table_lines(lines, n_columns, float_dtype=np.float64, column_indices=None, table_file=None):
+    """
+    parses the lines of a table into a contiguous (N, ncols) array, keeping only the columns in column_indices
+    """
+    if _LOADTXT_IN_C:
+        return np.loadtxt(lines, dtype=float_dtype, usecols=column_indices, ndmin=2)
+
+    values = np.fromstring(''.join(lines), dtype=float_dtype, sep=' ')
+    data = _table_rows(values, n_columns, table_file)
+    if column_indices is None:
+        return data
+    return np.ascontiguousarray(data[:, column_indices])
+
+
+def _same_view(array, view):
+    """
+    checks whether an array is the given view, i.e. has the same memory, shape, strides and dtype
+    """
+    return isinstance(array, np.ndarray) and array.__array_interface__ == view.__array_interface__
+
+
+def _as_slice(selection_indices):
+    """
+    converts integer indices or a boolean mask selecting a contiguous range of rows into an equivalent slice
+    other selections are returned unchanged
+    """
+    if isinstance(selection_indices, slice):
+        return selection_indices
+
+    selection = np.asarray(selection_indices)
+    if selection.ndim != 1:
+        return selection_indices
+    if selection.dtype == bool:
+        selection = np.flatnonzero(selection)
+    elif selection.dtype.kind not in 'iu' or np.any(selection < 0):
+        return selection_indices
+
+    if len(selection) > 0 and selection[-1] - selection[0] == len(selection) - 1 and np.all(np.diff(selection) == 1):
+        return slice(selection[0], selection[-1] + 1)
+    return selection_indices
+
+
+def _table_rows(values, n_columns, table_file):
+    """
+    reshapes the flat values of a table into rows, checking that no value was missed
+    """
+    if values.size % n_columns != 0:
+        raise ValueError(f'could not parse {table_file} as a table of {n_columns} numeric columns')
+    return values.reshape((-1, n_columns))
+
+
 def table_map_read(file):
     """
     Reads dynamo table map file
@@ -316,3 +926,26 @@ def table_map_read(file):
         out_dict[int(idx)] = path
 
     return out_dict
+
+
+def table_map_write(table_map, file):
+    """
+    Writes dynamo table map file in a single write
+    :param table_map: dict of form {idx : '/path/to/tomogram'}
+    :param file: output table map file
+    :return: file
+    """
+    logging.info(f'writing table map file: {file}')
+    with open(file, 'w', buffering=_WRITE_BUFFER_SIZE) as table_map_file:
+        table_map_file.write(format_table_map(table_map))
+
+    return file
+
+
+def format_table_map(table_map):
+    """
+    formats a table map into the lines of a table map file
+    :param table_map: dict of form {idx : '/path/to/tomogram'}
+    :return: str
+    """
+    return ''.join([f'{idx}\t{path}\n' for idx, path in table_map.items()])
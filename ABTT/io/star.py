@@ -1,65 +1,241 @@
+import io
 import logging
+import operator
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
+from operator import itemgetter
 
 import numpy as np
 
+from . import cache
+from ..math import neighbours
+from ..math.orientations import Orientations
+
+# number of rows transposed into columns at a time when scanning or writing a star file
+_ROWS_PER_CHUNK = 65536
+
+# buffer size in bytes for writing star files
+_WRITE_BUFFER_SIZE = 2 ** 22
+
+# number of bytes read at a time when indexing the data blocks of a star file
+_INDEX_CHUNK_SIZE = 2 ** 24
+
+# start of a data block, at the start of a line
+_DATA_BLOCK = re.compile(rb'^[ \t]*(data_\S*)', re.MULTILINE)
+
+# block holding the particles of RELION 3.1 star files, which also have a data_optics block with a loop
+_PARTICLES_BLOCK = 'data_particles'
+
+# block indices of star files already indexed { path : ((size, mtime_ns), {block_name : offset}) }
+_block_indices = {}
+
+# offsets of single blocks found without indexing the rest of a star file { (path, block_name) : (fingerprint, offset) }
+_block_offsets = {}
+
+# operators allowed in the (heading, operator, value) conditions of a where clause
+_WHERE_OPERATORS = {'==': operator.eq,
+                    '!=': operator.ne,
+                    '<': operator.lt,
+                    '<=': operator.le,
+                    '>': operator.gt,
+                    '>=': operator.ge,
+                    'in': lambda column, values: np.isin(column, list(values)),
+                    'not in': lambda column, values: ~np.isin(column, list(values))}
+
 
 class StarDict(dict):
     """
     a dictionary with some methods for reading and writing of star files
+    columns of lazy reads which have not been parsed yet are included by every dict method, they are parsed when
+    their values are accessed, e.g. by get, values, items, pop or ==. copy keeps them deferred and repr shows them
+    as <deferred> rather than parsing them
     """
 
-    def __init__(self, star_file=None, data_block=None):
+    def __init__(self, star_file=None, data_block=None, float_dtype=np.float64, columns=None, lazy=False, block=None):
+        """
+        :param star_file: star file to read
+        :param data_block: list of strings corresponding to a data block from a star file
+        :param float_dtype: dtype of non-integer numeric columns
+        :param columns: headings of the columns to read, None for all
+        :param lazy: if True, columns which are not in 'columns' are only parsed on first access
+        :param block: name of the data block to read, e.g. 'data_particles', None to read every block
+        """
+        self.star_file = None
+        self.float_dtype = float_dtype
+        self.deferred = {}
+
         if star_file is not None:
-            self.from_file(star_file)
+            self.from_file(star_file, float_dtype=float_dtype, columns=columns, lazy=lazy, block=block)
 
         elif data_block is not None:
             self.from_data_block(data_block)
 
+    def __missing__(self, key):
+        if key not in self.deferred:
+            raise KeyError(key)
 
-    def from_file(self, star_file):
-        logging.info(f'reading star file: {star_file}')
-        loop_info = data_loop_start_indices(star_file)
+        self.load(key)
+        return self[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.deferred
+
+    def __iter__(self):
+        return iter(self.headings())
 
-        if len(loop_info) == 1:
-            logging.info(f'single block star file...')
-            header = read_star_header(star_file)
-            column_headings = [info[1:info.find('#')].strip() for info in header if info.startswith('_')]
-            body = read_star_body(star_file)
-            for idx, heading in enumerate(column_headings):
-                self[heading] = np.asarray(body[idx])
+    def __len__(self):
+        return dict.__len__(self) + len(self.deferred)
 
+    def __setitem__(self, key, value):
+        # unpickling sets items before the attributes of the StarDict are restored
+        if key in self.__dict__.get('deferred', ()):
+            del self.deferred[key]
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key in self.deferred:
+            del self.deferred[key]
         else:
-            logging.info('multi block star file...')
-            data_blocks = get_data_blocks(star_file)
-            for data_block in data_blocks:
-                try:
-                    header, body = clean_data_block(data_block)
-                except:
-                    logging.warning('one or more data blocks in this star file are unsupported')
-                    continue
+            dict.__delitem__(self, key)
+
+    def __eq__(self, other):
+        if isinstance(other, StarDict):
+            other.load()
+        self.load()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
-                column_headings = [info[1:info.find('#')].strip() for info in header if info.startswith('_')]
-                for idx, heading in enumerate(column_headings):
-                    self[heading] = np.asarray(body[idx])
+    def __repr__(self):
+        items = [f'{heading!r}: {"<deferred>" if heading in self.deferred else repr(dict.__getitem__(self, heading))}'
+                 for heading in self.headings()]
+        return f'{{{", ".join(items)}}}'
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key in self.deferred:
+            self.load(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        if len(self.deferred) == 0:
+            return dict.popitem(self)
+        heading = list(self.deferred)[-1]
+        return heading, self.pop(heading)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.deferred.clear()
+        dict.clear(self)
+
+    def copy(self):
+        """
+        shallow copy, deferred columns stay deferred and are parsed from the same star file
+        :return: StarDict
+        """
+        star_dict = StarDict(float_dtype=self.float_dtype)
+        for heading in dict.keys(self):
+            dict.__setitem__(star_dict, heading, dict.__getitem__(self, heading))
+        star_dict.star_file = self.star_file
+        star_dict.deferred = dict(self.deferred)
+        return star_dict
+
+    def keys(self):
+        return self.headings()
+
+    def values(self):
+        return [self[heading] for heading in self.headings()]
+
+    def items(self):
+        return [(heading, self[heading]) for heading in self.headings()]
+
+    def from_file(self, star_file, float_dtype=np.float64, columns=None, lazy=False, block=None):
+        logging.info(f'reading star file: {star_file}')
+        if lazy and columns is None:
+            columns = []
+
+        for block_name, headings, block_columns, header in scan_blocks(star_file,
+                                                                       float_dtype=float_dtype,
+                                                                       columns=columns,
+                                                                       block=block):
+            self.from_columns(headings, block_columns)
+            if lazy:
+                self.defer_columns(star_file, block_name, headings, float_dtype=float_dtype)
+
+    def from_columns(self, headings, columns):
+        """
+        fills the StarDict from column headings and typed columns as produced by scan_blocks
+        :param headings: list of column headings
+        :param columns: list of numpy arrays, one for each heading, headings with a column of None are skipped
+        """
+        for heading, column in zip(headings, columns):
+            if column is not None:
+                self[heading] = column
+
+    def defer_columns(self, star_file, block_name, headings, float_dtype=np.float64):
+        """
+        registers columns of a data block in a star file which are parsed from the file on first access
+        :param star_file: star file
+        :param block_name: name of the data block containing the columns, e.g. 'data_particles'
+        :param headings: column headings, headings already present in the StarDict are ignored
+        :param float_dtype: dtype of non-integer numeric columns
+        """
+        self.star_file = star_file
+        self.float_dtype = float_dtype
+        for heading in headings:
+            if not dict.__contains__(self, heading):
+                self.deferred[heading] = block_name
+
+    def load(self, *headings):
+        """
+        parses deferred columns from the star file, all deferred columns are loaded if no headings are given
+        :param headings: column headings
+        """
+        if len(headings) == 0:
+            headings = list(self.deferred)
+
+        blocks = {}
+        for heading in headings:
+            if heading in self.deferred:
+                blocks.setdefault(self.deferred.pop(heading), []).append(heading)
+
+        for block_name, block_headings in blocks.items():
+            logging.info(f'loading deferred columns {block_headings} from {self.star_file}')
+            for name, headings, columns, header in scan_blocks(self.star_file,
+                                                               float_dtype=self.float_dtype,
+                                                               columns=block_headings,
+                                                               block=block_name):
+                self.from_columns(headings, columns)
 
     def from_data_block(self, data_block):
         logging.info('making stardict from data block')
-        try:
-            header, body = clean_data_block(data_block)
-            column_headings = [info[1:info.find('#')].strip() for info in header if info.startswith('_')]
-            for idx, heading in enumerate(column_headings):
-                self[heading] = np.asarray(body[idx])
-        except:
-            logging.warning('one or more data blocks in this star file are unsupported')
-            self['data'] = data_block
+        for block_name, headings, columns, header in _scan_lines(data_block, float_dtype=self.float_dtype,
+                                                                 reread=lambda block_name: data_block):
+            self.from_columns(headings, columns)
 
     def nrows(self):
-        key = self.headings()[0]
-        nrows = len(self[key])
-        return nrows
+        for key in self.headings():
+            if np.ndim(self[key]) > 0:
+                nrows = len(self[key])
+                return nrows
+        return 0
 
     def headings(self):
-        headings = list(self.keys())
+        headings = list(dict.keys(self)) + list(self.deferred)
         return headings
 
     def loopheader(self):
@@ -68,36 +244,49 @@ class StarDict(dict):
         return loopheader
 
     def write(self, file):
+        """
+        writes the StarDict to a star file
+        the format of each column is resolved once from its heading, rows are then formatted and written in chunks
+        :param file: output star file
+        """
         logging.info(f'writing star file: {file}')
-        header = self.loopheader()
-        body = []
-        nrows = self.nrows()
-        for row in range(nrows):
-            current_row = []
-            for column_name in self.headings():
-                element = self[column_name][row]
-
-                if any(_ in column_name.lower() for _ in ('coordinate',
-                                                        'angle',
-                                                        'apix',
-                                                        'pixel',
-                                                        'magnification')):
-                    element = f'{element:>12.5f}'
-
-                elif any(_ in column_name.lower() for _ in ('tag',
-                                                            'idx')):
-                    element = f'{element:>.0f}'
-
-                current_row.append(f'{element}\t')
-
-            current_row.append('\n')
-            body.append(' '.join(current_row))
-
-        with open(file, 'w') as file:
-            for line in header:
-                file.write(line)
-            for line in body:
-                file.write(line)
+        with StarWriter(file) as writer:
+            writer.write(self)
+
+    def subset(self, selection_indices):
+        """
+        extracts selected rows into a new StarDict, key-value pairs are copied unchanged
+        :param selection_indices: boolean mask or indices of rows
+        :return: StarDict
+        """
+        subset = StarDict(float_dtype=self.float_dtype)
+        for heading in self.headings():
+            column = self[heading]
+            subset[heading] = column if np.ndim(column) == 0 else np.asarray(column)[selection_indices]
+
+        return subset
+
+    def remove_duplicates(self, min_distance, keep=None, group_heading='rlnMicrographName'):
+        """
+        removes duplicate particles, particles closer than min_distance to another particle from the same micrograph
+        positions are taken from rlnCoordinateX, rlnCoordinateY and rlnCoordinateZ. Particles are kept from the best
+        score down unless they are a duplicate of a particle already kept, see neighbours.suppress_neighbours
+        :param min_distance: distance below which particles are considered duplicates, in the units of the coordinates
+        :param keep: heading of the column whose highest values are kept first, e.g. 'rlnMaxValueProbDistribution',
+                     None to keep particles in order
+        :param group_heading: heading of the column in which particles from different tomograms differ, None if all
+                              particles come from a single tomogram
+        :return: StarDict of the kept particles, in their original order
+        """
+        xyz = np.column_stack([self[f'rlnCoordinate{axis}'] for axis in 'XYZ'])
+        groups = None if group_heading is None else self[group_heading]
+        pairs, distances = neighbours.neighbour_pairs(xyz, groups, min_distance)
+
+        scores = None if keep is None else self[keep]
+        kept = neighbours.suppress_neighbours(pairs, len(xyz), scores)
+        logging.info(f'removing {np.sum(~kept)} duplicate particles closer than {min_distance} from StarDict')
+
+        return self.subset(kept)
 
     def extract_eulers_relion(self):
         """
@@ -108,34 +297,886 @@ class StarDict(dict):
         rln_tilt = self['rlnAngleTilt']
         rln_psi = self['rlnAnglePsi']
 
-        euler_angles_relion = np.vstack((rln_rot, rln_tilt, rln_psi)).transpose()
+        euler_angles_relion = np.column_stack((rln_rot, rln_tilt, rln_psi))
         return euler_angles_relion
 
+    def get_orientations(self, dtype=np.float64):
+        """
+        orientations of the particles from rlnAngleRot, rlnAngleTilt & rlnAnglePsi as unit quaternions, see
+        ABTT.math.orientations
+        :param dtype: np.float32 or np.float64
+        :return: Orientations
+        """
+        return Orientations.from_euler_angles(self.extract_eulers_relion(), 'relion', dtype=dtype)
 
-def read(star_file):
+
+class StarWriter:
+    """
+    writes a star file from one or more StarDicts, e.g. chunks from iter_chunks, appending their rows to a single loop
+    the block header is taken from the first StarDict written, later StarDicts must have the same loop headings.
+    Elements of a StarDict which are scalars rather than columns are written as key-value pairs before the loop
+
+    with StarWriter('filtered.star') as writer:
+        for chunk in iter_chunks('particles.star', chunksize=100000):
+            writer.write(chunk.subset(chunk['rlnMaxValueProbDistribution'] > 0.1))
+    """
+
+    def __init__(self, file, block_name='data_'):
+        """
+        :param file: output star file
+        :param block_name: name of the data block
+        """
+        self.block_name = block_name
+        self.headings = None
+        self.formats = None
+        self.started = False
+        self.file = open(file, 'w', buffering=_WRITE_BUFFER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start_block(self, block_name):
+        """
+        starts a new data block, the next StarDict written provides its header
+        :param block_name: name of the data block, e.g. 'data_optics'
+        """
+        if self.started:
+            self.file.write('\n')
+        self.block_name = block_name
+        self.headings = None
+
+    def write(self, star_dict):
+        """
+        appends the rows of a StarDict to the star file, writing the block header first if needed
+        :param star_dict: StarDict
+        :raises ValueError: if its columns do not all have the same number of rows, or if its loop headings differ
+                            from those of the StarDict which provided the block header
+        """
+        if self.headings is None:
+            headings = star_dict.headings()
+            pairs = [heading for heading in headings if np.ndim(star_dict[heading]) == 0]
+            self.headings = [heading for heading in headings if heading not in pairs]
+            self.formats = [column_format(heading) for heading in self.headings]
+
+            header = [f'{self.block_name}\n']
+            if len(pairs) > 0:
+                header.append('\n')
+                header.extend(f'_{heading} {column_format(heading) % star_dict[heading]}\n' for heading in pairs)
+                header.append('\n')
+            if len(self.headings) > 0:
+                header.extend(star_loopheader(self.headings)[1:])
+            self.file.writelines(header)
+            self.started = True
+
+        else:
+            headings = [heading for heading in star_dict.headings() if np.ndim(star_dict[heading]) > 0]
+            if headings != self.headings:
+                raise ValueError(f'loop headings {headings} do not match those of the block, {self.headings}')
+
+        if len(self.headings) == 0:
+            return
+
+        columns = [star_dict[heading] for heading in self.headings]
+        nrows = len(columns[0])
+        for heading, column in zip(self.headings, columns):
+            if len(column) != nrows:
+                raise ValueError(f'column {heading} has {len(column)} rows, {self.headings[0]} has {nrows}')
+
+        for start in range(0, nrows, _ROWS_PER_CHUNK):
+            stop = start + _ROWS_PER_CHUNK
+            self.file.write(format_rows(self.formats, [column[start:stop] for column in columns]))
+
+    def close(self):
+        self.file.close()
+
+
+def read(star_file, float_dtype=np.float64, columns=None, lazy=False, use_cache=False, cache_dir=None, block=None,
+         where=None):
     """
     reads a star file into a StarDict object { column_name : [data] }
+    the file is walked only once, see scan_blocks
     :param star_file:
-    :return: StarDict or dict of StarDicts
+    :param float_dtype: dtype of non-integer numeric columns, np.float32 halves their memory footprint
+    :param columns: headings of the columns to read, None for all, other columns are neither converted nor stored
+    :param lazy: if True, columns which are not in 'columns' are parsed from the file on first access
+    :param use_cache: if True, the parsed columns are stored in a binary sidecar cache on first read and loaded from it
+                  on later reads until the star file changes, see ABTT.io.cache. Lazy reads from the cache are
+                  memory mapped
+    :param cache_dir: cache directory, defaults to ABTT.io.cache.CACHE_DIR
+    :param block: name of a data block, e.g. 'data_particles'. If given, only this block is parsed, the file is
+                  scanned up to the block header (see index_blocks) and the reader seeks straight to it
+    :param where: condition or list of conditions (heading, operator, value) which rows must all satisfy, e.g.
+                  [('rlnMicrographName', 'in', micrographs), ('rlnMaxValueProbDistribution', '>', 0.1)], see
+                  evaluate_where. Conditions are evaluated on each chunk of rows as it is parsed and other columns
+                  are only converted for the rows which satisfy them. Conditions on headings absent from a block
+                  are ignored for that block, a KeyError is raised for headings found in none of the blocks read
+    :return: StarDict, or dict of StarDicts { block_name : StarDict } for multi block star files
     """
     logging.info(f'reading star file {star_file}')
-    loop_info = data_loop_start_indices(star_file)
-    if len(loop_info) == 1:
-        star_dict = StarDict(star_file)
+    where = _where_conditions(where)
+    if where and lazy:
+        raise ValueError('lazy reads cannot be filtered with where, deferred columns would not be filtered')
+
+    if use_cache:
+        blocks = _cached_blocks(star_file, float_dtype, _where_columns(columns, where), lazy, cache_dir)
+        if block is not None:
+            blocks = [scanned_block for scanned_block in blocks if scanned_block[0] == block]
+        if where:
+            blocks = [_filter_block(scanned_block, where, columns) for scanned_block in blocks]
+        lazy = False
+
+    elif lazy and columns is None:
+        blocks = scan_blocks(star_file, float_dtype=float_dtype, columns=[], block=block)
+
+    else:
+        blocks = scan_blocks(star_file, float_dtype=float_dtype, columns=columns, block=block, where=where)
+
+    star_dicts = {}
+    read_headings = set()
+    for block_name, headings, block_columns, header in blocks:
+        read_headings.update(headings)
+        star_dict = StarDict(float_dtype=float_dtype)
+        star_dict.from_columns(headings, block_columns)
+        if lazy:
+            star_dict.defer_columns(star_file, block_name, headings, float_dtype=float_dtype)
+        star_dicts[block_name] = star_dict
+    _check_where_headings(where, read_headings, star_file)
+
+    if len(star_dicts) == 1:
+        star_dict = list(star_dicts.values())[0]
         return star_dict
 
+    return star_dicts
+
+
+def write_blocks(star_dicts, file):
+    """
+    writes multiple data blocks into a single star file
+    :param star_dicts: dict of StarDicts { block_name : StarDict } as returned by read for multi block star files
+    :param file: output star file
+    """
+    logging.info(f'writing star file: {file}')
+    with StarWriter(file) as writer:
+        for block_name, star_dict in star_dicts.items():
+            writer.start_block(block_name)
+            writer.write(star_dict)
+
+
+def index_blocks(star_file):
+    """
+    finds the byte offset of every data block in a star file in a single scan over the raw bytes
+    the index is kept in memory until the size or modification time of the file change
+    :param star_file: star file
+    :return: dict { block_name : offset }
+    """
+    path, fingerprint = _fingerprint(star_file)
+    if path in _block_indices and _block_indices[path][0] == fingerprint:
+        return dict(_block_indices[path][1])
+
+    logging.info(f'indexing data blocks of star file {star_file}')
+    index = {}
+    for block_name, offset in _iter_block_offsets(star_file):
+        index.setdefault(block_name, offset)
+
+    _block_indices[path] = (fingerprint, index)
+    return dict(index)
+
+
+def _fingerprint(star_file):
+    """
+    absolute path of a star file and the (size, mtime_ns) which invalidate what is known of its blocks
+    """
+    stat = os.stat(star_file)
+    return os.path.abspath(star_file), (stat.st_size, stat.st_mtime_ns)
+
+
+def _iter_block_offsets(star_file):
+    """
+    generator of (block_name, offset) for each data block header in a star file, in file order
+    the raw bytes are read in chunks of _INDEX_CHUNK_SIZE, so stopping early leaves the rest of the file unread
+    """
+    with open(star_file, 'rb') as file:
+        offset = 0
+        remainder = b''
+        while True:
+            chunk = file.read(_INDEX_CHUNK_SIZE)
+            buffer = remainder + chunk
+
+            # only search complete lines, the last partial line is carried over to the next chunk
+            end = len(buffer) if len(chunk) == 0 else buffer.rfind(b'\n') + 1
+            for match in _DATA_BLOCK.finditer(buffer, 0, end):
+                yield match.group(1).decode(), offset + match.start()
+
+            if len(chunk) == 0:
+                break
+            offset += end
+            remainder = buffer[end:]
+
+
+def _block_offset(star_file, block):
+    """
+    byte offset of a data block in a star file, None if the file has no such block
+    the scan stops at the first header of the block, so a block near the start of a large file is found without
+    reading the rest of it. A file which is read to the end without finding the block is fully indexed
+    """
+    path, fingerprint = _fingerprint(star_file)
+    if path in _block_indices and _block_indices[path][0] == fingerprint:
+        return _block_indices[path][1].get(block)
+    if (path, block) in _block_offsets and _block_offsets[path, block][0] == fingerprint:
+        return _block_offsets[path, block][1]
+
+    index = {}
+    offsets = _iter_block_offsets(star_file)
+    try:
+        for block_name, offset in offsets:
+            if block_name == block:
+                _block_offsets[path, block] = (fingerprint, offset)
+                return offset
+            index.setdefault(block_name, offset)
+    finally:
+        offsets.close()
+
+    _block_indices[path] = (fingerprint, index)
+    return None
+
+
+def _default_block(star_file, block=None):
+    """
+    the block read from a star file by readers of a single loop, data_particles if there is one so that the optics
+    table of RELION 3.1 star files is not read in its place, else None for the first block containing a loop
+    data_particles follows the small optics block, so looking for it only reads the start of RELION 3.1 files
+    """
+    if block is None and _block_offset(star_file, _PARTICLES_BLOCK) is not None:
+        return _PARTICLES_BLOCK
+    return block
+
+
+def _open_lines(star_file, block=None):
+    """
+    opens a star file as text, positioned at the start of a data block if one is given
+    """
+    if block is None:
+        return open(star_file, 'r')
+
+    offset = _block_offset(star_file, block)
+    if offset is None:
+        raise KeyError(f'data block {block} not found in star file {star_file}')
+
+    file = open(star_file, 'rb')
+    file.seek(offset)
+    return io.TextIOWrapper(file)
+
+
+def iter_chunks(star_file, block=None, chunksize=100000, float_dtype=np.float64, columns=None, where=None,
+                dtypes=None):
+    """
+    iterates over the rows of one loop in a star file in chunks, so that files of any size can be processed in
+    bounded memory. Use with StarWriter to write results back out chunk by chunk.
+    column types are inferred chunk by chunk, a column read as strings stays strings in later chunks but earlier
+    chunks may have been numeric. Give the dtype of such columns in dtypes for the same type in every chunk
+    :param star_file: star file
+    :param block: name of the data block, e.g. 'data_particles', defaults to data_particles if present, else the
+                  first block containing a loop. Nothing is yielded if the block has no loop
+    :param chunksize: maximum number of rows per chunk
+    :param float_dtype: dtype of non-integer numeric columns
+    :param columns: headings of the columns to read, None for all
+    :param where: conditions which rows must satisfy, see read. chunksize counts rows before filtering and chunks
+                  left without rows are skipped. A KeyError is raised for headings absent from the loop
+    :param dtypes: dict { heading : dtype } of columns converted to a given dtype, e.g. {'rlnImageName': str}
+    :return: generator of StarDict
+    """
+    where = _where_conditions(where)
+    dtypes = {} if dtypes is None else dict(dtypes)
+    block = _default_block(star_file, block)
+    with _open_lines(star_file, block) as file:
+        block_name = None
+        headings, rows = [], []
+        selection = None
+        in_loop = False
+
+        for line in file:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+
+            if line.startswith('data_'):
+                # a requested block ends at the next block, even if it has no loop
+                if selection is not None or (block is not None and block_name is not None):
+                    break
+                block_name = line
+                headings = []
+                in_loop = False
+
+            elif line.startswith('loop_'):
+                if len(headings) > 0:
+                    raise ValueError(f'data block {block_name} contains more than one loop, which is not supported')
+                in_loop = True
+
+            elif line.startswith('_'):
+                if selection is not None:
+                    break
+                if in_loop:
+                    headings.append(line.split()[0][1:])
+
+            elif in_loop:
+                if selection is None:
+                    _check_where_headings(where, headings, star_file)
+                    selection = _RowSelection(headings, _where_columns(columns, where))
+                    conditions = where
+
+                if len(selection.indices) == 0:
+                    continue
+
+                rows.append(selection.split(line))
+                if len(rows) == chunksize:
+                    star_dict = _chunk_star_dict(rows, selection, float_dtype, columns, conditions, dtypes)
+                    rows = []
+                    if star_dict.nrows() > 0:
+                        yield star_dict
+
+        # a loop without rows is checked too
+        if selection is None:
+            _check_where_headings(where, headings, star_file)
+
+        if len(rows) > 0:
+            star_dict = _chunk_star_dict(rows, selection, float_dtype, columns, conditions, dtypes)
+            if star_dict.nrows() > 0:
+                yield star_dict
+
+
+def _chunk_star_dict(rows, selection, float_dtype=np.float64, columns=None, where=None, dtypes=None):
+    """
+    converts a chunk of split rows into a StarDict, dropping rows which do not satisfy where
+    columns converted to strings are added to dtypes in place, so that they are kept as strings in later chunks
+    """
+    chunks = [[] for _ in selection.indices]
+    _extend_columns(chunks, rows, float_dtype, where, selection.selected, dtypes)
+
+    star_dict = StarDict(float_dtype=float_dtype)
+    for heading, column_chunks in zip(selection.selected, chunks):
+        if column_chunks[0].dtype.kind == 'U' and dtypes is not None:
+            dtypes.setdefault(heading, str)
+        if columns is None or heading in columns:
+            star_dict[heading] = column_chunks[0]
+
+    return star_dict
+
+
+def read_many(star_files, workers=None, block=None, float_dtype=np.float64, columns=None,
+              source_heading='sourceFileIdx', where=None):
+    """
+    reads the same loop from many star files in parallel, one file per process, and concatenates the results
+    each column of the result is allocated once and filled file by file
+    :param star_files: list of star files
+    :param workers: number of processes, defaults to the number of cpus, 1 reads the files in this process
+    :param block: name of the data block to read, defaults to data_particles in files which have one, else the
+                  first block containing a loop
+    :param float_dtype: dtype of non-integer numeric columns
+    :param columns: headings of the columns to read, None for all
+    :param source_heading: heading of the added column holding the index of the source file in star_files for each
+                           row, None to skip it
+    :param where: conditions which rows must satisfy, see read. A KeyError is raised for headings absent from the
+                  loop of any file
+    :return: StarDict
+    """
+    star_files = list(star_files)
+    logging.info(f'reading {len(star_files)} star files')
+    if len(star_files) == 0:
+        return StarDict(float_dtype=float_dtype)
+
+    where = _where_conditions(where)
+    arguments = [(star_file, block, float_dtype, columns, where) for star_file in star_files]
+
+    if workers == 1:
+        loops = [_read_loop(*argument) for argument in arguments]
     else:
-        data_blocks = get_data_blocks(star_file)
-        star_dicts = {}
-        for data_block in data_blocks:
-            data_loop_name = data_block[0]
-            star_dict = StarDict(data_block=data_block)
-            star_dicts[data_loop_name] = star_dict
-        return star_dicts
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            loops = list(executor.map(_read_loop, *zip(*arguments)))
+
+    headings = list(loops[0].keys())
+    for star_file, loop in zip(star_files, loops):
+        if list(loop.keys()) != headings:
+            raise ValueError(f'headings of {star_file} do not match those of {star_files[0]}')
+
+    nrows = np.array([len(loop[headings[0]]) if headings else 0 for loop in loops])
+    offsets = np.concatenate(([0], np.cumsum(nrows)))
+
+    star_dict = StarDict(float_dtype=float_dtype)
+    for heading in headings:
+        parts = [loop.pop(heading) for loop in loops]
+        # a column read as strings from some files is read again as strings from the others, rather than
+        # formatting their numbers, which would alter values such as '007'
+        if len({part.dtype.kind == 'U' for part in parts}) > 1:
+            for idx, part in enumerate(parts):
+                if part.dtype.kind != 'U':
+                    parts[idx] = _read_loop(star_files[idx], block, float_dtype, [heading], where,
+                                            dtypes={heading: str})[heading]
+
+        column = np.empty(offsets[-1], dtype=_joined_dtype(parts, float_dtype))
+        for idx, part in enumerate(parts):
+            column[offsets[idx]:offsets[idx + 1]] = part
+        star_dict[heading] = column
+
+    if source_heading is not None:
+        star_dict[source_heading] = np.repeat(np.arange(len(star_files)), nrows)
+
+    return star_dict
+
+
+def _read_loop(star_file, block=None, float_dtype=np.float64, columns=None, where=None, dtypes=None):
+    """
+    reads the columns of the loop in a given block, of data_particles or of the first loop found in a star file
+    :return: dict { heading : column }
+    """
+    where = _where_conditions(where)
+    block = _default_block(star_file, block)
+    for block_name, headings, block_columns, header in scan_blocks(star_file,
+                                                                   float_dtype=float_dtype,
+                                                                   columns=columns,
+                                                                   block=block,
+                                                                   where=where,
+                                                                   dtypes=dtypes):
+        loop = {heading: column for heading, column in zip(headings, block_columns)
+                if column is not None and np.ndim(column) > 0}
+        if len(loop) > 0:
+            _check_where_headings(where, headings, star_file)
+            return loop
+
+    _check_where_headings(where, [], star_file)
+    return {}
+
+
+def _cached_blocks(star_file, float_dtype=np.float64, columns=None, lazy=False, cache_dir=None):
+    """
+    gets the blocks of a star file from the sidecar cache, parsing the whole file and caching it on a miss
+    lazy reads memory map every column instead of deferring them
+    """
+    if lazy:
+        columns = None
+
+    blocks = cache.load_blocks(star_file, float_dtype, columns=columns, mmap=lazy, cache_dir=cache_dir)
+    if blocks is None:
+        blocks = list(scan_blocks(star_file, float_dtype=float_dtype))
+        cache.store_blocks(star_file, blocks, float_dtype, cache_dir=cache_dir)
+
+        if columns is not None:
+            blocks = [(block_name, headings, [column if heading in columns else None
+                                              for heading, column in zip(headings, block_columns)], header)
+                      for block_name, headings, block_columns, header in blocks]
+
+    return blocks
+
+
+def scan_blocks(star_file, float_dtype=np.float64, columns=None, block=None, where=None, dtypes=None):
+    """
+    walks a star file once, yielding each data block as soon as it has been read
+    loop rows are split, transposed and converted into typed columns in chunks of _ROWS_PER_CHUNK rows so that
+    the raw text of the file is never held in memory. Key-value pairs outside of loops are converted to scalars.
+    Columns which are numeric in some chunks and strings in others are read again from their block as strings
+    :param star_file: star file
+    :param float_dtype: dtype of non-integer numeric columns
+    :param columns: headings of the columns to materialise, None for all. Rows are only split as far as the last
+                    requested column and no other column is converted
+    :param block: name of a single data block to scan, the file is scanned up to the block and only this block is read
+    :param where: conditions which loop rows must satisfy, see read. Rows which do not are dropped chunk by chunk
+    :param dtypes: dict { heading : dtype } of loop columns converted to a given dtype rather than the one inferred
+                   from all of their values
+    :return: generator of (block_name, headings, columns, header) where columns is a list of numpy arrays
+             (or scalars for key-value pairs), one for each heading (None for columns which were not requested),
+             and header is a list of the non-data lines of the block
+    """
+    where = _where_conditions(where)
+
+    def reread(block_name):
+        with _open_lines(star_file, block_name) as block_file:
+            yield from block_file
+
+    with _open_lines(star_file, block) as file:
+        for scanned_block in _scan_lines(file, float_dtype=float_dtype, columns=columns, where=where,
+                                         reread=reread, dtypes=dtypes):
+            yield scanned_block
+            if block is not None:
+                return
+
+
+def _scan_lines(lines, float_dtype=np.float64, columns=None, where=(), reread=None, dtypes=None):
+    """
+    generator of the data blocks in an iterable of star file lines, see scan_blocks
+    reread(block_name) gives the lines from the start of a block again, for columns whose chunks were converted to
+    different types, see _finish_block
+    """
+    block = None
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+
+        if line.startswith('data_'):
+            if block is not None:
+                yield _finish_block(block, reread)
+            block = _BlockScan(line, float_dtype=float_dtype, columns=columns, where=where, dtypes=dtypes)
+
+        elif block is None:
+            continue
+
+        elif line.startswith('loop_'):
+            block.start_loop(line)
+
+        elif line.startswith('_'):
+            block.add_heading(line)
+
+        elif block.in_loop:
+            block.add_row(line)
+
+    if block is not None:
+        yield _finish_block(block, reread)
+
+
+def _finish_block(block, reread):
+    """
+    finishes a scanned block, see _BlockScan.finish. Columns typed per chunk may be numeric in some chunks and
+    strings in others, these columns are parsed again from the raw text of the block as strings so that no value is
+    altered by a round trip through a number, e.g. '007'
+    """
+    block_name, headings, columns, header = block.finish()
+    if len(block.mixed) == 0:
+        return block_name, headings, columns, header
+    if reread is None:
+        raise ValueError(f'columns {block.mixed} of {block_name} mix numbers and strings and cannot be read again')
+
+    logging.debug(f'reading columns {block.mixed} of {block_name} again as strings')
+    rescan = _scan_lines(reread(block_name), float_dtype=block.float_dtype, columns=block.mixed, where=block.where,
+                         dtypes=dict(block.dtypes or {}, **{heading: str for heading in block.mixed}))
+    try:
+        for rescanned_name, rescanned_headings, rescanned_columns, rescanned_header in rescan:
+            if rescanned_name == block_name:
+                break
+    finally:
+        rescan.close()
+
+    for heading in block.mixed:
+        idx = headings.index(heading)
+        columns[idx] = rescanned_columns[idx]
+    return block_name, headings, columns, header
+
+
+class _BlockScan:
+    """
+    accumulates the lines of one data block into its key-value pairs and the typed columns of its loop
+    """
+
+    def __init__(self, name, float_dtype=np.float64, columns=None, where=(), dtypes=None):
+        self.name = name
+        self.float_dtype = float_dtype
+        self.columns = columns
+        self.where = where
+        self.dtypes = dtypes
+        # requested loop columns whose chunks were converted to numbers and to strings, see _finish_block
+        self.mixed = []
+        self.header = [name]
+        self.pairs = []
+        self.headings = []
+        self.chunks = []
+        self.rows = []
+        self.selection = None
+        self.in_loop = False
+
+    def start_loop(self, line):
+        # headings and rows of a second loop would be read as pairs and as rows of the first loop
+        if len(self.headings) > 0:
+            raise ValueError(f'data block {self.name} contains more than one loop, which is not supported')
+        self.header.append(line)
+        self.in_loop = True
+
+    def add_heading(self, line):
+        self.header.append(line)
+        if self.in_loop and self.selection is None:
+            self.headings.append(line.split()[0][1:])
+            return
+
+        # a key-value pair, which also ends any loop whose rows have been read
+        self.in_loop = False
+        tokens = line.split(None, 1)
+        value = tokens[1] if len(tokens) > 1 else ''
+        self.pairs.append((tokens[0][1:], value))
+
+    def add_row(self, line):
+        if self.selection is None:
+            self.select_columns()
+
+        if self.selection.indices:
+            self.rows.append(self.selection.split(line))
+            if len(self.rows) == _ROWS_PER_CHUNK:
+                _extend_columns(self.chunks, self.rows, self.float_dtype, self.where, self.selection.selected,
+                                self.dtypes)
+                self.rows = []
+
+    def select_columns(self):
+        """
+        selects the loop columns to split, the requested columns and those needed to evaluate the where conditions
+        """
+        self.selection = _RowSelection(self.headings, _where_columns(self.columns, self.where))
+        self.chunks = [[] for _ in self.selection.indices]
+        self.where = [condition for condition in self.where if condition[0] in self.selection.selected]
+
+    def finish(self):
+        """
+        converts the last rows of the block and joins its column chunks, aligning columns with headings
+        :return: (block_name, headings, columns, header)
+        """
+        if self.selection is None:
+            self.select_columns()
+
+        _extend_columns(self.chunks, self.rows, self.float_dtype, self.where, self.selection.selected, self.dtypes)
+        loop_columns = [None for _ in self.headings]
+        for idx, column_chunks in zip(self.selection.indices, self.chunks):
+            if self.columns is None or self.headings[idx] in self.columns:
+                if len({chunk.dtype.kind == 'U' for chunk in column_chunks}) > 1:
+                    self.mixed.append(self.headings[idx])
+                else:
+                    loop_columns[idx] = _join_chunks(column_chunks, self.float_dtype)
 
+        headings = [heading for heading, value in self.pairs] + self.headings
+        pair_values = []
+        for heading, value in self.pairs:
+            if self.columns is None or heading in self.columns:
+                pair_values.append(convert_column((value,), self.float_dtype)[0])
+            else:
+                pair_values.append(None)
 
+        return self.name, headings, pair_values + loop_columns, self.header
 
 
+class _RowSelection:
+    """
+    splits the rows of a loop into the tokens of requested columns only
+    """
+
+    def __init__(self, headings, columns=None):
+        if columns is None:
+            self.indices = list(range(len(headings)))
+            self.maxsplit = -1
+            self.select = None
+
+        else:
+            columns = set(columns)
+            self.indices = [idx for idx, heading in enumerate(headings) if heading in columns]
+            self.maxsplit = max(self.indices, default=-1) + 1
+            if len(self.indices) == 1:
+                index = self.indices[0]
+                self.select = lambda tokens: (tokens[index],)
+            elif len(self.indices) > 1:
+                self.select = itemgetter(*self.indices)
+
+        self.selected = [headings[idx] for idx in self.indices]
+
+    def split(self, line):
+        if self.maxsplit == -1:
+            return line.split()
+        return self.select(line.split(None, self.maxsplit))
+
+
+def convert_column(values, float_dtype=np.float64):
+    """
+    converts a whole column of strings into a contiguous numpy array in one go
+    the first of int64, float_dtype or fixed-width unicode string which can hold every value is used
+    :param values: sequence of strings
+    :param float_dtype: dtype used for non-integer numeric columns
+    :return: numpy array
+    """
+    for dtype in (np.int64, float_dtype):
+        try:
+            return np.array(values, dtype=dtype)
+        except (ValueError, OverflowError):
+            continue
+
+    return np.array(values, dtype=str)
+
+
+def _extend_columns(columns, rows, float_dtype=np.float64, where=None, headings=None, dtypes=None):
+    """
+    transposes a chunk of rows, converts each column of the chunk and appends it to the column chunks in place
+    if where is given, the columns it refers to are converted first and only the rows satisfying it are kept,
+    other columns are only converted for these rows
+    :param columns: list of lists of numpy arrays, one list per column
+    :param rows: list of lists of strings, one per row
+    :param float_dtype: dtype used for non-integer numeric columns
+    :param where: list of (heading, operator, value) conditions on headings
+    :param headings: headings of the columns
+    :param dtypes: dict { heading : dtype } of columns converted to a given dtype rather than the inferred one.
+                   where conditions are always evaluated on inferred types
+    """
+    dtypes = {} if dtypes is None else dtypes
+    if len(rows) == 0:
+        return
+
+    transposed = list(zip(*rows))
+    converted = {}
+    mask = None
+    if where:
+        for heading, op, value in where:
+            idx = headings.index(heading)
+            if idx not in converted:
+                converted[idx] = convert_column(transposed[idx], float_dtype)
+        mask = evaluate_where(where, {headings[idx]: column for idx, column in converted.items()})
+
+    for idx, (chunks, values) in enumerate(zip(columns, transposed)):
+        dtype = dtypes.get(headings[idx]) if headings is not None else None
+        if idx in converted and dtype is None:
+            chunks.append(converted[idx] if mask is None else converted[idx][mask])
+            continue
+
+        if mask is not None:
+            values = tuple(compress(values, mask))
+        chunks.append(convert_column(values, float_dtype) if dtype is None else np.array(values, dtype=dtype))
+
+
+def evaluate_where(where, columns):
+    """
+    evaluates conditions on columns
+    :param where: list of (heading, operator, value) conditions, operator is one of '==', '!=', '<', '<=', '>',
+                  '>=', 'in' or 'not in' (value is then a collection)
+    :param columns: dict { heading : column }, e.g. a StarDict
+    :return: boolean numpy array, True for rows satisfying every condition
+    """
+    mask = None
+    for heading, op, value in where:
+        if op not in _WHERE_OPERATORS:
+            raise ValueError(f'unknown operator {op}, expected one of {list(_WHERE_OPERATORS)}')
+        condition = np.asarray(_WHERE_OPERATORS[op](np.asarray(columns[heading]), value), dtype=bool)
+        mask = condition if mask is None else mask & condition
+
+    return mask
+
+
+def _where_conditions(where):
+    """
+    normalises a where clause into a list of (heading, operator, value) conditions
+    """
+    if where is None:
+        return []
+    if len(where) == 3 and isinstance(where[0], str) and where[1] in _WHERE_OPERATORS:
+        return [tuple(where)]
+    return [tuple(condition) for condition in where]
+
+
+def _check_where_headings(where, headings, star_file):
+    """
+    raises a KeyError for conditions on headings which were not read, a misspelled heading would otherwise select
+    every row
+    """
+    missing = [heading for heading, op, value in where if heading not in headings]
+    if missing:
+        raise KeyError(f'headings {missing} of where conditions not found in star file {star_file}')
+
+
+def _where_columns(columns, where):
+    """
+    adds the headings referred to by where conditions to requested columns
+    """
+    if columns is None or not where:
+        return columns
+    return list(columns) + [heading for heading, op, value in where if heading not in columns]
+
+
+def _filter_block(scanned_block, where, columns=None):
+    """
+    filters the loop rows of an already scanned block, see scan_blocks, and drops columns which were not requested
+    """
+    block_name, headings, block_columns, header = scanned_block
+    loop = {heading: column for heading, column in zip(headings, block_columns)
+            if column is not None and np.ndim(column) > 0}
+    mask = evaluate_where([condition for condition in where if condition[0] in loop], loop)
+
+    filtered = []
+    for heading, column in zip(headings, block_columns):
+        if columns is not None and heading not in columns:
+            column = None
+        elif mask is not None and heading in loop:
+            column = column[mask]
+        filtered.append(column)
+
+    return block_name, headings, filtered, header
+
+
+def _join_chunks(chunks, float_dtype=np.float64):
+    """
+    joins the converted chunks of a column into a single array
+    a column with integer and float chunks is joined as float_dtype, rather than the float64 np.concatenate would
+    promote int64 to. Chunks must be either all numeric or all strings
+    :param chunks: list of numpy arrays
+    :param float_dtype: dtype of columns mixing integer and float chunks
+    :return: numpy array
+    """
+    if len(chunks) == 0:
+        return np.array([])
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    dtype = _joined_dtype(chunks, float_dtype)
+    return np.concatenate([chunk.astype(dtype, copy=False) for chunk in chunks])
+
+
+def _joined_dtype(chunks, float_dtype=np.float64):
+    """
+    dtype of the column joining chunks of a column, float_dtype if they mix integer and float chunks
+    :param chunks: list of numpy arrays
+    :param float_dtype: dtype of non-integer numeric columns
+    :return: numpy dtype
+    """
+    if {chunk.dtype.kind for chunk in chunks} == {'i', 'f'}:
+        return np.dtype(float_dtype)
+    return np.result_type(*chunks)
+
+
+def column_format(heading):
+    """
+    resolves the %-format used for every element of a column when writing a star file, from its heading
+    :param heading: column heading
+    :return: format string
+    """
+    heading = heading.lower()
+    if any(_ in heading for _ in ('coordinate',
+                                  'angle',
+                                  'apix',
+                                  'pixel',
+                                  'magnification')):
+        return '%12.5f'
+
+    elif any(_ in heading for _ in ('tag',
+                                    'idx')):
+        return '%.0f'
+
+    return '%s'
+
+
+def format_rows(formats, columns):
+    """
+    formats columns into the lines of a star file body, one format operation per row rather than per element
+    :param formats: list of format strings, one for each column, see column_format
+    :param columns: list of columns (numpy arrays or lists) of equal length
+    :return: str
+    """
+    row_format = '\t '.join(formats) + '\t \n'
+    values = [_column_values(column, format) for column, format in zip(columns, formats)]
+    return ''.join([row_format % row for row in zip(*values)])
+
+
+def _column_values(column, format):
+    """
+    converts a column into a list of python objects which format identically to the numpy elements
+    numpy prints float32 elements at their own precision so these are converted to strings directly
+    """
+    column = np.asarray(column)
+    if format == '%s' and column.dtype.kind == 'f' and column.dtype != np.float64:
+        return column.astype(str).tolist()
+
+    return column.tolist()
+
 
 def star_loopheader(*args):
     """
@@ -198,16 +1239,8 @@ def read_star_body(star_file):
                     line.startswith('#')):
                 body_lines.append(line)
 
-        n_cols = len(body_lines[0].split())
-        body = [[] for _ in range(n_cols)]
-
-        for line in body_lines:
-            data = line.split()
-            for idx, col in enumerate(data):
-                try:
-                    body[idx].append(float(col))
-                except:
-                    body[idx].append(col)
+        rows = [line.split() for line in body_lines]
+        body = [convert_column(values) for values in zip(*rows)]
     return body
 
 
@@ -267,9 +1300,7 @@ def clean_data_block(star_data_block):
     :return: StarDict
     """
     logging.info('Cleaning data blocks from multi block star file')
-    known_data_blocks = ['data_', 'data_fsc', 'data_guinier']
-
-    if star_data_block[0] in known_data_blocks:
+    if star_data_block[0].startswith('data_'):
         header = []
         for line in star_data_block:
             line = line.strip()
@@ -287,16 +1318,8 @@ def clean_data_block(star_data_block):
                     line.startswith('#')):
                 body_lines.append(line)
 
-        n_cols = len(body_lines[0].split())
-        body = [[] for _ in range(n_cols)]
-
-        for line in body_lines:
-            data = line.split()
-            for idx, col in enumerate(data):
-                try:
-                    body[idx].append(float(col))
-                except:
-                    body[idx].append(col)
+        rows = [line.split() for line in body_lines]
+        body = [convert_column(values) for values in zip(*rows)]
 
         return header, body
 
@@ -1,5 +1,9 @@
 from . import ctf
 from . import electron
 from . import euler_angles
+from . import neighbours
+from . import orientations
 from . import rotate3d
+from . import sampling
 from . import spatial_frequency
+from . import symmetry
@@ -1,9 +1,17 @@
 import logging
+from functools import lru_cache
 
 import numpy as np
 
 from . import rotate3d
 
+# plane (p, q) of each elementary rotation, in which R[p, p] = R[q, q] = cos, R[q, p] = sin and R[p, q] = -sin
+_ROTATION_PLANES = {'X': (1, 2), 'Y': (2, 0), 'Z': (0, 1)}
+
+# tolerance on |rm(3,3)| - 1 below which the first and third euler angles are indeterminate and the tilt is taken as
+# 0 or 180, the error in the rotation from doing so is about sqrt(2 * tolerance)
+_GIMBAL_LOCK_TOLERANCE = 1e-12
+
 
 class Conventions:
     """Known euler angle conventions for cryo-EM software"""
@@ -155,7 +163,7 @@ class Conversion:
 
         # Force euler angles to have correct format and shape (N,3) array, float
         # Calculate rotation matrices from euler angles
-        self.euler_angles = np.asarray(euler_angles, dtype=np.float).reshape((-1, 3))
+        self.euler_angles = np.asarray(euler_angles, dtype=np.float64).reshape((-1, 3))
         self.rotation_matrices = self.calculate_rotation_matrices()
 
         if target_software is not None:
@@ -164,9 +172,21 @@ class Conversion:
 
     def calculate_rotation_matrices(self):
         logging.debug('calculating rotation matrices from euler angles')
+        # Calculate rotation matrices for all euler triplets at once
+        rotation_matrices = calculate_rotation_matrices(self.euler_angles,
+                                                        euler_angle_axes=self.axes,
+                                                        intrinsic=self.intrinsic,
+                                                        extrinsic=self.extrinsic)
+
+        # Store/return
+        self.rotation_matrices = rotation_matrices
+        return self.rotation_matrices
+
+    def calculate_rotation_matrices_loop(self):
+        logging.debug('calculating rotation matrices from euler angles one euler triplet at a time')
         # Set up empty array for storage of rotation matrices
         n_rows = self.euler_angles.shape[0]
-        rotation_matrices = np.empty((n_rows, 3, 3), dtype=np.float)
+        rotation_matrices = np.empty((n_rows, 3, 3), dtype=np.float64)
 
         # Calculate rotation matrix for each euler triplet
         for idx, euler_triplet in enumerate(self.euler_angles):
@@ -180,15 +200,7 @@ class Conversion:
         return self.rotation_matrices
 
     def calculate_rotation_matrices_fast(self):
-        logging.debug('calculating rotation matrices from euler angles')
-        rotation_matrices = np.apply_along_axis(calculate_rotation_matrix,
-                                                axis=1,
-                                                arr=self.euler_angles,
-                                                euler_angle_axes=self.axes,
-                                                intrinsic=self.intrinsic,
-                                                extrinsic=self.extrinsic)
-        self.rotation_matrices = rotation_matrices
-        return self.rotation_matrices
+        return self.calculate_rotation_matrices()
 
     def transpose_rotation_matrices(self):
         logging.debug("""transposing (N,3,3) matrix to give (N,3,3) matrix where each 3,3 matrix is the transpose of
@@ -198,8 +210,6 @@ class Conversion:
 
     def angles_from_rotation_matrices(self, target_axes_convention, intrinsic=None, extrinsic=None):
         logging.debug(f'calculating {target_axes_convention} euler angles from stored rotation matrices')
-        n_rows = self.rotation_matrices.shape[0]
-        euler_angles = np.empty((n_rows, 3))
 
         if intrinsic is None and extrinsic is None:
             logging.debug("defaulting to generating euler angles as intrinsic")
@@ -218,21 +228,19 @@ class Conversion:
             logging.debug('angles will be generated as extrinsic')
             intrinsic = False
             extrinsic = True
-    
-        for idx, rotation_matrix in enumerate(self.rotation_matrices):
-            if target_axes_convention.upper() == 'ZXZ':
-                euler_angles[idx] = matrix2ZXZeuler(rotation_matrix,
-                                                    intrinsic=intrinsic,
-                                                    extrinsic=extrinsic)
-                self.intrinsic = intrinsic
-                self.extrinsic = extrinsic
-
-            elif target_axes_convention.upper() == 'ZYZ':
-                euler_angles[idx] = matrix2ZYZeuler(rotation_matrix,
-                                                    intrinsic=intrinsic,
-                                                    extrinsic=extrinsic)
-            else:
-                logging.warning(f'conversion for {target_axes_convention} not yet supported!')
+
+        if target_axes_convention.upper() == 'ZXZ':
+            euler_angles = matrices2ZXZeuler(self.rotation_matrices, intrinsic=intrinsic, extrinsic=extrinsic)
+            self.intrinsic = intrinsic
+            self.extrinsic = extrinsic
+
+        elif target_axes_convention.upper() == 'ZYZ':
+            euler_angles = matrices2ZYZeuler(self.rotation_matrices, intrinsic=intrinsic, extrinsic=extrinsic)
+
+        else:
+            logging.warning(f'conversion for {target_axes_convention} not yet supported!')
+            return self.euler_angles
+
         self.euler_angles = euler_angles
         return self.euler_angles
 
@@ -268,19 +276,124 @@ class Conversion:
         message = f'converting euler angles from {self.axes} : {self.reference_frame} to {target_axes} : {target_reference_frame}'
         logging.info(message)
 
+        # the rotation matrices are transposed at most once and euler angles are calculated from them once
+        converted = False
         if self.reference_frame != target_reference_frame:
-            self.change_reference_frame()
-
-        if self.axes != target_axes:
-            self.change_axes(target_axes)
+            self.transpose_rotation_matrices()
+            self.reference_frame = target_reference_frame
+            converted = True
 
-        if self.intrinsic != target_intrinsic or self.extrinsic != target_extrinsic:
-            self.calculate_rotation_matrices()
+        if converted or self.axes != target_axes or self.intrinsic != target_intrinsic:
             self.angles_from_rotation_matrices(target_axes, target_intrinsic, target_extrinsic)
+            self.axes = target_axes
+            self.intrinsic = target_intrinsic
+            self.extrinsic = target_extrinsic
 
         return self.euler_angles
 
 
+class ConversionPlan:
+    """
+    Conversion of euler angles between two conventions, derived once for each pair of conventions (see conversion_plan)
+    rather than for every set of euler angles converted.
+
+    For the proper euler angles of the known software conventions, 'ZXZ' and 'ZYZ', a conversion is a closed-form
+    mapping of each angle: rotations about Y are rotations about X conjugated by a 90 degree rotation about Z and a
+    change of reference frame (transposition) maps angles (a, b, c) applied in that order to (180 - c, b, 180 - a).
+    Other conventions are converted through rotation matrices: one batched matrix calculation, an optional
+    transposition and one batched calculation of euler angles
+    """
+
+    def __init__(self, source_convention, target_convention):
+        """
+        :param source_convention: (axes, reference_frame, intrinsic, extrinsic) as in Conventions
+        :param target_convention: (axes, reference_frame, intrinsic, extrinsic) as in Conventions
+        """
+        self.source_axes, self.source_reference_frame, self.source_intrinsic, _ = source_convention
+        self.target_axes, self.target_reference_frame, self.target_intrinsic, _ = target_convention
+        self.source_axes = self.source_axes.upper()
+        self.target_axes = self.target_axes.upper()
+
+        self.transpose = self.source_reference_frame.lower() != self.target_reference_frame.lower()
+        self.identity = (not self.transpose and self.source_axes == self.target_axes
+                         and self.source_intrinsic == self.target_intrinsic)
+        self.mapping = self.closed_form_mapping()
+        logging.debug(f'derived conversion plan from {source_convention} to {target_convention}')
+
+    def closed_form_mapping(self):
+        """
+        derives the mapping of each target angle from the source angles, target = sign * source[index] + offset
+        :return: list of (index, sign, offset) for each target angle or None if the conventions are not both 'ZXZ' or
+                 'ZYZ'
+        """
+        if self.source_axes not in ('ZXZ', 'ZYZ') or self.target_axes not in ('ZXZ', 'ZYZ'):
+            return None
+
+        # source angles in order of application, R = Rz(last) R(middle) Rz(first)
+        first, middle, last = [(idx, 1, 0) for idx in range(3)]
+        if not self.source_intrinsic:
+            first, last = last, first
+
+        # Ry(b) = Rz(90) Rx(b) Rz(-90)
+        if self.source_axes == 'ZYZ':
+            first, last = _shift_angle(first, -90), _shift_angle(last, 90)
+
+        # transpose(Rz(c) Rx(b) Rz(a)) = Rz(-a) Rx(-b) Rz(-c) = Rz(180 - a) Rx(b) Rz(180 - c)
+        if self.transpose:
+            first, last = _shift_angle(_negate_angle(last), 180), _shift_angle(_negate_angle(first), 180)
+
+        if self.target_axes == 'ZYZ':
+            first, last = _shift_angle(first, 90), _shift_angle(last, -90)
+
+        if not self.target_intrinsic:
+            first, last = last, first
+        return [first, middle, last]
+
+    def apply(self, euler_angles):
+        """
+        converts euler angles from the source to the target convention
+        first and third angles are wrapped into (-180, 180], the second angle is not changed by closed-form mappings
+        :param euler_angles: (N,3) numpy array of euler angles in degrees
+        :return: (N,3) numpy array of euler angles in degrees
+        """
+        euler_angles = np.asarray(euler_angles, dtype=np.float64).reshape((-1, 3))
+        if self.identity:
+            return euler_angles.copy()
+        if self.mapping is None:
+            return self.apply_matrices(euler_angles)
+
+        converted = np.empty_like(euler_angles)
+        for target_idx, (source_idx, sign, offset) in enumerate(self.mapping):
+            converted[:, target_idx] = euler_angles[:, source_idx] * sign + offset
+        converted[:, [0, 2]] = 180 - np.mod(180 - converted[:, [0, 2]], 360)
+        return converted
+
+    def apply_matrices(self, euler_angles):
+        """
+        converts euler angles from the source to the target convention through their rotation matrices
+        :param euler_angles: (N,3) numpy array of euler angles in degrees
+        :return: (N,3) numpy array of euler angles in degrees
+        """
+        rotation_matrices = calculate_rotation_matrices(euler_angles, self.source_axes,
+                                                        intrinsic=self.source_intrinsic,
+                                                        extrinsic=not self.source_intrinsic)
+        if self.transpose:
+            rotation_matrices = np.transpose(rotation_matrices, (0, 2, 1))
+
+        return matrices2euler(rotation_matrices, self.target_axes, intrinsic=self.target_intrinsic,
+                              extrinsic=not self.target_intrinsic)
+
+
+def _shift_angle(angle, offset):
+    index, sign, angle_offset = angle
+    return index, sign, angle_offset + offset
+
+
+def _negate_angle(angle):
+    index, sign, offset = angle
+    return index, -sign, -offset
+
+
 # General functions
 def calculate_rotation_matrix(euler_triplet, euler_angle_axes, intrinsic=True, extrinsic=None):
     """
@@ -323,6 +436,93 @@ def calculate_rotation_matrix(euler_triplet, euler_angle_axes, intrinsic=True, e
     return rotation_matrix_final
 
 
+def calculate_rotation_matrices(euler_angles, euler_angle_axes, intrinsic=True, extrinsic=None):
+    """
+    calculates rotation matrices for many euler triplets at once, giving the same result as calculate_rotation_matrix
+    on each triplet up to rounding. Matrices are multiplied in the same order as in calculate_rotation_matrix, each product with an
+    elementary rotation only mixes two columns so is computed on whole columns rather than matrix by matrix
+    :param euler_angles: (N,3) numpy array of euler angles in degrees
+    :param euler_angle_axes: str of format 'XYZ' or similar for rotation about X, Y, then Z
+    :return: (N,3,3) numpy array of rotation matrices, a view of a (3,3,N) array so that each element is contiguous
+    """
+    logging.debug(f'calculating rotation matrices from {euler_angle_axes} euler angles')
+    # Check that intrinsic and extrinsic are not the same
+    if extrinsic and intrinsic:
+        intrinsic = False
+        logging.debug('extrinsic rotation was explicitly set to True so performing extrinsic rotations')
+
+    elif extrinsic is None and intrinsic:
+        extrinsic = False
+        logging.debug('defaulting to intrinsic rotations')
+
+    axes = euler_angle_axes.upper()
+    for axis in axes:
+        if axis not in _ROTATION_PLANES:
+            raise ValueError(f'axis {axis} not XYZ so not supported')
+
+    # angles are transposed so that each angle, and each matrix element below, is a contiguous (N,) array
+    euler_angles_radians = np.deg2rad(np.asarray(euler_angles, dtype=np.float64).reshape((-1, 3)).T.copy())
+    cos_angles = np.cos(euler_angles_radians)
+    sin_angles = np.sin(euler_angles_radians)
+
+    # intrinsic: R = R3 @ R2 @ R1, extrinsic: R = R1 @ R2 @ R3, evaluated left to right
+    order = [0, 1, 2] if extrinsic and not intrinsic else [2, 1, 0]
+
+    # matrix elements which are exactly 0 or 1 are held as python scalars so that products with them are skipped
+    first = order[0]
+    p, q = _ROTATION_PLANES[axes[first]]
+    elements = [[0, 0, 0], [0, 0, 0], [0, 0, 0]]
+    elements[3 - p - q][3 - p - q] = 1
+    elements[p][p] = elements[q][q] = cos_angles[first]
+    elements[q][p] = sin_angles[first]
+    elements[p][q] = -sin_angles[first]
+
+    # elements are stored contiguously, the (N,3,3) array returned is a view of the (3,3,N) array of elements
+    rotation_matrices = np.empty((3, 3, euler_angles_radians.shape[1]), dtype=np.float64)
+
+    # right multiplication by each further elementary rotation mixes columns p and q, the last one is written
+    # straight into the output
+    for idx in order[1:]:
+        p, q = _ROTATION_PLANES[axes[idx]]
+        cos_angle = cos_angles[idx]
+        sin_angle = sin_angles[idx]
+        minus_sin_angle = -sin_angle
+        last = idx == order[-1]
+        for i, row in enumerate(elements):
+            row[p], row[q] = (_mix_elements(row[p], cos_angle, row[q], sin_angle,
+                                            out=rotation_matrices[i, p] if last else None),
+                              _mix_elements(row[q], cos_angle, row[p], minus_sin_angle,
+                                            out=rotation_matrices[i, q] if last else None))
+
+    k = 3 - p - q
+    for i in range(3):
+        rotation_matrices[i, k] = elements[i][k]
+
+    return rotation_matrices.transpose((2, 0, 1))
+
+
+def _mix_elements(a, cos_angle, b, sin_angle, out=None):
+    """
+    a * cos_angle + b * sin_angle for matrix elements a and b which are (N,) arrays or the scalars 0 and 1
+    :return: (N,) array, written into out if given, or the scalar 0
+    """
+    terms = [(element, factor) for element, factor in ((a, cos_angle), (b, sin_angle))
+             if isinstance(element, np.ndarray) or element == 1]
+    if len(terms) == 0 and out is None:
+        return 0
+
+    if out is None:
+        out = np.empty_like(cos_angle)
+    if len(terms) == 0:
+        out[...] = 0
+        return out
+
+    np.multiply(terms[0][0], terms[0][1], out=out)
+    for element, factor in terms[1:]:
+        out += element * factor
+    return out
+
+
 def matrix2ZXZeuler(rotation_matrix, intrinsic=True, extrinsic=None):
     """
     Converts rotation matrix ([3,3] numpy array) into ZXZ euler angles (in degrees)
@@ -339,14 +539,14 @@ def matrix2ZXZeuler(rotation_matrix, intrinsic=True, extrinsic=None):
         logging.debug('ZXZ euler angles output will be extrinsic, i.e. rotations of points not axes')
 
     # Set a tolerance because of indetermination in defining narot and tdrot
-    tolerance = 1e-4
+    tolerance = _GIMBAL_LOCK_TOLERANCE
 
     # Check special cases
     # rm(3,3) = +1
     if np.absolute(rotation_matrix[2, 2] - 1) < tolerance:
         tdrot = 0
         tilt = 0
-        narot = np.rad2deg(np.arctan2(rotation_matrix[1, 0], rotation_matrix[2, 2]))
+        narot = np.rad2deg(np.arctan2(rotation_matrix[1, 0], rotation_matrix[0, 0]))
 
     # rm(3,3) = -1
     elif np.absolute(rotation_matrix[2, 2] + 1) < tolerance:
@@ -361,10 +561,10 @@ def matrix2ZXZeuler(rotation_matrix, intrinsic=True, extrinsic=None):
         narot = np.rad2deg(np.arctan2(rotation_matrix[0, 2], -rotation_matrix[1, 2]))
 
     if intrinsic and not extrinsic:
-        ZXZeuler = np.array([tdrot, tilt, narot], dtype=np.float)
+        ZXZeuler = np.array([tdrot, tilt, narot], dtype=np.float64)
 
     elif extrinsic and not intrinsic:
-        ZXZeuler = np.array([narot, tilt, tdrot], dtype=np.float)
+        ZXZeuler = np.array([narot, tilt, tdrot], dtype=np.float64)
 
     return ZXZeuler
 
@@ -381,7 +581,7 @@ def matrix2ZYZeuler(rotation_matrix, intrinsic=True, extrinsic=None):
 
 
     # Set a tolerance because of indetermination in defining narot and tdrot
-    tolerance = 1e-4
+    tolerance = _GIMBAL_LOCK_TOLERANCE
 
     # Check special cases
     # rm(3,3) = -1
@@ -397,14 +597,15 @@ def matrix2ZYZeuler(rotation_matrix, intrinsic=True, extrinsic=None):
     # R(1,2) = sin(a)cos(c)-cos(a)sin(c) = sin(a-c)
     # R(2,1) = sin(a)cos(c)-cos(a)sin(c) = sin(a-c)
     # R(2,2) = sin(c)sin(a)+cos(c)cos(a) = cos(c-a)
+    # with narot (c) = 0, tdrot (a) = atan2(R(2,1), R(2,2)) for both b = 0 and b = pi
     if np.absolute(rotation_matrix[2, 2] + 1) < tolerance:
-        tdrot = -np.arctan2(rotation_matrix[1, 0], rotation_matrix[1, 1])
+        tdrot = np.rad2deg(np.arctan2(rotation_matrix[1, 0], rotation_matrix[1, 1]))
         tilt = 180
         narot = 0
 
 
     elif np.absolute(rotation_matrix[2, 2] - 1) < tolerance:
-        tdrot = np.arctan2(rotation_matrix[1, 0], rotation_matrix[1, 1])
+        tdrot = np.rad2deg(np.arctan2(rotation_matrix[1, 0], rotation_matrix[1, 1]))
         tilt = 0
         narot = 0
 
@@ -416,14 +617,143 @@ def matrix2ZYZeuler(rotation_matrix, intrinsic=True, extrinsic=None):
         narot = np.rad2deg(np.arctan2(rotation_matrix[1, 2], rotation_matrix[0, 2]))
 
     if intrinsic and not extrinsic:
-        ZYZeuler = np.array([tdrot, tilt, narot], dtype=np.float)
+        ZYZeuler = np.array([tdrot, tilt, narot], dtype=np.float64)
 
     elif extrinsic and not intrinsic:
-        ZYZeuler = np.array([narot, tilt, tdrot], dtype=np.float)
+        ZYZeuler = np.array([narot, tilt, tdrot], dtype=np.float64)
 
     return ZYZeuler
 
 
+def matrices2ZXZeuler(rotation_matrices, intrinsic=True, extrinsic=None):
+    """
+    Converts rotation matrices into ZXZ euler angles (in degrees), giving the same result as matrix2ZXZeuler on each
+    matrix. Special cases where rm(3,3) = +/-1 are selected with masks rather than branches
+    :param rotation_matrices: (N,3,3) numpy array
+    :return: (N,3) numpy array of euler angles in degrees
+    """
+    logging.debug('calculating ZXZ euler angles from rotation matrices')
+    intrinsic, extrinsic = _intrinsic_extrinsic(intrinsic, extrinsic)
+    rotation_matrices = np.asarray(rotation_matrices, dtype=np.float64).reshape((-1, 3, 3))
+    special = _gimbal_lock(rotation_matrices)
+
+    # general case, angles of special cases are then overwritten
+    tdrot = np.rad2deg(np.arctan2(rotation_matrices[:, 2, 0], rotation_matrices[:, 2, 1]))
+    tilt = np.rad2deg(np.arccos(np.clip(rotation_matrices[:, 2, 2], -1, 1)))
+    narot = np.rad2deg(np.arctan2(rotation_matrices[:, 0, 2], -rotation_matrices[:, 1, 2]))
+
+    # rm(3,3) = +/-1, tdrot = 0
+    if np.any(special):
+        tdrot[special] = 0
+        tilt[special] = np.where(rotation_matrices[special, 2, 2] > 0, 0, 180)
+        narot[special] = np.rad2deg(np.arctan2(rotation_matrices[special, 1, 0], rotation_matrices[special, 0, 0]))
+
+    if extrinsic and not intrinsic:
+        return np.column_stack((narot, tilt, tdrot))
+    return np.column_stack((tdrot, tilt, narot))
+
+
+def matrices2ZYZeuler(rotation_matrices, intrinsic=True, extrinsic=None):
+    """
+    Converts rotation matrices into ZYZ euler angles (in degrees), giving the same result as matrix2ZYZeuler on each
+    matrix. Special cases where rm(3,3) = +/-1 are selected with masks rather than branches
+    :param rotation_matrices: (N,3,3) numpy array
+    :return: (N,3) numpy array of euler angles in degrees
+    """
+    logging.debug('calculating ZYZ euler angles from rotation matrices')
+    intrinsic, extrinsic = _intrinsic_extrinsic(intrinsic, extrinsic)
+    rotation_matrices = np.asarray(rotation_matrices, dtype=np.float64).reshape((-1, 3, 3))
+    special = _gimbal_lock(rotation_matrices)
+
+    # general case, angles of special cases are then overwritten
+    tdrot = np.rad2deg(np.arctan2(rotation_matrices[:, 2, 1], -rotation_matrices[:, 2, 0]))
+    tilt = np.rad2deg(np.arccos(np.clip(rotation_matrices[:, 2, 2], -1, 1)))
+    narot = np.rad2deg(np.arctan2(rotation_matrices[:, 1, 2], rotation_matrices[:, 0, 2]))
+
+    # rm(3,3) = +/-1, narot = 0
+    if np.any(special):
+        tdrot[special] = np.rad2deg(np.arctan2(rotation_matrices[special, 1, 0], rotation_matrices[special, 1, 1]))
+        tilt[special] = np.where(rotation_matrices[special, 2, 2] > 0, 0, 180)
+        narot[special] = 0
+
+    if extrinsic and not intrinsic:
+        return np.column_stack((narot, tilt, tdrot))
+    return np.column_stack((tdrot, tilt, narot))
+
+
+def matrices2euler(rotation_matrices, euler_angle_axes, intrinsic=True, extrinsic=None):
+    """
+    Converts rotation matrices into euler angles (in degrees) about the given axes, see matrices2ZXZeuler
+    :param rotation_matrices: (N,3,3) numpy array
+    :param euler_angle_axes: 'ZXZ' or 'ZYZ'
+    :return: (N,3) numpy array of euler angles in degrees
+    """
+    if euler_angle_axes.upper() == 'ZXZ':
+        return matrices2ZXZeuler(rotation_matrices, intrinsic=intrinsic, extrinsic=extrinsic)
+    elif euler_angle_axes.upper() == 'ZYZ':
+        return matrices2ZYZeuler(rotation_matrices, intrinsic=intrinsic, extrinsic=extrinsic)
+    raise ValueError(f'conversion for {euler_angle_axes} not yet supported!')
+
+
+def _intrinsic_extrinsic(intrinsic=True, extrinsic=None):
+    """
+    resolves intrinsic and extrinsic flags as in matrix2ZXZeuler, extrinsic takes precedence if both are set
+    """
+    if intrinsic and extrinsic is None:
+        extrinsic = False
+    if extrinsic and intrinsic:
+        intrinsic = False
+    return intrinsic, extrinsic
+
+
+def _gimbal_lock(rotation_matrices, tolerance=_GIMBAL_LOCK_TOLERANCE):
+    """
+    (N,) boolean mask of rotation matrices with rm(3,3) = +/-1 within tolerance, where the first and third euler
+    angles are indeterminate
+    """
+    return np.absolute(np.absolute(rotation_matrices[:, 2, 2]) - 1) < tolerance
+
+
+def conversion_plan(from_software, target_software):
+    """
+    conversion plan between the euler angle conventions of two software packages, derived once and cached
+    :param from_software: 'relion', 'dynamo' or 'emclarity'
+    :param target_software: 'relion', 'dynamo' or 'emclarity'
+    :return: ConversionPlan
+    """
+    return _conversion_plan(from_software.lower(), target_software.lower())
+
+
+@lru_cache(maxsize=None)
+def _conversion_plan(from_software, target_software):
+    return ConversionPlan(software_convention(from_software), software_convention(target_software))
+
+
+def software_convention(software):
+    """
+    euler angle convention of a software package, see Conventions
+    :param software: 'relion', 'dynamo' or 'emclarity'
+    :return: axes, reference_frame, intrinsic, extrinsic
+    """
+    conventions = Conventions()
+    euler_angle_conventions = {'relion': conventions.relion,
+                               'dynamo': conventions.dynamo,
+                               'emclarity': conventions.emclarity,
+                               }
+    return euler_angle_conventions[software.lower()]
+
+
+def convert_euler_angles(euler_angles, from_software, target_software):
+    """
+    Converts (N,3) numpy array of euler angles between the conventions of two software packages
+    :param euler_angles: (N,3) numpy array of euler angles in degrees
+    :param from_software: 'relion', 'dynamo' or 'emclarity'
+    :param target_software: 'relion', 'dynamo' or 'emclarity'
+    :return: (N,3) numpy array of euler angles in degrees
+    """
+    return conversion_plan(from_software, target_software).apply(euler_angles)
+
+
 def relion2dynamo(euler_angles_relion):
     """
     Converts (N,3) numpy array of relion euler angles (rot, tilt, psi) to dynamo format (tdrot, tilt, narot)
@@ -431,8 +761,7 @@ def relion2dynamo(euler_angles_relion):
     :type euler_angles_relion: (N,3) numpy array
     :return: euler_angles_dynamo: (N,3) numpy array containing dynamo format euler angles
     """
-    angle_conversion = Conversion(euler_angles_relion, from_software='relion')
-    euler_angles_dynamo = angle_conversion.to_software('dynamo')
+    euler_angles_dynamo = convert_euler_angles(euler_angles_relion, 'relion', 'dynamo')
 
     return euler_angles_dynamo
 
@@ -444,7 +773,6 @@ def dynamo2relion(euler_angles_dynamo):
     :type euler_angles_dynamo: (N,3) numpy array
     :return: euler_angles_relion: (N,3) numpy array containing dynamo format euler angles
     """
-    angle_conversion = Conversion(euler_angles_dynamo, from_software='dynamo')
-    euler_angles_relion = angle_conversion.to_software('relion')
+    euler_angles_relion = convert_euler_angles(euler_angles_dynamo, 'dynamo', 'relion')
 
     return euler_angles_relion
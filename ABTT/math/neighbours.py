@@ -0,0 +1,90 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+
+def neighbour_pairs(xyz, groups=None, max_distance=1, min_distance=0, workers=1):
+    """
+    finds all pairs of points in the same group with min_distance <= distance < max_distance
+    pairs are found with a kd-tree per group, memory scales with the number of pairs rather than the square of the
+    number of points
+    :param xyz: (N, 3) numpy array of positions
+    :param groups: (N,) numpy array of group labels, e.g. tomogram indices or micrograph names, points in different
+                   groups are never neighbours. None for a single group
+    :param max_distance: maximum distance below which points are considered neighbours
+    :param min_distance: minimum distance above which points are considered neighbours
+    :param workers: number of processes between which groups are shared, None for the number of cpus
+    :return: pairs, distances: (M, 2) numpy array of indices i < j of neighbouring points and (M,) numpy array of
+             their distances
+    """
+    xyz = np.asarray(xyz)
+    if groups is None:
+        group_rows = [np.arange(len(xyz))]
+    else:
+        group_labels, inverse = np.unique(groups, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        group_rows = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(group_labels)))[:-1])
+
+    group_xyz = [xyz[rows] for rows in group_rows]
+    logging.debug(f'finding neighbours within {max_distance} in {len(group_rows)} groups')
+
+    if workers == 1:
+        group_pairs = [kdtree_pairs(points, max_distance) for points in group_xyz]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            group_pairs = list(executor.map(kdtree_pairs, group_xyz, [max_distance] * len(group_xyz)))
+
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    pairs.extend(rows[local_pairs] for rows, local_pairs in zip(group_rows, group_pairs))
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    distances = np.linalg.norm(xyz[pairs[:, 0]] - xyz[pairs[:, 1]], axis=1)
+
+    in_range = (distances >= min_distance) & (distances < max_distance)
+    return pairs[in_range], distances[in_range]
+
+
+def kdtree_pairs(xyz, max_distance):
+    """
+    finds all pairs of points closer than max_distance with a kd-tree
+    :param xyz: (N, 3) numpy array of positions
+    :param max_distance: maximum distance
+    :return: (M, 2) numpy array of indices i < j into xyz
+    """
+    tree = cKDTree(xyz)
+    return tree.query_pairs(max_distance, output_type='ndarray')
+
+
+def suppress_neighbours(pairs, n_points, scores=None):
+    """
+    selects points by greedy suppression: points are visited from the highest score down and each is kept unless it
+    is connected to a point which was already kept. Unlike clustering through chains of connected points, points are
+    only ever removed by a direct neighbour, so dense arrangements of points keep every point that is not a duplicate
+    :param pairs: (M, 2) numpy array of indices of connected points, see neighbour_pairs
+    :param n_points: total number of points
+    :param scores: (N,) numpy array of scores, None to visit points in order
+    :return: (N,) boolean numpy array, True for the kept points, including every unconnected point
+    """
+    pairs = np.asarray(pairs).reshape((-1, 2))
+    rows = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    columns = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    adjacency = csr_matrix((np.ones(len(rows), dtype=bool), (rows, columns)), shape=(n_points, n_points))
+
+    # ties between scores are broken by the position of the point
+    sort_keys = [np.arange(n_points)]
+    if scores is not None:
+        sort_keys.append(-np.asarray(scores))
+    order = np.lexsort(sort_keys)
+
+    # unconnected points are kept without being visited, each connected point is visited once
+    connected = np.diff(adjacency.indptr) > 0
+    kept = (~connected).tolist()
+    indptr = adjacency.indptr.tolist()
+    indices = adjacency.indices.tolist()
+    for point in order[connected[order]].tolist():
+        if not any(kept[neighbour] for neighbour in indices[indptr[point]:indptr[point + 1]]):
+            kept[point] = True
+
+    return np.array(kept, dtype=bool)
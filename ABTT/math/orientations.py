@@ -0,0 +1,245 @@
+import logging
+
+import numpy as np
+
+from . import euler_angles as euler
+
+# index of each rotation axis in the vector part of a quaternion
+_AXES = {'X': 0, 'Y': 1, 'Z': 2}
+
+
+class Orientations:
+    """
+    A compact store of N orientations as unit quaternions (w, x, y, z), 16 or 32 bytes per orientation rather than the
+    72 bytes of a float64 rotation matrix.
+
+    Orientations are held in the 'rotate_reference' reference frame, the frame of RELION and Dynamo euler angles.
+    The rotation matrix of an orientation is that of calculate_rotation_matrices for the euler angles of the software
+    package, transposed for software packages rotating the particle such as emClarity.
+    """
+
+    def __init__(self, quaternions, dtype=np.float64):
+        """
+        :param quaternions: (N,4) numpy array of quaternions (w, x, y, z), normalised on instantiation
+        :param dtype: np.float32 or np.float64
+        """
+        quaternions = np.asarray(quaternions, dtype=dtype).reshape((-1, 4))
+        self.quaternions = quaternions / np.linalg.norm(quaternions, axis=1)[:, np.newaxis]
+
+    def __len__(self):
+        return self.quaternions.shape[0]
+
+    def __getitem__(self, selection):
+        return Orientations(self.quaternions[selection], dtype=self.dtype)
+
+    def __mul__(self, other):
+        return self.compose(other)
+
+    @property
+    def dtype(self):
+        return self.quaternions.dtype
+
+    @classmethod
+    def from_euler_angles(cls, euler_angles, software, dtype=np.float64):
+        """
+        orientations from the euler angles of a software package, see Conventions
+        :param euler_angles: (N,3) numpy array of euler angles in degrees
+        :param software: 'relion', 'dynamo' or 'emclarity'
+        :param dtype: np.float32 or np.float64
+        :return: Orientations
+        """
+        logging.debug(f'calculating quaternions from {software} euler angles')
+        axes, reference_frame, intrinsic, extrinsic = euler.software_convention(software)
+        quaternions = quaternions_from_euler_angles(euler_angles, axes, intrinsic=intrinsic, extrinsic=extrinsic)
+        if reference_frame == 'rotate_particle':
+            quaternions = conjugate(quaternions)
+        return cls(quaternions, dtype=dtype)
+
+    @classmethod
+    def from_rotation_matrices(cls, rotation_matrices, dtype=np.float64):
+        """
+        :param rotation_matrices: (N,3,3) numpy array of rotation matrices in the 'rotate_reference' frame
+        :param dtype: np.float32 or np.float64
+        :return: Orientations
+        """
+        return cls(quaternions_from_rotation_matrices(rotation_matrices), dtype=dtype)
+
+    def to_euler_angles(self, software):
+        """
+        euler angles of a software package describing these orientations, see Conventions
+        :param software: 'relion', 'dynamo' or 'emclarity'
+        :return: (N,3) numpy array of euler angles in degrees
+        """
+        logging.debug(f'calculating {software} euler angles from quaternions')
+        axes, reference_frame, intrinsic, extrinsic = euler.software_convention(software)
+        quaternions = self.quaternions.astype(np.float64)
+        if reference_frame == 'rotate_particle':
+            quaternions = conjugate(quaternions)
+        return euler.matrices2euler(rotation_matrices_from_quaternions(quaternions), axes,
+                                    intrinsic=intrinsic, extrinsic=extrinsic)
+
+    def to_rotation_matrices(self):
+        """
+        :return: (N,3,3) numpy array of rotation matrices in the 'rotate_reference' frame
+        """
+        return rotation_matrices_from_quaternions(self.quaternions)
+
+    def compose(self, other):
+        """
+        composition of two sets of orientations, self.compose(other) rotates by other then by self, as the product of
+        their rotation matrices self @ other. One set may contain a single orientation, which is applied to all
+        :param other: Orientations
+        :return: Orientations
+        """
+        return Orientations(multiply(self.quaternions, other.quaternions), dtype=self.dtype)
+
+    def inverse(self):
+        """
+        :return: Orientations of the inverse rotations
+        """
+        return Orientations(conjugate(self.quaternions), dtype=self.dtype)
+
+    def apply(self, vectors):
+        """
+        rotates vectors, as the product of the rotation matrices with the vectors R @ v
+        :param vectors: (N,3) numpy array of vectors, or (3,) for one vector rotated by every orientation
+        :return: (N,3) numpy array of rotated vectors
+        """
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        w = self.quaternions[:, :1]
+        xyz = self.quaternions[:, 1:]
+        # v' = v + 2w (u x v) + 2u x (u x v) for the quaternion (w, u)
+        t = 2 * np.cross(xyz, vectors)
+        return vectors + w * t + np.cross(xyz, t)
+
+    def slerp(self, other, fraction):
+        """
+        spherical linear interpolation between two sets of orientations, along the shortest path for each
+        :param other: Orientations
+        :param fraction: fraction of the way from self to other, a scalar or (N,) numpy array
+        :return: Orientations
+        """
+        q0 = self.quaternions
+        q1 = np.broadcast_to(other.quaternions, np.broadcast_shapes(q0.shape, other.quaternions.shape))
+        fraction = np.asarray(fraction, dtype=self.dtype).reshape((-1, 1))
+
+        # q and -q are the same rotation, the shortest path is between quaternions with a positive dot product
+        dot = np.sum(q0 * q1, axis=1, keepdims=True)
+        q1 = np.where(dot < 0, -q1, q1)
+        dot = np.clip(np.abs(dot), 0, 1)
+
+        angle = np.arccos(dot)
+        sin_angle = np.sin(angle)
+        # close orientations are interpolated linearly, the result is normalised on instantiation
+        close = sin_angle < 1e-6
+        safe_sin_angle = np.where(close, 1, sin_angle)
+        weight0 = np.where(close, 1 - fraction, np.sin((1 - fraction) * angle) / safe_sin_angle)
+        weight1 = np.where(close, fraction, np.sin(fraction * angle) / safe_sin_angle)
+        return Orientations(weight0 * q0 + weight1 * q1, dtype=self.dtype)
+
+
+def multiply(q1, q2):
+    """
+    Hamilton product of quaternions, the quaternion of the rotation matrix R1 @ R2
+    :param q1: (N,4) or (4,) numpy array of quaternions (w, x, y, z)
+    :param q2: (N,4) or (4,) numpy array of quaternions (w, x, y, z)
+    :return: (N,4) numpy array
+    """
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(q1).reshape((-1, 4)), 1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(q2).reshape((-1, 4)), 1, 0)
+    return np.column_stack((w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                            w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                            w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                            w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2))
+
+
+def conjugate(quaternions):
+    """
+    :param quaternions: (N,4) numpy array of quaternions (w, x, y, z)
+    :return: (N,4) numpy array of conjugate quaternions, the inverse rotations of unit quaternions
+    """
+    return quaternions * np.array([1, -1, -1, -1], dtype=quaternions.dtype)
+
+
+def quaternions_from_euler_angles(euler_angles, euler_angle_axes, intrinsic=True, extrinsic=None):
+    """
+    quaternions of the rotation matrices given by calculate_rotation_matrices, as products of the quaternions of
+    rotations about each axis
+    :param euler_angles: (N,3) numpy array of euler angles in degrees
+    :param euler_angle_axes: str of format 'XYZ' or similar for rotation about X, Y, then Z
+    :return: (N,4) numpy array of quaternions (w, x, y, z)
+    """
+    intrinsic, extrinsic = euler._intrinsic_extrinsic(intrinsic, extrinsic)
+    half_angles = np.deg2rad(np.asarray(euler_angles, dtype=np.float64).reshape((-1, 3))) / 2
+
+    axis_quaternions = []
+    for idx, axis in enumerate(euler_angle_axes.upper()):
+        if axis not in _AXES:
+            raise ValueError(f'axis {axis} not XYZ so not supported')
+        quaternions = np.zeros((half_angles.shape[0], 4))
+        quaternions[:, 0] = np.cos(half_angles[:, idx])
+        quaternions[:, 1 + _AXES[axis]] = np.sin(half_angles[:, idx])
+        axis_quaternions.append(quaternions)
+
+    # intrinsic: R = R3 @ R2 @ R1, extrinsic: R = R1 @ R2 @ R3
+    if extrinsic and not intrinsic:
+        return multiply(multiply(axis_quaternions[0], axis_quaternions[1]), axis_quaternions[2])
+    return multiply(multiply(axis_quaternions[2], axis_quaternions[1]), axis_quaternions[0])
+
+
+def rotation_matrices_from_quaternions(quaternions):
+    """
+    :param quaternions: (N,4) numpy array of unit quaternions (w, x, y, z)
+    :return: (N,3,3) numpy array of rotation matrices
+    """
+    w, x, y, z = np.moveaxis(np.asarray(quaternions).reshape((-1, 4)), 1, 0)
+    rotation_matrices = np.empty((w.shape[0], 3, 3), dtype=w.dtype)
+    rotation_matrices[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    rotation_matrices[:, 0, 1] = 2 * (x * y - w * z)
+    rotation_matrices[:, 0, 2] = 2 * (x * z + w * y)
+    rotation_matrices[:, 1, 0] = 2 * (x * y + w * z)
+    rotation_matrices[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    rotation_matrices[:, 1, 2] = 2 * (y * z - w * x)
+    rotation_matrices[:, 2, 0] = 2 * (x * z - w * y)
+    rotation_matrices[:, 2, 1] = 2 * (y * z + w * x)
+    rotation_matrices[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return rotation_matrices
+
+
+def quaternions_from_rotation_matrices(rotation_matrices):
+    """
+    quaternions of rotation matrices, with w >= 0. Each quaternion is calculated from its largest component for
+    numerical stability (Shepperd's method)
+    :param rotation_matrices: (N,3,3) numpy array of rotation matrices
+    :return: (N,4) numpy array of unit quaternions (w, x, y, z)
+    """
+    r = np.asarray(rotation_matrices, dtype=np.float64).reshape((-1, 3, 3))
+    diagonal = np.stack((r[:, 0, 0], r[:, 1, 1], r[:, 2, 2]), axis=1)
+    # 4 * component ** 2 for w, x, y and z
+    squares = np.column_stack((1 + diagonal.sum(axis=1),
+                               1 + diagonal[:, 0] - diagonal[:, 1] - diagonal[:, 2],
+                               1 - diagonal[:, 0] + diagonal[:, 1] - diagonal[:, 2],
+                               1 - diagonal[:, 0] - diagonal[:, 1] + diagonal[:, 2]))
+    largest = np.argmax(squares, axis=1)
+
+    # sums and differences of off diagonal elements, 4 * product of two components
+    wx = r[:, 2, 1] - r[:, 1, 2]
+    wy = r[:, 0, 2] - r[:, 2, 0]
+    wz = r[:, 1, 0] - r[:, 0, 1]
+    xy = r[:, 0, 1] + r[:, 1, 0]
+    xz = r[:, 0, 2] + r[:, 2, 0]
+    yz = r[:, 1, 2] + r[:, 2, 1]
+    products = [np.column_stack(columns) for columns in ((squares[:, 0], wx, wy, wz),
+                                                        (wx, squares[:, 1], xy, xz),
+                                                        (wy, xy, squares[:, 2], yz),
+                                                        (wz, xz, yz, squares[:, 3]))]
+
+    quaternions = np.empty((r.shape[0], 4))
+    for component in range(4):
+        selected = largest == component
+        # 4 * component = 2 * sqrt(4 * component ** 2)
+        scale = 2 * np.sqrt(squares[selected, component])
+        quaternions[selected] = products[component][selected] / scale[:, np.newaxis]
+
+    quaternions /= np.linalg.norm(quaternions, axis=1)[:, np.newaxis]
+    return np.where(quaternions[:, :1] < 0, -quaternions, quaternions)
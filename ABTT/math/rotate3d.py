@@ -17,7 +17,7 @@ def rotate_x(theta):
     rotation_matrix = np.array([[1, 0, 0],
                                 [0, cos_theta, -sin_theta],
                                 [0, sin_theta, cos_theta]],
-                               dtype=np.float)
+                               dtype=np.float64)
 
     return rotation_matrix
 
@@ -36,7 +36,7 @@ def rotate_y(theta):
     rotation_matrix = np.array([[cos_theta, 0, sin_theta],
                                 [0, 1, 0],
                                 [-sin_theta, 0, cos_theta]],
-                               dtype=np.float)
+                               dtype=np.float64)
 
     return rotation_matrix
 
@@ -55,7 +55,7 @@ def rotate_z(theta):
     rotation_matrix = np.array([[cos_theta, -sin_theta, 0],
                                 [sin_theta, cos_theta, 0],
                                 [0, 0, 1]],
-                               dtype=np.float)
+                               dtype=np.float64)
 
     return rotation_matrix
 
@@ -0,0 +1,129 @@
+import logging
+import os
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+
+from . import symmetry as point_groups
+from .orientations import Orientations
+from .._cache_dir import CACHE_DIR
+
+# version of the grid generation, part of the name of cached grids so that grids from older versions are not reused
+_GRID_VERSION = 1
+
+# number of view directions whose in-plane rotations are generated at once
+_DIRECTIONS_PER_CHUNK = 4096
+
+# angle between successive points of a fibonacci lattice on the sphere
+_GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+
+
+def orientation_grid(step, symmetry='C1', software='relion', cone=None, prior=None, cache_dir=None):
+    """
+    near-uniform sampling of orientations with a given angular step, e.g. for angular searches.
+    View directions are spread uniformly over the sphere on a fibonacci lattice with spacing close to step and are
+    combined with in-plane rotations every step degrees, a uniform sampling of each factor of the uniform measure
+    on rotations.
+
+    Grids are reduced by symmetry to the orientations q for which q is the smallest of the symmetry equivalent
+    rotations q S, see symmetry.closest_operators. With a cone, only orientations within cone degrees of the prior
+    are kept, the grid is rotated so that it contains the identity and is then rotated onto the prior.
+
+    Grids are memoized in memory and stored as .npy files in cache_dir, by step, symmetry, cone and software
+    :param step: angular step in degrees
+    :param symmetry: 'Cn', 'Dn', 'T', 'O' or 'I', see symmetry.symmetry_operators
+    :param software: 'relion', 'dynamo' or 'emclarity', convention of the euler angles returned
+    :param cone: maximum angle in degrees from the prior, None for all orientations
+    :param prior: euler angles of the prior orientation in the convention of software, None for the identity
+    :param cache_dir: directory in which grids are stored, defaults to orientation_grids in the ABTT cache directory
+    :return: (M,3) contiguous numpy array of euler angles in degrees, read-only if prior is None
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(CACHE_DIR, 'orientation_grids')
+    grid = _cached_grid(float(step), symmetry.upper(), software.lower(), None if cone is None else float(cone),
+                        cache_dir)
+    if prior is None:
+        return grid
+
+    prior = Orientations.from_euler_angles(prior, software)
+    return np.ascontiguousarray((prior * Orientations.from_euler_angles(grid, software)).to_euler_angles(software))
+
+
+@lru_cache(maxsize=32)
+def _cached_grid(step, symmetry, software, cone, cache_dir):
+    # repr gives the shortest string which reads back as the same float, so that distinct steps never share a file
+    cone_name = 'all' if cone is None else repr(cone)
+    grid_file = os.path.join(cache_dir, f'v{_GRID_VERSION}_{software}_{symmetry}_step{step!r}_cone{cone_name}.npy')
+    if os.path.exists(grid_file):
+        logging.info(f'loading orientation grid from {grid_file}')
+        grid = np.load(grid_file)
+    else:
+        grid = np.ascontiguousarray(generate_grid(step, symmetry, cone).to_euler_angles(software))
+        os.makedirs(cache_dir, exist_ok=True)
+        # written to a temporary file of its own first, so that a partially written grid is never loaded and
+        # processes generating the same grid do not write to the same file
+        descriptor, partial = tempfile.mkstemp(prefix=f'.{os.path.basename(grid_file)}.', dir=cache_dir)
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                np.save(file, grid, allow_pickle=False)
+            os.replace(partial, grid_file)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        logging.info(f'stored orientation grid in {grid_file}')
+
+    grid.flags.writeable = False
+    return grid
+
+
+def generate_grid(step, symmetry='C1', cone=None):
+    """
+    generates the orientations of orientation_grid around the identity, without caching
+    :param step: angular step in degrees
+    :param symmetry: 'Cn', 'Dn', 'T', 'O' or 'I', see symmetry.symmetry_operators
+    :param cone: maximum angle in degrees from the identity, None for all orientations. Grids with a cone are
+                 rotated so that they contain the identity
+    :return: Orientations
+    """
+    step_radians = np.deg2rad(step)
+    n_directions = max(1, int(round(4 * np.pi / step_radians ** 2)))
+    n_in_plane = max(1, int(round(360 / step)))
+    in_plane = np.arange(n_in_plane) * 360 / n_in_plane
+
+    # the tilt of the view direction is never larger than the angle of the rotation, directions are generated from
+    # the pole only as far as the cone, with a margin of one step for centering the grid on the identity
+    last_direction = n_directions
+    if cone is not None and cone + step < 180:
+        margin = np.cos(np.deg2rad(cone + step))
+        last_direction = min(n_directions, int(np.ceil(n_directions * (1 - margin) / 2)) + 1)
+    logging.info(f'generating orientation grid with {step} degree step from {last_direction} view directions and '
+                 f'{n_in_plane} in-plane rotations')
+
+    quaternions = []
+    for start in range(0, last_direction, _DIRECTIONS_PER_CHUNK):
+        directions = np.arange(start, min(start + _DIRECTIONS_PER_CHUNK, last_direction))
+        rot = np.rad2deg(np.mod(directions * _GOLDEN_ANGLE, 2 * np.pi))
+        tilt = np.rad2deg(np.arccos(1 - (2 * directions + 1) / n_directions))
+
+        euler_angles = np.column_stack((np.repeat(rot, n_in_plane),
+                                        np.repeat(tilt, n_in_plane),
+                                        np.tile(in_plane, len(directions))))
+        chunk = Orientations.from_euler_angles(euler_angles, 'relion').quaternions
+
+        # |w| = cos(angle / 2)
+        if cone is not None:
+            chunk = chunk[np.abs(chunk[:, 0]) >= np.cos(np.deg2rad(min(cone + step, 180)) / 2)]
+        else:
+            chunk = chunk[point_groups.closest_operators(chunk, symmetry) == 0]
+        quaternions.append(chunk)
+    quaternions = np.concatenate(quaternions)
+
+    if cone is not None:
+        # the grid is rotated so that the orientation closest to the identity becomes the identity
+        closest = quaternions[np.argmax(np.abs(quaternions[:, 0]))]
+        quaternions = (Orientations(closest).inverse() * Orientations(quaternions)).quaternions
+        quaternions = quaternions[np.abs(quaternions[:, 0]) >= np.cos(np.deg2rad(cone) / 2)]
+        quaternions = quaternions[point_groups.closest_operators(quaternions, symmetry) == 0]
+
+    return Orientations(quaternions)
@@ -0,0 +1,137 @@
+import logging
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from .orientations import Orientations, conjugate, multiply
+
+# maximum number of elements of the (N, n_operators) array of quaternion products held at once
+_CHUNK_ELEMENTS = 2 ** 24
+
+# golden ratio, the icosahedral 5-fold axes lie along (0, +/-1, +/-golden ratio) and its permutations
+_GOLDEN_RATIO = (1 + np.sqrt(5)) / 2
+
+
+def symmetry_operators(symmetry):
+    """
+    rotations of a point group as Orientations
+    Cn: n-fold axis along Z
+    Dn: n-fold axis along Z, 2-fold axis along X
+    T: 2-fold axes along X, Y and Z, 3-fold axes along (+/-1, +/-1, +/-1)
+    O: 4-fold axes along X, Y and Z, 3-fold axes along (+/-1, +/-1, +/-1)
+    I: 2-fold axes along X, Y and Z, 5-fold axes along (0, +/-1, +/-golden ratio) and cyclic permutations
+    :param symmetry: 'Cn', 'Dn', 'T', 'O' or 'I', e.g. 'C2' or 'd6'
+    :return: Orientations, the first of which is the identity
+    """
+    return Orientations(_symmetry_quaternions(symmetry.upper()))
+
+
+@lru_cache(maxsize=None)
+def _symmetry_quaternions(symmetry):
+    match = re.fullmatch(r'([CD])(\d+)', symmetry)
+    if match is not None and int(match.group(2)) > 0:
+        n = int(match.group(2))
+        generators = [_axis_angle_quaternion([0, 0, 1], 360 / n)]
+        if match.group(1) == 'D':
+            generators.append(_axis_angle_quaternion([1, 0, 0], 180))
+    elif symmetry == 'T':
+        generators = [_axis_angle_quaternion([0, 0, 1], 180), _axis_angle_quaternion([1, 1, 1], 120)]
+    elif symmetry == 'O':
+        generators = [_axis_angle_quaternion([0, 0, 1], 90), _axis_angle_quaternion([1, 1, 1], 120)]
+    elif symmetry == 'I':
+        generators = [_axis_angle_quaternion([0, 0, 1], 180), _axis_angle_quaternion([1, 1, 1], 120),
+                      _axis_angle_quaternion([0, 1, _GOLDEN_RATIO], 72)]
+    else:
+        raise ValueError(f'symmetry {symmetry} not supported, expected Cn, Dn, T, O or I')
+
+    quaternions = _group_closure(generators)
+    logging.debug(f'generated {len(quaternions)} symmetry operators for {symmetry} symmetry')
+    quaternions.flags.writeable = False
+    return quaternions
+
+
+def _axis_angle_quaternion(axis, angle):
+    """
+    quaternion of a rotation by angle (degrees) about axis
+    """
+    axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    half_angle = np.deg2rad(angle) / 2
+    return np.concatenate(([np.cos(half_angle)], np.sin(half_angle) * axis))
+
+
+def _group_closure(generators, tolerance=1e-6):
+    """
+    all products of generators, q and -q are the same rotation so only one of them is kept
+    :return: (M,4) numpy array of quaternions with w >= 0, starting with the identity
+    """
+    group = [np.array([1.0, 0, 0, 0])]
+    new = list(group)
+    while len(new) > 0:
+        products = np.concatenate([multiply(np.array(new), generator) for generator in generators])
+        new = []
+        for quaternion in products:
+            if np.max(np.abs(np.array(group) @ quaternion)) < 1 - tolerance:
+                group.append(quaternion)
+                new.append(quaternion)
+
+    group = np.array(group)
+    return np.where(group[:, :1] < 0, -group, group)
+
+
+def closest_operators(quaternions, symmetry):
+    """
+    finds the symmetry operator S for which each rotation q S is the smallest rotation, the rotations for which this
+    is the identity form the asymmetric unit of the point group around the identity.
+    The scalar part w of q S is the dot product of q with conj(S) and the angle of q S is 2 arccos(|w|), so every
+    operator is compared with one matrix product for each chunk of rotations
+    :param quaternions: (N,4) numpy array of quaternions (w, x, y, z)
+    :param symmetry: 'Cn', 'Dn', 'T', 'O' or 'I', see symmetry_operators
+    :return: (N,) numpy array of indices into symmetry_operators(symmetry)
+    """
+    operators = _symmetry_quaternions(symmetry.upper())
+    closest = np.empty(quaternions.shape[0], dtype=int)
+    chunk_size = max(1, _CHUNK_ELEMENTS // len(operators))
+    for start in range(0, quaternions.shape[0], chunk_size):
+        w = quaternions[start:start + chunk_size] @ conjugate(operators).T
+        closest[start:start + chunk_size] = np.argmax(np.abs(w), axis=1)
+    return closest
+
+
+def orientation_distance(orientations_a, orientations_b, symmetry='C1'):
+    """
+    minimum angle of the rotations between two sets of orientations over the rotations of a point group.
+    Orientations a and b @ S are equivalent for every symmetry operator S, as a symmetric reference rotated by either
+    is the same. The closest operator is found with closest_operators
+    :param orientations_a: Orientations
+    :param orientations_b: Orientations, the same number as orientations_a or a single orientation
+    :param symmetry: 'Cn', 'Dn', 'T', 'O' or 'I', see symmetry_operators
+    :return: (N,) numpy array of angles in degrees, from 0 to 180
+    """
+    operators = _symmetry_quaternions(symmetry.upper())
+    # rotation from a to b, r = conj(a) b
+    relative = multiply(conjugate(orientations_a.quaternions.astype(np.float64)),
+                        orientations_b.quaternions.astype(np.float64))
+
+    # the angle of the closest rotation is calculated from all its components for precision at small angles
+    closest = multiply(relative, operators[closest_operators(relative, symmetry)])
+    angle = 2 * np.arctan2(np.linalg.norm(closest[:, 1:], axis=1), np.abs(closest[:, 0]))
+    return np.rad2deg(angle)
+
+
+def angular_distance(euler_angles_a, euler_angles_b, software='relion', symmetry='C1', software_b=None):
+    """
+    minimum angle between the orientations described by two sets of euler angles over the rotations of a point group,
+    see orientation_distance. e.g. to check convergence between two iterations of a refinement with C2 symmetry
+    :param euler_angles_a: (N,3) numpy array of euler angles in degrees
+    :param euler_angles_b: (N,3) numpy array of euler angles in degrees
+    :param software: 'relion', 'dynamo' or 'emclarity', convention of euler_angles_a
+    :param symmetry: 'Cn', 'Dn', 'T', 'O' or 'I', see symmetry_operators
+    :param software_b: convention of euler_angles_b, defaults to software
+    :return: (N,) numpy array of angles in degrees, from 0 to 180
+    """
+    if software_b is None:
+        software_b = software
+    orientations_a = Orientations.from_euler_angles(euler_angles_a, software)
+    orientations_b = Orientations.from_euler_angles(euler_angles_b, software_b)
+    return orientation_distance(orientations_a, orientations_b, symmetry)
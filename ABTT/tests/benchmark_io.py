@@ -0,0 +1,184 @@
+import os
+import tempfile
+import timeit
+
+import numpy as np
+
+from ABTT.io.dynamo import DynamoTable, table_read
+from ABTT.io.star import StarDict
+
+
+def write_star_rowwise(star_dict, file):
+    """reference implementation of StarDict.write, formatting every element of every row in python"""
+    header = star_dict.loopheader()
+    body = []
+    nrows = star_dict.nrows()
+    for row in range(nrows):
+        current_row = []
+        for column_name in star_dict.headings():
+            element = star_dict[column_name][row]
+
+            if any(_ in column_name.lower() for _ in ('coordinate',
+                                                    'angle',
+                                                    'apix',
+                                                    'pixel',
+                                                    'magnification')):
+                element = f'{element:>12.5f}'
+
+            elif any(_ in column_name.lower() for _ in ('tag',
+                                                        'idx')):
+                element = f'{element:>.0f}'
+
+            current_row.append(f'{element}\t')
+
+        current_row.append('\n')
+        body.append(' '.join(current_row))
+
+    with open(file, 'w') as file:
+        for line in header:
+            file.write(line)
+        for line in body:
+            file.write(line)
+
+
+def random_star_dict(n):
+    star_dict = StarDict()
+    star_dict['dynParticleTag'] = np.arange(n) + 1
+    for axis in 'XYZ':
+        star_dict[f'rlnCoordinate{axis}'] = np.random.random(n) * 1000
+    for angle in ('Rot', 'Tilt', 'Psi'):
+        star_dict[f'rlnAngle{angle}'] = np.random.random(n) * 360 - 180
+    star_dict['rlnMicrographName'] = np.array([f'tomo_{idx:03d}.mrc' for idx in np.random.randint(0, 100, n)])
+    star_dict['rlnDetectorPixelSize'] = np.ones(n) * 4.472
+    star_dict['rlnCtfMaxResolution'] = np.random.random(n) * 10
+    return star_dict
+
+
+def write_table_savetxt(table, file):
+    """reference implementation of DynamoTable.write, filling a dense (N, 41) array for np.savetxt"""
+    keys = [key for key in table if key in table.convention]
+    data = np.zeros((len(table[keys[0]]), 41))
+    for key in keys:
+        data[:, table.convention[key] - 1] = table[key]
+
+    format = ['%.4f' for _ in range(41)]
+    format[0] = '%d'
+    np.savetxt(file, data, delimiter=' \t', fmt=format)
+
+
+def random_table_data(n, n_columns=35):
+    data = np.random.random((n, n_columns)) * 360 - 180
+    data[:, 0] = np.arange(n) + 1
+    data[:, 19] = np.random.randint(1, 100, n)
+    # columns which are constant in typical tables, e.g. tilt range, filter type and pixel size
+    data[:, [1, 2, 11, 12, 15, 16, 17, 18, 20, 22, 26, 27, 28, 29, 30, 31, 32]] = 0
+    data[:, [13, 14]] = [-60, 60]
+    return data
+
+
+def benchmark_star_write(n):
+    star_dict = random_star_dict(n)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_rowwise = os.path.join(directory, 'rowwise.star')
+        file_columnwise = os.path.join(directory, 'columnwise.star')
+
+        start_time = timeit.default_timer()
+        write_star_rowwise(star_dict, file_rowwise)
+        rowwise_time = timeit.default_timer() - start_time
+
+        start_time = timeit.default_timer()
+        star_dict.write(file_columnwise)
+        columnwise_time = timeit.default_timer() - start_time
+
+        with open(file_rowwise, 'rb') as file:
+            rowwise_bytes = file.read()
+        with open(file_columnwise, 'rb') as file:
+            columnwise_bytes = file.read()
+
+    print(f'star write, {n} rows')
+    print(f'row-wise time: {rowwise_time}')
+    print(f'column-wise time: {columnwise_time}')
+    print(f'column-wise is {rowwise_time / columnwise_time} faster')
+    print(f'Output files are identical?: {rowwise_bytes == columnwise_bytes}')
+
+
+def benchmark_table_read(n):
+    data = random_table_data(n)
+
+    with tempfile.TemporaryDirectory() as directory:
+        table_file = os.path.join(directory, 'table.tbl')
+        np.savetxt(table_file, data, fmt='%.5f')
+        size = os.path.getsize(table_file) / 2 ** 20
+
+        start_time = timeit.default_timer()
+        reference = np.loadtxt(table_file)
+        loadtxt_time = timeit.default_timer() - start_time
+
+        start_time = timeit.default_timer()
+        table = table_read(table_file)
+        read_time = timeit.default_timer() - start_time
+
+        start_time = timeit.default_timer()
+        table_float32 = table_read(table_file, float_dtype=np.float32)
+        float32_time = timeit.default_timer() - start_time
+
+        start_time = timeit.default_timer()
+        table_subset = table_read(table_file, columns=['tag', 'x', 'y', 'z', 'tomo'])
+        subset_time = timeit.default_timer() - start_time
+
+    print(f'dynamo table read, {n} rows, {size:.0f} MB')
+    print(f'np.loadtxt time: {loadtxt_time} ({size / loadtxt_time:.0f} MB/s)')
+    print(f'table_read time: {read_time} ({size / read_time:.0f} MB/s)')
+    print(f'table_read float32 time: {float32_time}')
+    print(f'table_read 5 columns time: {subset_time}')
+    print(f'table_read time relative to np.loadtxt: {read_time / loadtxt_time}, same parser from numpy 1.23')
+    print(f'Results are identical?: {np.array_equal(reference, table.data)}')
+    print(f'float64 memory: {table.data.nbytes / 2 ** 20:.0f} MB, '
+          f'float32 memory: {table_float32.data.nbytes / 2 ** 20:.0f} MB, '
+          f'5 columns memory: {table_subset.data.nbytes / 2 ** 20:.0f} MB')
+
+
+def benchmark_table_write(n):
+    data = random_table_data(n)
+    table = DynamoTable()
+    for key, column_idx in table.convention.items():
+        if column_idx <= data.shape[1]:
+            table[key] = data[:, column_idx - 1]
+
+    sparse_table = DynamoTable()
+    for key in ('tag', 'aligned_value', 'averaged_value', 'x', 'y', 'z', 'tdrot', 'tilt', 'narot', 'tomo'):
+        sparse_table[key] = table[key]
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = []
+        for name, current_table in (('full', table), ('10 column', sparse_table)):
+            file_savetxt = os.path.join(directory, 'savetxt.tbl')
+            file_chunked = os.path.join(directory, 'chunked.tbl')
+
+            start_time = timeit.default_timer()
+            write_table_savetxt(current_table, file_savetxt)
+            savetxt_time = timeit.default_timer() - start_time
+
+            start_time = timeit.default_timer()
+            current_table.write(file_chunked)
+            chunked_time = timeit.default_timer() - start_time
+
+            with open(file_savetxt, 'rb') as file:
+                savetxt_bytes = file.read()
+            with open(file_chunked, 'rb') as file:
+                chunked_bytes = file.read()
+            results.append((name, savetxt_time, chunked_time, savetxt_bytes == chunked_bytes))
+
+    print(f'dynamo table write, {n} rows')
+    for name, savetxt_time, chunked_time, identical in results:
+        print(f'{name} table, np.savetxt time: {savetxt_time}')
+        print(f'{name} table, DynamoTable.write time: {chunked_time}')
+        print(f'{name} table, DynamoTable.write is {savetxt_time / chunked_time} faster')
+        print(f'{name} table, Output files are identical?: {identical}')
+
+
+if __name__ == '__main__':
+    benchmark_star_write(200000)
+    benchmark_table_read(1000000)
+    benchmark_table_write(1000000)
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
@@ -7,6 +9,23 @@ from Bio import PDB
 import ABTT.io
 
 
+def distance_to_tomogram_centre(table):
+    xyz = table['xyz']
+    return np.linalg.norm(xyz - xyz.mean(axis=0), axis=1)
+
+
+def custom_score(table):
+    return table['score'] * table['tomo']
+
+
+def column_dtypes(table):
+    return {key: table[key].dtype for key in table}
+
+
+def first_particles(table):
+    return table.subtable(slice(0, 2), view=True)
+
+
 class StarDictTest(unittest.TestCase):
 
     def test_headings(self):
@@ -26,8 +45,29 @@ class StarDictTest(unittest.TestCase):
     def test_write(self):
         star_file = 'example_data/io/example.star'
         star_dict = ABTT.io.star.read(star_file)
-        out_file = 'example_data/io/example_rewrite.star'
-        star_dict.write(out_file)
+        with tempfile.TemporaryDirectory() as directory:
+            out_file = os.path.join(directory, 'example_rewrite.star')
+            star_dict.write(out_file)
+
+    def test_write_format(self):
+        star_file = 'example_data/io/example.star'
+        star_dict = ABTT.io.star.read(star_file)
+        with tempfile.TemporaryDirectory() as directory:
+            out_file = os.path.join(directory, 'example_rewrite.star')
+            star_dict.write(out_file)
+            with open(out_file) as file:
+                written = file.read()
+        with open('example_data/io/example_rewrite.star') as file:
+            reference = file.read()
+        self.assertTrue(written == reference)
+
+    def test_write_unequal_columns(self):
+        star_dict = ABTT.io.star.StarDict()
+        star_dict['rlnA'] = np.arange(5)
+        star_dict['rlnB'] = np.arange(2)
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaisesRegex(ValueError, 'rlnB'):
+                star_dict.write(os.path.join(directory, 'unequal.star'))
 
     def test_data_loop_start_indices(self):
         star_file = 'example_data/fsc/postprocess.star'
@@ -41,6 +81,314 @@ class StarDictTest(unittest.TestCase):
     def test_read_relion_postprocess(self):
         star_file = 'example_data/fsc/postprocess.star'
         star_dicts = ABTT.io.star.read(star_file)
+        self.assertTrue(list(star_dicts.keys()) == ['data_general', 'data_fsc', 'data_guinier'])
+        self.assertTrue(star_dicts['data_general']['rlnFinalResolution'] == 2.845333)
+        self.assertTrue(star_dicts['data_fsc'].nrows() == 121)
+
+    def test_index_blocks(self):
+        star_file = 'example_data/fsc/postprocess.star'
+        index = ABTT.io.star.index_blocks(star_file)
+        self.assertTrue(list(index.keys()) == ['data_general', 'data_fsc', 'data_guinier'])
+        with open(star_file, 'rb') as file:
+            for block_name, offset in index.items():
+                file.seek(offset)
+                self.assertTrue(file.readline().strip().decode() == block_name)
+
+    def test_read_block(self):
+        star_file = 'example_data/fsc/postprocess.star'
+        star_dicts = ABTT.io.star.read(star_file)
+        star_dict = ABTT.io.star.read(star_file, block='data_guinier')
+        self.assertTrue(star_dict.headings() == star_dicts['data_guinier'].headings())
+        np.testing.assert_array_equal(star_dict['rlnResolutionSquared'],
+                                      star_dicts['data_guinier']['rlnResolutionSquared'])
+
+    def test_write_blocks(self):
+        star_file = 'example_data/fsc/postprocess.star'
+        star_dicts = ABTT.io.star.read(star_file)
+        with tempfile.TemporaryDirectory() as directory:
+            out_file = os.path.join(directory, 'postprocess.star')
+            ABTT.io.star.write_blocks(star_dicts, out_file)
+            rewritten = ABTT.io.star.read(out_file)
+        self.assertTrue(rewritten['data_general'] == star_dicts['data_general'])
+        np.testing.assert_array_equal(rewritten['data_fsc']['rlnResolution'], star_dicts['data_fsc']['rlnResolution'])
+
+    def test_two_loops(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'two_loops.star')
+            with open(file, 'w') as star_file:
+                star_file.write('data_images\n\nloop_\n_rlnImageName #1\na.mrc\nb.mrc\n\n'
+                                'loop_\n_rlnDefocusU #1\n_rlnDefocusV #2\n1.0 2.0\n')
+            for read in (ABTT.io.star.read, lambda star_file: list(ABTT.io.star.iter_chunks(star_file))):
+                with self.assertRaisesRegex(ValueError, 'data_images'):
+                    read(file)
+
+    def test_scan_blocks(self):
+        star_file = 'example_data/fsc/postprocess.star'
+        blocks = list(ABTT.io.star.scan_blocks(star_file))
+        block_names = [block[0] for block in blocks]
+        self.assertTrue(block_names == ['data_general', 'data_fsc', 'data_guinier'])
+        block_name, headings, columns, header = blocks[1]
+        self.assertTrue(len(headings) == len(columns) == 7)
+        self.assertTrue(all(len(column) == len(columns[0]) for column in columns))
+
+    def test_column_types(self):
+        star_file = 'example_data/io/example.star'
+        star_dict = ABTT.io.star.read(star_file)
+        self.assertTrue(star_dict['dynParticleTag'].dtype == np.int64)
+        self.assertTrue(star_dict['rlnCoordinateX'].dtype == np.float64)
+        self.assertTrue(star_dict['rlnMicrographName'].dtype.kind == 'U')
+
+        star_dict = ABTT.io.star.read(star_file, float_dtype=np.float32)
+        self.assertTrue(star_dict['rlnCoordinateX'].dtype == np.float32)
+
+    def test_read_columns(self):
+        star_file = 'example_data/io/example.star'
+        columns = ['rlnCoordinateX', 'dynAngleTilt', 'rlnMicrographName']
+        star_dict = ABTT.io.star.read(star_file, columns=columns)
+        self.assertTrue(sorted(star_dict.headings()) == sorted(columns))
+        self.assertTrue(star_dict.nrows() == 7228)
+
+    def test_read_lazy(self):
+        star_file = 'example_data/io/example.star'
+        star_dict = ABTT.io.star.read(star_file, columns=['rlnCoordinateX'], lazy=True)
+        self.assertTrue(list(dict.keys(star_dict)) == ['rlnCoordinateX'])
+        self.assertTrue(len(star_dict.headings()) == 16)
+        self.assertTrue('rlnImageName' in star_dict)
+
+        # deferred columns are seen by every dict method
+        reference = ABTT.io.star.read(star_file)
+        self.assertTrue(list(star_dict) == star_dict.keys())
+        self.assertTrue(sorted(star_dict.keys()) == sorted(reference.headings()))
+        self.assertTrue(len(star_dict) == len(reference))
+        self.assertTrue(star_dict.get('rlnMissing') is None)
+        np.testing.assert_array_equal(star_dict.get('rlnImageName'), reference['rlnImageName'])
+        self.assertTrue('rlnImageName' in dict.keys(star_dict))
+        for heading, column in star_dict.items():
+            np.testing.assert_array_equal(column, reference[heading])
+        self.assertTrue(len(star_dict.deferred) == 0)
+
+        star_dict = ABTT.io.star.read(star_file, columns=['rlnCoordinateX'], lazy=True)
+        self.assertTrue('<deferred>' in repr(star_dict))
+        copied = star_dict.copy()
+        self.assertTrue(copied.keys() == star_dict.keys() and len(copied.deferred) == 15)
+        np.testing.assert_array_equal(copied['rlnImageName'], reference['rlnImageName'])
+        np.testing.assert_array_equal(star_dict.pop('rlnImageName'), reference['rlnImageName'])
+        del star_dict['rlnMicrographName']
+        star_dict['rlnCoordinateY'] = np.zeros(star_dict.nrows())
+        headings = [heading for heading in reference.headings()
+                    if heading not in ('rlnImageName', 'rlnMicrographName')]
+        self.assertTrue(sorted(star_dict.keys()) == sorted(headings))
+        self.assertTrue(np.all(star_dict['rlnCoordinateY'] == 0))
+        self.assertTrue(star_dict.pop('rlnImageName', None) is None)
+
+    def test_read_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            star_file = os.path.join(directory, 'example.star')
+            cache_dir = os.path.join(directory, 'cache')
+            shutil.copy('example_data/io/example.star', star_file)
+            reference = ABTT.io.star.read(star_file)
+
+            star_dict = ABTT.io.star.read(star_file, use_cache=True, cache_dir=cache_dir)
+            entry = ABTT.io.cache.entry_directory(star_file, cache_dir=cache_dir)
+            self.assertTrue(os.path.exists(os.path.join(entry, 'meta.json')))
+
+            cached = ABTT.io.star.read(star_file, use_cache=True, cache_dir=cache_dir)
+            for heading in reference:
+                np.testing.assert_array_equal(cached[heading], reference[heading])
+
+            mapped = ABTT.io.star.read(star_file, lazy=True, use_cache=True, cache_dir=cache_dir)
+            self.assertTrue(isinstance(mapped['rlnCoordinateX'], np.memmap))
+
+            with open(star_file, 'a') as file:
+                file.write('1 2 3 4 5 6 7 8 a b 9 10 11 12 c d\n')
+            updated = ABTT.io.star.read(star_file, use_cache=True, cache_dir=cache_dir)
+            self.assertTrue(updated.nrows() == reference.nrows() + 1)
+
+            # entries are moved into place complete, no partially written entry is left behind
+            self.assertTrue(os.listdir(cache_dir) == [os.path.basename(entry)])
+            ABTT.io.cache.store_blocks(star_file, list(ABTT.io.star.scan_blocks(star_file)), cache_dir=cache_dir)
+            self.assertTrue(os.listdir(cache_dir) == [os.path.basename(entry)])
+
+            ABTT.io.cache.evict(cache_dir, size_limit=0)
+            self.assertFalse(os.path.exists(entry))
+
+    def test_iter_chunks(self):
+        star_file = 'example_data/io/example.star'
+        reference = ABTT.io.star.read(star_file)
+        chunks = list(ABTT.io.star.iter_chunks(star_file, chunksize=1000))
+        self.assertTrue(len(chunks) == 8)
+        self.assertTrue(sum(chunk.nrows() for chunk in chunks) == reference.nrows())
+        np.testing.assert_array_equal(chunks[-1]['rlnImageName'], reference['rlnImageName'][7000:])
+
+        chunks = list(ABTT.io.star.iter_chunks('example_data/fsc/postprocess.star', block='data_guinier'))
+        self.assertTrue('rlnResolutionSquared' in chunks[0])
+
+        # data_general has no loop, the rows of the following block are not read
+        chunks = list(ABTT.io.star.iter_chunks('example_data/fsc/postprocess.star', block='data_general'))
+        self.assertTrue(len(chunks) == 0)
+
+    def test_star_writer(self):
+        star_file = 'example_data/io/example.star'
+        with tempfile.TemporaryDirectory() as directory:
+            out_file = os.path.join(directory, 'example_rewrite.star')
+            with ABTT.io.star.StarWriter(out_file) as writer:
+                for chunk in ABTT.io.star.iter_chunks(star_file, chunksize=1000):
+                    writer.write(chunk)
+            with open(out_file) as file:
+                written = file.read()
+        with open('example_data/io/example_rewrite.star') as file:
+            reference = file.read()
+        self.assertTrue(written == reference)
+
+        # later chunks must have the loop headings of the first, in the same order
+        chunk = next(ABTT.io.star.iter_chunks(star_file, chunksize=10, columns=['rlnCoordinateX', 'rlnCoordinateY']))
+        reordered = ABTT.io.star.StarDict()
+        reordered['rlnCoordinateY'] = chunk['rlnCoordinateY']
+        reordered['rlnCoordinateX'] = chunk['rlnCoordinateX']
+        extra = chunk.copy()
+        extra['rlnCoordinateZ'] = chunk['rlnCoordinateX']
+        with tempfile.TemporaryDirectory() as directory:
+            for other in (reordered, extra):
+                with ABTT.io.star.StarWriter(os.path.join(directory, 'chunks.star')) as writer:
+                    writer.write(chunk)
+                    with self.assertRaises(ValueError):
+                        writer.write(other)
+
+    def test_read_many(self):
+        star_files = ['example_data/io/example.star', 'example_data/io/example.star']
+        reference = ABTT.io.star.read(star_files[0])
+        star_dict = ABTT.io.star.read_many(star_files, workers=2)
+        self.assertTrue(star_dict.nrows() == 2 * reference.nrows())
+        np.testing.assert_array_equal(star_dict['rlnImageName'][reference.nrows():], reference['rlnImageName'])
+        np.testing.assert_array_equal(np.bincount(star_dict['sourceFileIdx']), [reference.nrows()] * 2)
+
+        serial = ABTT.io.star.read_many(star_files, workers=1, columns=['rlnCoordinateX'])
+        self.assertTrue(serial.headings() == ['rlnCoordinateX', 'sourceFileIdx'])
+
+        # a column read as integers from one file and as floats from another keeps float_dtype
+        with tempfile.TemporaryDirectory() as directory:
+            mixed_files = [os.path.join(directory, 'ints.star'), os.path.join(directory, 'floats.star')]
+            for file, values in zip(mixed_files, ('1\n2\n', '1.5\n')):
+                with open(file, 'w') as star_file:
+                    star_file.write(f'data_\n\nloop_\n_rlnA #1\n{values}')
+            star_dict = ABTT.io.star.read_many(mixed_files, workers=1, float_dtype=np.float32)
+        self.assertTrue(star_dict['rlnA'].dtype == np.float32)
+        np.testing.assert_array_equal(star_dict['rlnA'], [1, 2, 1.5])
+
+    def test_read_where(self):
+        file = 'example_data/io/example.star'
+        reference = ABTT.io.star.read(file)
+        micrographs = np.unique(reference['rlnMicrographName'])[:2]
+        threshold = np.median(reference['rlnCoordinateX'])
+        expected = np.isin(reference['rlnMicrographName'], micrographs) & (reference['rlnCoordinateX'] > threshold)
+
+        star_dict = ABTT.io.star.read(file, where=[('rlnMicrographName', 'in', micrographs),
+                                                   ('rlnCoordinateX', '>', threshold)])
+        self.assertTrue(star_dict.headings() == reference.headings())
+        for heading in reference.headings():
+            np.testing.assert_array_equal(star_dict[heading], reference[heading][expected])
+
+        projected = ABTT.io.star.read(file, columns=['rlnImageName'], where=('rlnCoordinateX', '>', threshold))
+        self.assertTrue(projected.headings() == ['rlnImageName'])
+        np.testing.assert_array_equal(projected['rlnImageName'],
+                                      reference['rlnImageName'][reference['rlnCoordinateX'] > threshold])
+
+        chunks = list(ABTT.io.star.iter_chunks(file, chunksize=7, where=('rlnCoordinateX', '>', threshold)))
+        self.assertTrue(sum(chunk.nrows() for chunk in chunks) == np.sum(reference['rlnCoordinateX'] > threshold))
+
+        with self.assertRaises(ValueError):
+            ABTT.io.star.read(file, lazy=True, where=('rlnCoordinateX', '>', threshold))
+
+        # a misspelled heading raises rather than selecting every row
+        misspelled = ('rlnCoordX', '>', threshold)
+        with self.assertRaises(KeyError):
+            ABTT.io.star.read(file, where=misspelled)
+        with self.assertRaises(KeyError):
+            list(ABTT.io.star.iter_chunks(file, where=misspelled))
+        with self.assertRaises(KeyError):
+            ABTT.io.star.read_many([file], workers=1, where=misspelled)
+        with self.assertRaises(KeyError):
+            ABTT.io.star.read('example_data/fsc/postprocess.star', block='data_fsc', where=misspelled)
+
+        # conditions on headings of one block only are ignored for the other blocks
+        blocks = ABTT.io.star.read('example_data/fsc/postprocess.star', where=('rlnResolutionSquared', '>', 0.01))
+        self.assertTrue(np.all(blocks['data_guinier']['rlnResolutionSquared'] > 0.01))
+        self.assertTrue(blocks['data_fsc'].nrows() == ABTT.io.star.read('example_data/fsc/postprocess.star',
+                                                                         block='data_fsc').nrows())
+
+    def test_remove_duplicates(self):
+        star_dict = ABTT.io.star.read('example_data/io/example.star')
+        nrows = star_dict.nrows()
+        duplicated = ABTT.io.star.StarDict()
+        for heading in star_dict.headings():
+            duplicated[heading] = np.concatenate((star_dict[heading], star_dict[heading]))
+        duplicated['rlnCoordinateX'][nrows:] += 0.5
+        duplicated['score'] = np.concatenate((np.zeros(nrows), np.ones(nrows)))
+
+        unique = duplicated.remove_duplicates(1, keep='score')
+        self.assertTrue(unique.nrows() == nrows)
+        np.testing.assert_array_equal(unique['rlnCoordinateX'], star_dict['rlnCoordinateX'] + 0.5)
+        np.testing.assert_array_equal(duplicated.remove_duplicates(1)['rlnImageName'], star_dict['rlnImageName'])
+
+        # key-value pairs are kept as they are
+        duplicated['rlnImagePixelSize'] = 4.47
+        unique = duplicated.remove_duplicates(1)
+        self.assertTrue(unique.nrows() == nrows)
+        self.assertTrue(unique['rlnImagePixelSize'] == 4.47)
+        self.assertTrue(duplicated.subset([0, 1])['rlnImagePixelSize'] == 4.47)
+
+    def test_mixed_column_types(self):
+        # a column which only parses as numbers in some chunks keeps the raw text of every value
+        values = ['007', '1e3', '12', '5', 'x1', '09', '2.50', '3']
+        rows_per_chunk = ABTT.io.star._ROWS_PER_CHUNK
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'mixed.star')
+            with open(file, 'w') as star_file:
+                star_file.write('data_\n\nloop_\n_rlnName #1\n_rlnIndex #2\n')
+                star_file.writelines(f'{value} {idx}\n' for idx, value in enumerate(values))
+
+            ABTT.io.star._ROWS_PER_CHUNK = 3
+            try:
+                star_dict = ABTT.io.star.read(file)
+                filtered = ABTT.io.star.read(file, where=('rlnIndex', '>', 0))
+            finally:
+                ABTT.io.star._ROWS_PER_CHUNK = rows_per_chunk
+            np.testing.assert_array_equal(star_dict['rlnName'], values)
+            self.assertTrue(star_dict['rlnIndex'].dtype == np.int64)
+            np.testing.assert_array_equal(filtered['rlnName'], values[1:])
+
+            chunks = list(ABTT.io.star.iter_chunks(file, chunksize=3, dtypes={'rlnName': str}))
+            np.testing.assert_array_equal(np.concatenate([chunk['rlnName'] for chunk in chunks]), values)
+            chunks = list(ABTT.io.star.iter_chunks(file, chunksize=3))
+            self.assertTrue(chunks[-1]['rlnName'].dtype.kind == 'U')
+
+            numeric_file = os.path.join(directory, 'numeric.star')
+            with open(numeric_file, 'w') as star_file:
+                star_file.write('data_\n\nloop_\n_rlnName #1\n_rlnIndex #2\n007 0\n')
+            star_dict = ABTT.io.star.read_many([numeric_file, file], workers=1)
+            np.testing.assert_array_equal(star_dict['rlnName'], ['007'] + values)
+
+    def test_mixed_numeric_chunks(self):
+        # a column which is integer valued in its first chunk and fractional in a later one keeps float_dtype
+        rows_per_chunk = ABTT.io.star._ROWS_PER_CHUNK
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'mixed.star')
+            with open(file, 'w') as star_file:
+                star_file.write('data_\n\nloop_\n_rlnCoordinateX #1\n')
+                star_file.writelines(f'{value}\n' for value in ('1', '2', '3', '4.5', '5'))
+
+            ABTT.io.star._ROWS_PER_CHUNK = 3
+            try:
+                star_dict = ABTT.io.star.read(file, float_dtype=np.float32)
+            finally:
+                ABTT.io.star._ROWS_PER_CHUNK = rows_per_chunk
+            self.assertTrue(star_dict['rlnCoordinateX'].dtype == np.float32)
+            np.testing.assert_array_equal(star_dict['rlnCoordinateX'], [1, 2, 3, 4.5, 5])
+
+    def test_convert_column(self):
+        self.assertTrue(ABTT.io.star.convert_column(('1', '2')).dtype == np.int64)
+        self.assertTrue(ABTT.io.star.convert_column(('1', '2.5')).dtype == np.float64)
+        self.assertTrue(ABTT.io.star.convert_column(('1', 'a.mrc')).dtype.kind == 'U')
 
 class MrcTest(unittest.TestCase):
 
@@ -133,4 +481,332 @@ class DynamoTableTest(unittest.TestCase):
 
     def test_write(self):
         table = self.test_read()
-        table.write('example_data/io/dynamotable_out.tbl')
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'dynamotable_out.tbl')
+            table.write(file)
+            with open(file, 'r') as table_file:
+                written = table_file.read()
+        with open('example_data/io/dynamotable_out.tbl', 'r') as table_file:
+            self.assertTrue(written == table_file.read())
+
+    def test_write_format(self):
+        table = ABTT.io.dynamo.DynamoTable()
+        table['tag'] = np.arange(3) + 1
+        table['x'] = np.array([1.5, 2.25, 3.125])
+        table['tomo'] = np.array([1, 1, 2])
+
+        reference = np.zeros((3, 41))
+        reference[:, 0] = table['tag']
+        reference[:, 23] = table['x']
+        reference[:, 19] = table['tomo']
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'dynamotable_out.tbl')
+            table.write(file)
+            np.testing.assert_array_equal(np.loadtxt(file), reference)
+            with open(file, 'r') as table_file:
+                self.assertTrue(table_file.readline().startswith('1 \t0.0000 \t0.0000 \t'))
+
+    def test_read_data(self):
+        file = 'example_data/io/dynamotable.tbl'
+        reference = np.loadtxt(file)
+        table = ABTT.io.dynamo.table_read(file)
+        np.testing.assert_array_equal(table.data, reference)
+        self.assertTrue(np.shares_memory(table['eulers'], table.data))
+        np.testing.assert_array_equal(table['xyz'], reference[:, 23:26] + reference[:, 3:6])
+
+        np.testing.assert_array_equal(table.get('xyz'), table['xyz'])
+        self.assertTrue(table.get('eulers') is not None and table.get('missing') is None)
+        self.assertTrue(ABTT.io.dynamo.DynamoTable().get('eulers', 0) == 0)
+        self.assertTrue('eulers' not in table and 'xyz' not in table)
+
+        subset = ABTT.io.dynamo.table_read(file, float_dtype=np.float32, columns=['tomo', 'x', 'y', 'z'])
+        self.assertTrue(list(subset.keys()) == ['tomo', 'x', 'y', 'z'])
+        self.assertTrue(subset.data.shape == (reference.shape[0], 4) and subset.data.flags.c_contiguous)
+        self.assertTrue(subset['x'].dtype == np.float32)
+        np.testing.assert_array_equal(subset['x'], reference[:, 23].astype(np.float32))
+
+    def test_subtable_views(self):
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl')
+        subtable = table.subtable(np.arange(10, 20), view=True)
+        self.assertTrue(np.shares_memory(subtable.data, table.data))
+        np.testing.assert_array_equal(subtable['x'], table['x'][10:20])
+        self.assertTrue(np.shares_memory(subtable['eulers'], table.data))
+
+        # subtables are copies by default, even of a contiguous range of rows
+        for selection in (np.arange(10, 20), np.arange(table.number_of_particles()) < 10, table['tag'] > 0):
+            subtable = table.subtable(selection)
+            self.assertFalse(np.shares_memory(subtable.data, table.data))
+            subtable['x'][:] = -1
+            self.assertFalse(np.any(table['x'] == -1))
+        self.assertFalse(np.shares_memory(table.averaged().data, table.data))
+        self.assertTrue(table.subtable(3)['x'] == table['x'][3])
+        for tomo_table in table.table_per_tomogram().values():
+            self.assertFalse(np.shares_memory(tomo_table.data, table.data))
+
+        shuffled = table.subtable(np.random.permutation(table.number_of_particles()))
+        self.assertFalse(np.shares_memory(shuffled.data, table.data))
+        for tomo_idx, tomo_table in shuffled.table_per_tomogram().items():
+            expected = shuffled['tomo'] == tomo_idx
+            self.assertTrue(np.shares_memory(tomo_table['x'], tomo_table.data))
+            for key in ('tag', 'x', 'tdrot'):
+                np.testing.assert_array_equal(tomo_table[key], shuffled[key][expected])
+
+        table = ABTT.io.dynamo.DynamoTable()
+        table['tag'] = np.arange(4) + 1
+        table['tomo'] = np.array([1, 1, 2, 2])
+        table.compact()
+        self.assertTrue(table.data.shape == (4, 2) and table.backed_keys() == ['tag', 'tomo'])
+        self.assertTrue(np.shares_memory(table.groupby('tomo').tables(view=True)[2]['tag'], table.data))
+        self.assertFalse(np.shares_memory(table.table_per_tomogram()[2]['tag'], table.data))
+
+    def test_neighbours_in_range(self):
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl')
+        xyz = table['xyz']
+        distances = np.linalg.norm(xyz[:, np.newaxis] - xyz[np.newaxis], axis=2)
+        same_tomogram = table['tomo'][:, np.newaxis] == table['tomo'][np.newaxis]
+        np.fill_diagonal(same_tomogram, False)
+        expected = np.sum((distances >= 20) & (distances < 60) & same_tomogram, axis=0)
+        np.testing.assert_array_equal(table.neighbours_in_range(20, 60), expected)
+
+        pairs, pair_distances = table.neighbour_list(60, 20)
+        self.assertTrue(np.all(pairs[:, 0] < pairs[:, 1]))
+        np.testing.assert_allclose(pair_distances, distances[pairs[:, 0], pairs[:, 1]])
+
+    def test_neighbourhood_analysis(self):
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl')
+        result, bin_centres, bin_minmax = table.neighbourhood_analysis(10, 100, 10)
+        self.assertTrue(result.shape == (table.number_of_particles(), 10))
+        for idx, (bin_minimum, bin_maximum) in enumerate(bin_minmax):
+            np.testing.assert_array_equal(result[:, idx], table.neighbours_in_range(bin_minimum, bin_maximum))
+
+        parallel_result, _, _ = table.neighbourhood_analysis(10, 100, 10, workers=2)
+        np.testing.assert_array_equal(parallel_result, result)
+
+    def test_groupby(self):
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl')
+        groups = table.groupby('ref')
+        np.testing.assert_array_equal(groups.keys, np.unique(table['ref']))
+        for idx, value in enumerate(groups.keys):
+            in_group = table['ref'] == value
+            self.assertTrue(groups.count()[idx] == np.sum(in_group))
+            self.assertAlmostEqual(groups.mean('cc')[idx], np.mean(table['cc'][in_group]))
+            self.assertTrue(groups.min('x')[idx] == np.min(table['x'][in_group]))
+            self.assertTrue(groups.max('x')[idx] == np.max(table['x'][in_group]))
+            np.testing.assert_array_equal(groups.rows()[value], np.flatnonzero(in_group))
+            np.testing.assert_array_equal(groups.tables()[value]['tag'], table['tag'][in_group])
+
+        particles_per_class = table.particles_per_class()
+        self.assertTrue(sum(particles_per_class.values()) == table.number_of_particles())
+        particles_per_class, percentage_per_class = table.class_distribution()
+        self.assertAlmostEqual(sum(percentage_per_class.values()), 100)
+
+    def test_map_tomograms(self):
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl')
+        table = table.subtable(np.random.permutation(table.number_of_particles()))
+
+        serial = table.map_tomograms(distance_to_tomogram_centre, workers=1)
+        parallel = table.map_tomograms(distance_to_tomogram_centre, workers=2)
+        np.testing.assert_array_equal(parallel, serial)
+        for tomo_idx in table.unique_tomograms():
+            in_tomogram = table['tomo'] == tomo_idx
+            np.testing.assert_allclose(serial[in_tomogram], distance_to_tomogram_centre(table.subtable(in_tomogram)))
+
+        counts = table.map_tomograms(ABTT.io.dynamo.DynamoTable.number_of_particles, workers=2, per_row=False)
+        self.assertTrue(counts == dict(zip(*np.unique(table['tomo'], return_counts=True))))
+
+        # columns outside of the table convention are shared too
+        table['score'] = np.arange(table.number_of_particles())
+        np.testing.assert_array_equal(table.map_tomograms(custom_score, workers=2),
+                                      table.map_tomograms(custom_score, workers=1))
+
+        # columns keep their dtype whatever the number of workers
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl', float_dtype=np.float32)
+        table['score'] = np.arange(table.number_of_particles())
+        serial = table.map_tomograms(column_dtypes, workers=1, per_row=False)
+        self.assertTrue(serial == table.map_tomograms(column_dtypes, workers=2, per_row=False))
+        self.assertTrue(all(dtypes['score'] == np.int64 and dtypes['x'] == np.float32 for dtypes in serial.values()))
+
+        # results holding views of the shared memory, such as subtables, are copied out of it
+        serial = table.map_tomograms(first_particles, workers=1, per_row=False)
+        parallel = table.map_tomograms(first_particles, workers=2, per_row=False)
+        self.assertTrue(parallel.keys() == serial.keys())
+        for tomo_idx, subtable in parallel.items():
+            self.assertTrue(list(subtable) == list(serial[tomo_idx]))
+            for key in subtable:
+                np.testing.assert_array_equal(subtable[key], serial[tomo_idx][key])
+
+        table['name'] = np.array(['particle'] * table.number_of_particles())
+        for workers in (1, 2):
+            with self.assertRaises(ValueError):
+                table.map_tomograms(custom_score, workers=workers)
+
+        empty = table.subtable(slice(0, 0))
+        del empty['name']
+        for workers in (1, 2):
+            self.assertTrue(len(empty.map_tomograms(custom_score, workers=workers)) == 0)
+            self.assertTrue(empty.map_tomograms(custom_score, workers=workers, per_row=False) == {})
+
+    def test_remove_duplicates(self):
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl')
+        nrows = table.number_of_particles()
+        duplicated = ABTT.io.dynamo.DynamoTable()
+        for key in table:
+            duplicated[key] = np.concatenate((table[key], table[key]))
+        duplicated['dx'][nrows:] += 0.5
+        duplicated['cc'][:nrows] = duplicated['cc'][nrows:] + 1
+
+        unique = duplicated.remove_duplicates(1, keep='cc')
+        np.testing.assert_array_equal(unique['tag'], table['tag'])
+        np.testing.assert_array_equal(unique['dx'], table['dx'])
+        self.assertTrue(table.remove_duplicates(1).number_of_particles() == nrows)
+
+        # a chain of neighbours is not merged into a single particle
+        line = ABTT.io.dynamo.DynamoTable()
+        line['tag'] = np.arange(10) + 1
+        line['x'] = np.arange(10) * 0.9
+        line['y'] = np.zeros(10)
+        line['z'] = np.zeros(10)
+        line['tomo'] = np.ones(10)
+        np.testing.assert_array_equal(line.remove_duplicates(1, keep=None)['tag'], [1, 3, 5, 7, 9])
+
+        # every removed particle is a duplicate of a kept particle with a better score
+        rng = np.random.default_rng(0)
+        dense = ABTT.io.dynamo.DynamoTable()
+        dense['tag'] = np.arange(2000) + 1
+        for key, values in zip(('x', 'y', 'z'), rng.uniform(0, 20, (3, 2000))):
+            dense[key] = values
+        dense['tomo'] = rng.integers(1, 3, 2000)
+        dense['cc'] = rng.uniform(size=2000)
+        unique = dense.remove_duplicates(1.5)
+        removed = ~np.isin(dense['tag'], unique['tag'])
+        self.assertTrue(0 < np.sum(removed) < 2000)
+        for idx in np.flatnonzero(removed):
+            duplicate_of = ((unique['tomo'] == dense['tomo'][idx]) & (unique['cc'] > dense['cc'][idx]) &
+                            (np.linalg.norm(unique['xyz'] - dense['xyz'][idx], axis=1) < 1.5))
+            self.assertTrue(np.any(duplicate_of))
+        self.assertTrue(len(unique.neighbour_list(1.5)[0]) == 0)
+
+
+class ConvertTest(unittest.TestCase):
+    def test_dynamo_star_round_trip(self):
+        table = ABTT.io.dynamo.table_read('example_data/io/dynamotable.tbl')
+        table_map = {1: '/data/tomo_1.mrc', 2: '/data/tomo_2.mrc'}
+        star = ABTT.io.convert.dynamo_to_star(table, table_map)
+        np.testing.assert_array_equal(star['rlnMicrographName'],
+                                      np.where(table['tomo'] == 1, 'tomo_1.mrc', 'tomo_2.mrc'))
+        np.testing.assert_array_equal(star['rlnCoordinateX'], table['xyz'][:, 0])
+
+        converted, converted_map = ABTT.io.convert.star_to_dynamo(star)
+        self.assertTrue(converted_map == {1: 'tomo_1.mrc', 2: 'tomo_2.mrc'})
+        np.testing.assert_array_equal(converted['tomo'], table['tomo'])
+        np.testing.assert_array_equal(converted['xyz'], table['xyz'])
+
+        # euler angles are compared through the rotations they describe
+        rotations = ABTT.math.euler_angles.Conversion(table['eulers'], from_software='dynamo').rotation_matrices
+        converted_rotations = ABTT.math.euler_angles.Conversion(converted['eulers'],
+                                                                from_software='dynamo').rotation_matrices
+        np.testing.assert_allclose(converted_rotations, rotations, atol=1e-6)
+
+        with self.assertRaises(KeyError):
+            ABTT.io.convert.dynamo_to_star(table, {1: '/data/tomo_1.mrc'})
+
+    def test_stream_conversion(self):
+        table_file = 'example_data/io/dynamotable.tbl'
+        with tempfile.TemporaryDirectory() as directory:
+            table_map_file = os.path.join(directory, 'stream_map.doc')
+            star_file = os.path.join(directory, 'stream.star')
+            converted_table_file = os.path.join(directory, 'stream.tbl')
+            table_map = {1: '/data/tomo_1.mrc', 2: '/data/tomo_2.mrc'}
+            ABTT.io.dynamo.table_map_write(table_map, table_map_file)
+
+            table = ABTT.io.dynamo.table_read(table_file)
+            chunks = list(ABTT.io.dynamo.iter_table_chunks(table_file, chunksize=7))
+            self.assertTrue(len(chunks) == int(np.ceil(table.number_of_particles() / 7)))
+            np.testing.assert_array_equal(np.concatenate([chunk.data for chunk in chunks]), table.data)
+
+            ABTT.io.convert.stream_dynamo_to_star(table_file, table_map_file, star_file, chunksize=7)
+            star = ABTT.io.star.read(star_file)
+            expected = ABTT.io.convert.dynamo_to_star(table, table_map)
+            for heading in expected.headings():
+                if heading == 'rlnMicrographName':
+                    np.testing.assert_array_equal(star[heading], expected[heading])
+                else:
+                    np.testing.assert_allclose(star[heading], expected[heading], atol=1e-4)
+
+            # tomograms first seen in later chunks are indexed after those already in the table map
+            star['rlnImageName'] = np.array([f'particle_{idx}.mrc' for idx in range(star.nrows())])
+            star['rlnMicrographName'] = np.where(table['tag'] > 10, 'a.mrc', star['rlnMicrographName'])
+            star.write(star_file)
+            converted_map = ABTT.io.convert.stream_star_to_dynamo(star_file, converted_table_file, chunksize=7,
+                                                                  reextraction_box_size=32)
+            converted = ABTT.io.dynamo.table_read(converted_table_file)
+            first_chunk_tomograms = np.unique(star['rlnMicrographName'][:7]).tolist()
+            self.assertTrue([converted_map[idx] for idx in sorted(converted_map)][:len(first_chunk_tomograms)] ==
+                            first_chunk_tomograms)
+            converted_map_file = converted_table_file.replace('.tbl', '.doc')
+            self.assertTrue(ABTT.io.dynamo.table_map_read(converted_map_file) == converted_map)
+            np.testing.assert_array_equal(ABTT.io.convert.tomogram_names(converted['tomo'], converted_map),
+                                          star['rlnMicrographName'])
+            np.testing.assert_array_equal(converted['tag'], np.arange(star.nrows()) + 1)
+            np.testing.assert_allclose(converted['xyz'], table['xyz'], atol=1e-4)
+
+            reextraction = ABTT.io.dynamo.table_read(converted_table_file.replace('.tbl', '_reextract.tbl'))
+            np.testing.assert_array_equal(reextraction['tomo'], converted['tag'])
+            reextraction_map = ABTT.io.dynamo.table_map_read(converted_table_file.replace('.tbl', '_reextract.doc'))
+            self.assertTrue(reextraction_map[star.nrows()] == f'particle_{star.nrows() - 1}.mrc')
+
+    def test_stream_numeric_names(self):
+        # tomograms and particles named like numbers keep their names and indices in every chunk
+        names = ['007', '007', '007', 'a.mrc', '007']
+        with tempfile.TemporaryDirectory() as directory:
+            star_file = os.path.join(directory, 'numeric.star')
+            with open(star_file, 'w') as file:
+                file.write('data_\n\nloop_\n')
+                file.writelines(f'_{heading} #{idx + 1}\n' for idx, heading in enumerate(
+                    ('rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ', 'rlnAngleRot', 'rlnAngleTilt',
+                     'rlnAnglePsi', 'rlnMicrographName', 'rlnImageName')))
+                file.writelines(f'1 2 3 0 0 0 {name} 00{idx}\n' for idx, name in enumerate(names))
+
+            table_file = os.path.join(directory, 'numeric.tbl')
+            table_map = ABTT.io.convert.stream_star_to_dynamo(star_file, table_file, chunksize=2,
+                                                              reextraction_box_size=32)
+            self.assertTrue(table_map == {1: '007', 2: 'a.mrc'})
+            np.testing.assert_array_equal(ABTT.io.dynamo.table_read(table_file)['tomo'], [1, 1, 1, 2, 1])
+            reextraction_map = ABTT.io.dynamo.table_map_read(table_file.replace('.tbl', '_reextract.doc'))
+            self.assertTrue(list(reextraction_map.values()) == [f'00{idx}' for idx in range(len(names))])
+
+    def test_stream_relion_31(self):
+        optics = ABTT.io.star.StarDict()
+        optics['rlnOpticsGroup'] = np.array([1, 2])
+        optics['rlnImagePixelSize'] = np.array([1.5, 2.0])
+        particles = ABTT.io.star.StarDict()
+        for heading in ('rlnCoordinateX', 'rlnCoordinateY', 'rlnCoordinateZ', 'rlnAngleRot', 'rlnAngleTilt',
+                        'rlnAnglePsi'):
+            particles[heading] = np.arange(10, dtype=float)
+        particles['rlnMicrographName'] = np.array(['tomo_1.mrc'] * 5 + ['tomo_2.mrc'] * 5)
+        particles['rlnOpticsGroup'] = np.ones(10, dtype=int)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # the optics table comes first in RELION 3.1 star files
+            star_file = os.path.join(directory, 'particles.star')
+            ABTT.io.star.write_blocks({'data_optics': optics, 'data_particles': particles}, star_file)
+            table_file = os.path.join(directory, 'particles.tbl')
+            table_map = ABTT.io.convert.stream_star_to_dynamo(star_file, table_file, chunksize=4)
+            self.assertTrue(table_map == {1: 'tomo_1.mrc', 2: 'tomo_2.mrc'})
+            np.testing.assert_allclose(ABTT.io.dynamo.table_read(table_file)['x'], particles['rlnCoordinateX'])
+            self.assertTrue(ABTT.io.star.read_many([star_file], workers=1).nrows() == 10)
+            self.assertTrue(sum(chunk.nrows() for chunk in ABTT.io.star.iter_chunks(star_file)) == 10)
+            # data_particles is found without indexing the whole file
+            self.assertTrue(os.path.abspath(star_file) not in ABTT.io.star._block_indices)
+
+            optics_file = os.path.join(directory, 'optics.star')
+            ABTT.io.star.write_blocks({'data_optics': optics}, optics_file)
+            with self.assertRaises(ValueError):
+                ABTT.io.convert.stream_star_to_dynamo(optics_file, os.path.join(directory, 'optics.tbl'))
+
+    def test_table_map_write(self):
+        table_map = {1: '/data/tomo_1.mrc', 2: '/data/tomo_2.mrc'}
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'table_map.doc')
+            ABTT.io.dynamo.table_map_write(table_map, file)
+            self.assertTrue(ABTT.io.dynamo.table_map_read(file) == table_map)
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 import numpy as np
@@ -73,6 +75,23 @@ class EulerAnglesTest(unittest.TestCase):
         np.testing.assert_array_almost_equal(rotation_matrix, rotation_matrix_ref, decimal=4)
         return rotation_matrix
 
+    def test_calculate_rotation_matrices(self):
+        euler_angles = np.random.default_rng(0).random((100, 3)) * 720 - 360
+        euler_angles[0] = [-155.55, 63.924, 197.81]
+        for axes in ('ZXZ', 'ZYZ', 'XYZ', 'ZYX', 'YXY'):
+            for intrinsic in (True, False):
+                rotation_matrices = ABTT.math.euler_angles.calculate_rotation_matrices(euler_angles, axes,
+                                                                                       intrinsic=intrinsic,
+                                                                                       extrinsic=not intrinsic)
+                for euler_triplet, rotation_matrix in zip(euler_angles, rotation_matrices):
+                    reference = ABTT.math.euler_angles.calculate_rotation_matrix(euler_triplet, axes,
+                                                                                 intrinsic=intrinsic,
+                                                                                 extrinsic=not intrinsic)
+                    np.testing.assert_allclose(rotation_matrix, reference, rtol=0, atol=1e-14)
+
+        with self.assertRaises(ValueError):
+            ABTT.math.euler_angles.calculate_rotation_matrices(euler_angles, 'ZWZ')
+
     def test_matrix2ZYZeuler(self):
         euler_triplet_ref = [107.81, 63.924, -65.55]  # Extrinsic euler angles
         rotation_matrix = self.test_calculate_rotation_matrix_ZYZ()
@@ -89,6 +108,29 @@ class EulerAnglesTest(unittest.TestCase):
         recalculated_rotation_matrix = ABTT.euler_angles.calculate_rotation_matrix(euler_triplet, 'ZXZ', intrinsic=True)
         np.testing.assert_array_almost_equal(rotation_matrix, recalculated_rotation_matrix)
 
+    def test_matrices2euler(self):
+        euler_angles = np.random.default_rng(0).random((100, 3)) * 360 - 180
+        # gimbal lock, tilt = 0 or 180, and tilts close to it
+        euler_angles[:6, 1] = [0, 180, -180, 1e-3, 179.999, 1e-8]
+        for axes, matrix2euler, matrices2euler in (('ZXZ', ABTT.math.euler_angles.matrix2ZXZeuler,
+                                                    ABTT.math.euler_angles.matrices2ZXZeuler),
+                                                   ('ZYZ', ABTT.math.euler_angles.matrix2ZYZeuler,
+                                                    ABTT.math.euler_angles.matrices2ZYZeuler)):
+            for intrinsic in (True, False):
+                rotation_matrices = ABTT.math.euler_angles.calculate_rotation_matrices(euler_angles, axes,
+                                                                                       intrinsic=intrinsic,
+                                                                                       extrinsic=not intrinsic)
+                euler_angles_batch = matrices2euler(rotation_matrices, intrinsic=intrinsic, extrinsic=not intrinsic)
+                for rotation_matrix, euler_triplet in zip(rotation_matrices, euler_angles_batch):
+                    reference = matrix2euler(rotation_matrix, intrinsic=intrinsic, extrinsic=not intrinsic)
+                    np.testing.assert_array_equal(euler_triplet, reference)
+
+                # angles are in degrees and describe the same rotations, including at gimbal lock
+                recalculated = ABTT.math.euler_angles.calculate_rotation_matrices(euler_angles_batch, axes,
+                                                                                  intrinsic=intrinsic,
+                                                                                  extrinsic=not intrinsic)
+                np.testing.assert_allclose(recalculated, rotation_matrices, atol=1e-6)
+
     def test_AngleConversion(self):
         euler_triplet_ZXZ_intrinsic = [-155.55, 63.924, 197.81]  # rotates_reference
         euler_triplet_ZYZ_extrinsic = [107.81, 63.924, -65.55]  # rotates reference
@@ -110,6 +152,260 @@ class EulerAnglesTest(unittest.TestCase):
                                              conversion_object.euler_angles)
 
 
+class ConversionPlanTest(unittest.TestCase):
+    software = ('relion', 'dynamo', 'emclarity')
+
+    @staticmethod
+    def rotation_matrices(euler_angles, software):
+        return ABTT.math.euler_angles.Conversion(euler_angles, from_software=software).rotation_matrices
+
+    @staticmethod
+    def random_euler_angles(n=1000):
+        euler_angles = np.random.default_rng(0).random((n, 3)) * 360 - 180
+        euler_angles[:, 1] = (euler_angles[:, 1] + 180) / 2
+        # gimbal lock and tilts close to it
+        euler_angles[:6, 1] = [0, 180, 1e-9, 1e-4, 179.9999, 180 - 1e-9]
+        return euler_angles
+
+    def test_conversion_plan_cached(self):
+        plan = ABTT.math.euler_angles.conversion_plan('relion', 'dynamo')
+        self.assertTrue(ABTT.math.euler_angles.conversion_plan('RELION', 'dynamo') is plan)
+        self.assertTrue(plan.mapping is not None)
+        self.assertFalse(plan.transpose)
+        self.assertTrue(ABTT.math.euler_angles.conversion_plan('dynamo', 'emclarity').transpose)
+
+    def test_known_conversion(self):
+        euler_triplet_dynamo = [-155.55, 63.924, 197.81 - 360]
+        euler_triplet_relion = [107.81, 63.924, -65.55]
+        np.testing.assert_allclose(ABTT.math.euler_angles.relion2dynamo(euler_triplet_relion),
+                                   [euler_triplet_dynamo], atol=1e-10)
+        np.testing.assert_allclose(ABTT.math.euler_angles.dynamo2relion(euler_triplet_dynamo),
+                                   [euler_triplet_relion], atol=1e-10)
+
+    def test_closed_form_matches_matrices(self):
+        euler_angles = self.random_euler_angles()
+        for from_software in self.software:
+            for target_software in self.software:
+                plan = ABTT.math.euler_angles.conversion_plan(from_software, target_software)
+                reference = self.rotation_matrices(plan.apply_matrices(euler_angles), target_software)
+                np.testing.assert_allclose(self.rotation_matrices(plan.apply(euler_angles), target_software),
+                                           reference, atol=1e-6)
+
+                if from_software != target_software:
+                    conversion = ABTT.math.euler_angles.Conversion(euler_angles, from_software=from_software,
+                                                                   target_software=target_software)
+                    np.testing.assert_allclose(self.rotation_matrices(conversion.euler_angles, target_software),
+                                               reference, atol=1e-6)
+
+    def test_round_trip(self):
+        euler_angles = self.random_euler_angles()
+        for idx, from_software in enumerate(self.software):
+            reference = self.rotation_matrices(euler_angles, from_software)
+            for target_software in self.software:
+                converted = ABTT.math.euler_angles.convert_euler_angles(euler_angles, from_software, target_software)
+                self.assertTrue(np.all((converted[:, [0, 2]] > -180) & (converted[:, [0, 2]] <= 180)))
+                round_trip = ABTT.math.euler_angles.convert_euler_angles(converted, target_software, from_software)
+                np.testing.assert_allclose(self.rotation_matrices(round_trip, from_software), reference, atol=1e-12)
+
+            # round trip through every convention
+            converted, current_software = euler_angles, from_software
+            for target_software in self.software[idx + 1:] + self.software[:idx + 1]:
+                converted = ABTT.math.euler_angles.convert_euler_angles(converted, current_software, target_software)
+                current_software = target_software
+            np.testing.assert_allclose(self.rotation_matrices(converted, from_software), reference, atol=1e-12)
+
+
+class OrientationsTest(unittest.TestCase):
+    software = ('relion', 'dynamo', 'emclarity')
+
+    @staticmethod
+    def random_orientations(n=1000, seed=0):
+        euler_angles = np.random.default_rng(seed).random((n, 3)) * 360 - 180
+        euler_angles[:3, 1] = [0, 180, 1e-9]
+        return euler_angles, ABTT.math.orientations.Orientations.from_euler_angles(euler_angles, 'dynamo')
+
+    def test_euler_angles(self):
+        euler_angles, _ = self.random_orientations()
+        for from_software in self.software:
+            orientations = ABTT.math.orientations.Orientations.from_euler_angles(euler_angles, from_software)
+            rotation_matrices = ABTT.math.euler_angles.Conversion(euler_angles,
+                                                                  from_software=from_software).rotation_matrices
+            if from_software == 'emclarity':
+                rotation_matrices = np.transpose(rotation_matrices, (0, 2, 1))
+            np.testing.assert_allclose(orientations.to_rotation_matrices(), rotation_matrices, atol=1e-12)
+
+            for target_software in self.software:
+                converted = ABTT.math.euler_angles.convert_euler_angles(euler_angles, from_software, target_software)
+                reference = ABTT.math.euler_angles.Conversion(converted, from_software=target_software)
+                recalculated = ABTT.math.euler_angles.Conversion(orientations.to_euler_angles(target_software),
+                                                                 from_software=target_software)
+                np.testing.assert_allclose(recalculated.rotation_matrices, reference.rotation_matrices, atol=1e-6)
+
+    def test_rotation_matrices(self):
+        _, orientations = self.random_orientations()
+        rotation_matrices = orientations.to_rotation_matrices()
+        recalculated = ABTT.math.orientations.Orientations.from_rotation_matrices(rotation_matrices)
+        np.testing.assert_allclose(recalculated.to_rotation_matrices(), rotation_matrices, atol=1e-12)
+        self.assertTrue(np.all(recalculated.quaternions[:, 0] >= 0))
+
+    def test_compose_inverse_apply(self):
+        _, orientations = self.random_orientations()
+        _, other = self.random_orientations(seed=1)
+        rotation_matrices = orientations.to_rotation_matrices()
+
+        np.testing.assert_allclose((orientations * other).to_rotation_matrices(),
+                                   rotation_matrices @ other.to_rotation_matrices(), atol=1e-12)
+        np.testing.assert_allclose((orientations * orientations.inverse()).to_rotation_matrices(),
+                                   np.broadcast_to(np.eye(3), rotation_matrices.shape), atol=1e-12)
+        np.testing.assert_allclose((orientations * other[:1]).to_rotation_matrices(),
+                                   rotation_matrices @ other[:1].to_rotation_matrices(), atol=1e-12)
+
+        vectors = np.random.default_rng(2).random((len(orientations), 3))
+        np.testing.assert_allclose(orientations.apply(vectors), np.einsum('nij,nj->ni', rotation_matrices, vectors),
+                                   atol=1e-12)
+        np.testing.assert_allclose(orientations.apply([0, 0, 1]), rotation_matrices[:, :, 2], atol=1e-12)
+
+    def test_slerp(self):
+        _, orientations = self.random_orientations()
+        _, other = self.random_orientations(seed=1)
+        np.testing.assert_allclose(orientations.slerp(other, 0).to_rotation_matrices(),
+                                   orientations.to_rotation_matrices(), atol=1e-12)
+        np.testing.assert_allclose(orientations.slerp(other, 1).to_rotation_matrices(),
+                                   other.to_rotation_matrices(), atol=1e-12)
+
+        # halfway, the rotation from each orientation to the interpolated orientation is half the rotation between them
+        # cos(angle / 4) ** 2 = (1 + cos(angle / 2)) / 2
+        halfway = orientations.slerp(other, 0.5)
+        np.testing.assert_allclose((halfway * orientations.inverse()).quaternions[:, 0] ** 2,
+                                   (1 + np.abs((other * orientations.inverse()).quaternions[:, 0])) / 2, atol=1e-12)
+        np.testing.assert_allclose(orientations.slerp(orientations, 0.3).to_rotation_matrices(),
+                                   orientations.to_rotation_matrices(), atol=1e-12)
+
+    def test_float32(self):
+        euler_angles, orientations = self.random_orientations()
+        orientations_float32 = ABTT.math.orientations.Orientations.from_euler_angles(euler_angles, 'dynamo',
+                                                                                     dtype=np.float32)
+        self.assertTrue(orientations_float32.quaternions.dtype == np.float32)
+        self.assertTrue(orientations_float32.quaternions.nbytes == 16 * len(euler_angles))
+        np.testing.assert_allclose(orientations_float32.to_rotation_matrices(), orientations.to_rotation_matrices(),
+                                   atol=1e-6)
+
+
+class SymmetryTest(unittest.TestCase):
+    def test_symmetry_operators(self):
+        for symmetry, order in (('C1', 1), ('c2', 2), ('C7', 7), ('D2', 4), ('D6', 12), ('T', 12), ('O', 24),
+                                ('I', 60)):
+            operators = ABTT.math.symmetry.symmetry_operators(symmetry)
+            self.assertTrue(len(operators) == order)
+            np.testing.assert_allclose(operators.quaternions[0], [1, 0, 0, 0])
+
+        with self.assertRaises(ValueError):
+            ABTT.math.symmetry.symmetry_operators('C0')
+        with self.assertRaises(ValueError):
+            ABTT.math.symmetry.symmetry_operators('H')
+
+    def test_angular_distance(self):
+        rng = np.random.default_rng(0)
+        euler_angles_a = rng.random((1000, 3)) * 360 - 180
+        euler_angles_b = rng.random((1000, 3)) * 360 - 180
+
+        # without symmetry, the angle of the rotation between the two orientations
+        rotations_a = ABTT.math.euler_angles.Conversion(euler_angles_a, from_software='relion').rotation_matrices
+        rotations_b = ABTT.math.euler_angles.Conversion(euler_angles_b, from_software='relion').rotation_matrices
+        trace = np.einsum('nji,nji->n', rotations_a, rotations_b)
+        reference = np.rad2deg(np.arccos(np.clip((trace - 1) / 2, -1, 1)))
+        distance = ABTT.math.symmetry.angular_distance(euler_angles_a, euler_angles_b)
+        np.testing.assert_allclose(distance, reference, atol=1e-6)
+        np.testing.assert_allclose(ABTT.math.symmetry.angular_distance(euler_angles_b, euler_angles_a), distance,
+                                   atol=1e-10)
+
+        # the same orientations in different conventions
+        euler_angles_dynamo = ABTT.math.euler_angles.relion2dynamo(euler_angles_a)
+        np.testing.assert_allclose(ABTT.math.symmetry.angular_distance(euler_angles_a, euler_angles_dynamo,
+                                                                       software='relion', software_b='dynamo'),
+                                   0, atol=1e-6)
+
+        # symmetry equivalent orientations, a @ S
+        orientations_a = ABTT.math.orientations.Orientations.from_euler_angles(euler_angles_a, 'relion')
+        for symmetry in ('C2', 'D3', 'T', 'O', 'I'):
+            operators = ABTT.math.symmetry.symmetry_operators(symmetry)
+            equivalent = orientations_a * operators[rng.integers(0, len(operators), len(orientations_a))]
+            np.testing.assert_allclose(ABTT.math.symmetry.angular_distance(euler_angles_a,
+                                                                           equivalent.to_euler_angles('relion'),
+                                                                           symmetry=symmetry),
+                                       0, atol=1e-6)
+            symmetric_distance = ABTT.math.symmetry.angular_distance(euler_angles_a, euler_angles_b,
+                                                                     symmetry=symmetry)
+            self.assertTrue(np.all(symmetric_distance <= distance + 1e-10))
+
+        # a rotation of 170 degrees about the C2 axis is 10 degrees away from a symmetry equivalent orientation
+        rotated = orientations_a * ABTT.math.orientations.Orientations([np.cos(np.deg2rad(85)), 0, 0,
+                                                                        np.sin(np.deg2rad(85))])
+        np.testing.assert_allclose(ABTT.math.symmetry.orientation_distance(orientations_a, rotated, symmetry='C2'),
+                                   10, atol=1e-8)
+
+
+class SamplingTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        ABTT.math.sampling._cached_grid.cache_clear()
+        self.cache.cleanup()
+
+    def nearest_grid_distance(self, grid, euler_angles, symmetry='C1'):
+        grid = ABTT.math.orientations.Orientations.from_euler_angles(grid, 'relion')
+        orientations = ABTT.math.orientations.Orientations.from_euler_angles(euler_angles, 'relion')
+        return np.array([np.min(ABTT.math.symmetry.orientation_distance(grid, orientations[idx:idx + 1], symmetry))
+                         for idx in range(len(orientations))])
+
+    def test_orientation_grid(self):
+        step = 15
+        grid = ABTT.math.sampling.orientation_grid(step, cache_dir=self.cache.name)
+        self.assertTrue(grid.shape == (4392, 3))
+        self.assertTrue(grid.flags.c_contiguous)
+
+        # every orientation is close to the grid
+        euler_angles = np.random.default_rng(0).random((100, 3)) * 360 - 180
+        self.assertTrue(np.all(self.nearest_grid_distance(grid, euler_angles) < step))
+
+        # grids are the same orientations in every convention
+        grid_dynamo = ABTT.math.sampling.orientation_grid(step, software='dynamo', cache_dir=self.cache.name)
+        np.testing.assert_allclose(ABTT.math.symmetry.angular_distance(grid, grid_dynamo, software='relion',
+                                                                       software_b='dynamo'), 0, atol=1e-6)
+
+    def test_orientation_grid_symmetry(self):
+        step = 15
+        n_orientations = len(ABTT.math.sampling.orientation_grid(step, cache_dir=self.cache.name))
+        euler_angles = np.random.default_rng(0).random((100, 3)) * 360 - 180
+        for symmetry, order in (('C2', 2), ('D2', 4), ('O', 24)):
+            grid = ABTT.math.sampling.orientation_grid(step, symmetry, cache_dir=self.cache.name)
+            self.assertTrue(abs(len(grid) * order / n_orientations - 1) < 0.05)
+            self.assertTrue(np.all(self.nearest_grid_distance(grid, euler_angles, symmetry) < step))
+
+    def test_orientation_grid_cone(self):
+        prior = [10, 20, 30]
+        grid = ABTT.math.sampling.orientation_grid(5, software='dynamo', cone=12, prior=prior,
+                                                   cache_dir=self.cache.name)
+        distance = ABTT.math.symmetry.angular_distance(grid, np.tile(prior, (len(grid), 1)), software='dynamo')
+        self.assertTrue(len(grid) > 0)
+        self.assertTrue(np.all(distance <= 12 + 1e-9))
+        self.assertTrue(np.min(distance) < 1e-6)
+
+    def test_orientation_grid_cache(self):
+        grid = ABTT.math.sampling.orientation_grid(30, 'C2', cache_dir=self.cache.name)
+        self.assertTrue(ABTT.math.sampling.orientation_grid(30, 'c2', cache_dir=self.cache.name) is grid)
+        self.assertFalse(grid.flags.writeable)
+        self.assertTrue(len(os.listdir(self.cache.name)) == 1)
+
+        ABTT.math.sampling._cached_grid.cache_clear()
+        np.testing.assert_array_equal(ABTT.math.sampling.orientation_grid(30, 'C2', cache_dir=self.cache.name), grid)
+
+        # close steps are stored in files of their own
+        ABTT.math.sampling.orientation_grid(30.0000001, 'C2', cache_dir=self.cache.name)
+        self.assertTrue(len(os.listdir(self.cache.name)) == 2)
+
+
 class CTFTest(unittest.TestCase):
     def test_electron_wavelength(self):
         electron_wavelength = ABTT.math.electron.relativistic_wavelength(300000)
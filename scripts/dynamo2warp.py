@@ -1,17 +1,12 @@
 #!/usr/bin/env python
 # Import modules and put ABTT on path until it's available in environment
-import os
 import pathlib
 import sys
 
 sys.path.append('/mnt/storage/documents/IBS_PhD/programming/ABTT')
-import numpy as np
 import click
 
-from ABTT.io.dynamo import table_map_read
-from ABTT.io.dynamo import table_read as dynamo_table_read
-from ABTT.io.star import StarDict
-from ABTT.math.euler_angles import dynamo2relion as eulers_dynamo2relion
+from ABTT.io.convert import stream_dynamo_to_star
 
 
 # Set up parser and command line interface
@@ -44,48 +39,8 @@ def main(dynamo_table_file, table_map_file, output_star_file):
         if not file.exists():
             raise Exception(f'File {file.absolute()} does not exist...')
 
-    # Read table and table map
-    table = dynamo_table_read(dynamo_table_file)
-    table_map = table_map_read(table_map_file)
-
-    # get number of rows
-    n_rows = table['x'].shape[0]
-
-    # Initialise StarDict for writing out star file
-    star = StarDict()
-
-    # Convert euler angles
-    euler_angles_dynamo = table['eulers']
-    euler_angles_relion = eulers_dynamo2relion(euler_angles_dynamo)
-    rln_rot = euler_angles_relion[:, 0]
-    rln_tilt = euler_angles_relion[:, 1]
-    rln_psi = euler_angles_relion[:, 2]
-
-    # Collect micrograph basenames
-    for tomo_idx in table_map:
-        path = table_map[tomo_idx]
-        basename = os.path.basename(path)
-        table_map[tomo_idx] = basename
-
-    # Make list of basenames matching tomogram index from table
-    basenames = np.empty(n_rows, dtype=object)
-
-    for idx, tomo_idx in enumerate(table['tomo']):
-        basenames[idx] = table_map[tomo_idx]
-
-    # Add necessary info under proper headings to star file
-    star['rlnCoordinateX'] = table['xyz'][:, 0]
-    star['rlnCoordinateY'] = table['xyz'][:, 1]
-    star['rlnCoordinateZ'] = table['xyz'][:, 2]
-
-    star['rlnAngleRot'] = rln_rot
-    star['rlnAngleTilt'] = rln_tilt
-    star['rlnAnglePsi'] = rln_psi
-
-    star['rlnMicrographName'] = basenames
-
-    # Write out star file
-    star.write(output_star_file)
+    # Convert positions, euler angles and tomogram names chunk by chunk, writing out the star file as we go
+    stream_dynamo_to_star(dynamo_table_file, table_map_file, output_star_file)
     click.echo('Done!')
 
 